@@ -1,14 +1,139 @@
 #!/usr/bin/env python3
 
 import argparse
+import csv
+import glob
+import json
 import os
-import subprocess
+import re
+import shutil
+import sys
 import pandas as pd
 
-def run_command(cmd, dry_run=False, env=None, workdir=None, shell=False):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True, env=env, shell=shell, cwd=workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command
+from utils.lr_pyramid import LRPyramid, image_stem
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# final transforms of an input of the template script: <prefix>input<index>-<first image stem>-0GenericAffine.mat
+TRANSFORM_NAME = re.compile(r"^input(\d{4})-(.+)-0GenericAffine\.mat$")
+
+def template_script(args):
+    """
+    antsMultivariateTemplateConstruction2.sh to run and its environment: the one of $ANTSPATH,
+    or the vendored copy for the local scheduler (-c 6, utils/template_jobs.py) and its options,
+    for the warm start (-W) and the convergence check (not in the ANTs release).
+    """
+    if args.control != 6 and not args.warm_start and args.converge_tol is None:
+        return os.path.join("$ANTSPATH", "antsMultivariateTemplateConstruction2.sh"), None
+
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    if args.control == 6:
+        env["ANTS_TEMPLATE_SCHEDULER"] = " ".join(scheduler_command(args))
+    return os.path.join(REPO_ROOT, "postprocessing", "antsMultivariateTemplateConstruction2.sh"), env
+
+def scheduler_command(args):
+    """utils/template_jobs.py command line of the -c 6 options."""
+    scheduler = [sys.executable, "-m", "utils.template_jobs", "--threads-per-job", str(args.threads_per_job),
+                 "--retries", str(args.job_retries)]
+    if args.job_timeout:
+        scheduler += ["--timeout", str(args.job_timeout)]
+    if args.job_memory:
+        scheduler += ["--memory", str(args.job_memory)]
+    return scheduler
+
+def convergence_env(args, env, json_path):
+    """
+    Environment of one stage with the convergence check (utils/template_convergence.py) run
+    after each iteration, its curve written to json_path; env unchanged without --converge-tol.
+    """
+    if args.converge_tol is None:
+        return env
+    check = [sys.executable, "-m", "utils.template_convergence", "--tol", str(args.converge_tol),
+             "--min-iterations", str(args.converge_min_ite), "--json", json_path]
+    if args.converge_warp_tol is not None:
+        check += ["--warp-tol", str(args.converge_warp_tol)]
+    env = dict(env)
+    env["ANTS_TEMPLATE_CONVERGENCE"] = " ".join(check)
+    return env
+
+def last_iteration(args, iterations, json_path):
+    """Last iteration run by a stage: the one it converged at, else iterations - 1."""
+    if args.converge_tol is not None and os.path.exists(json_path):
+        with open(json_path, encoding="utf-8") as f:
+            curve = json.load(f)
+        if curve.get("converged"):
+            return curve["last_iteration"]
+    return iterations - 1
+
+def warm_start_options(args, warm_q, initial_prefix=None):
+    """
+    Warm-start options of antsMultivariateTemplateConstruction2.sh (vendored copy, -W/-Q/-I):
+    iterations after the first start from the transforms of the previous one, and with
+    initial_prefix the first one starts from the transforms of that run.
+    """
+    if not args.warm_start:
+        return ""
+    opts = "-W 1 "
+    if warm_q:
+        opts += f"-Q {warm_q} "
+    if initial_prefix:
+        opts += f"-I {initial_prefix} "
+    return opts
+
+def read_inputs(csv_path):
+    """Rows of an input CSV as the template script reads them (no header): the images of each input."""
+    with open(csv_path, newline="") as f:
+        return [[cell.strip() for cell in row] for row in csv.reader(f) if row]
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def link_transforms(src_prefix, src_count, rows, count, dest_dir, by_name=False, dry_run=False):
+    """
+    Link the final transforms of a run of the template script (src_prefix, src_count images per
+    input) and its last template update into dest_dir, numbered as the inputs of rows (count
+    images each), for the -I option. Inputs are matched by row, or with by_name by the name of
+    their first image. Returns the -I prefix and the number of inputs matched.
+    """
+    src_dir, src_name = os.path.split(src_prefix)
+    found = {}
+    pattern = os.path.join(glob.escape(src_dir), f"{glob.escape(src_name)}input*-0GenericAffine.mat")
+    for affine in glob.glob(pattern):
+        m = TRANSFORM_NAME.match(os.path.basename(affine)[len(src_name):])
+        warp = affine[:-len("0GenericAffine.mat")] + "1Warp.nii.gz"
+        if m and os.path.exists(warp):
+            found[m.group(2) if by_name else int(m.group(1)) // src_count] = (affine, warp)
+
+    keys = [image_stem(row[0]) if by_name else row_index for row_index, row in enumerate(rows)]
+    matched = sum(key in found for key in keys)
+    dest_prefix = os.path.join(dest_dir, "MY")
+    if dry_run:
+        print(f"[DRY RUN] link the transforms of {src_prefix}input* ({matched} inputs) to {dest_prefix}input*")
+        return dest_prefix, matched
+
+    # built aside, as src_prefix may be in dest_dir
+    tmp_dir = f"{dest_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tmp_prefix = os.path.join(tmp_dir, "MY")
+    for row_index, (row, key) in enumerate(zip(rows, keys)):
+        if key not in found:
+            continue
+        base = f"{tmp_prefix}input{row_index * count:04d}-{image_stem(row[0])}-"
+        link_or_copy(found[key][0], base + "0GenericAffine.mat")
+        link_or_copy(found[key][1], base + "1Warp.nii.gz")
+    for suffix in ["template0GenericAffine.mat", "template0warp.nii.gz"]:
+        if os.path.exists(src_prefix + suffix):
+            link_or_copy(src_prefix + suffix, tmp_prefix + suffix)
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.replace(tmp_dir, dest_dir)
+    return dest_prefix, matched
 
 def main():
     parser = argparse.ArgumentParser(description="Two-stage multivariate template construction with ANTs, BIDS-style outputs")
@@ -16,9 +141,25 @@ def main():
     parser.add_argument("-S", "--session", required=True,help="Session label (e.g. ses-0)")
     parser.add_argument("-b", "--bids-root", required=True,help="BIDS root folder")
     parser.add_argument("-j", "--jobs", type=int, default=12,help="Number of CPU cores to use (default: 12)")
+    parser.add_argument("-c", "--control", type=int, choices=[0, 2, 6], default=2,
+                        help="Parallel computation of antsMultivariateTemplateConstruction2.sh: 0 = serial, 2 = pexec, "
+                             "6 = Python local scheduler (memory-aware, timeouts and retries) (default: 2)")
+    parser.add_argument("--threads-per-job", type=int, default=1,
+                        help="With -c 6, minimum ITK threads of each registration job (default: 1)")
+    parser.add_argument("--job-memory", type=float, default=None,
+                        help="With -c 6, memory budget of the registration jobs in GB (default: 90%% of the available memory)")
+    parser.add_argument("--job-timeout", type=float, default=None,
+                        help="With -c 6, time limit of a registration job in seconds, killed and retried after it")
+    parser.add_argument("--job-retries", type=int, default=1,
+                        help="With -c 6, attempts after a failed or timed out registration job (default: 1)")
     parser.add_argument("--modalities", nargs="+", required=True,help="List of modalities to look for (e.g., T1w T2w label-WM_mask)")
-    parser.add_argument("--input-list-LR", required=True,help="CSV file with list of input NIfTI images for first stage")
+    parser.add_argument("--input-list-LR", default=None,help="CSV file with list of input NIfTI images for first stage (required without --incremental)")
     parser.add_argument("--LR-reg-metrics", default="MI",help="Type of similarity metric used for pairwise registration (MI by default)")
+    parser.add_argument("--LR-voxel-size", type=float, default=None,
+                        help="Downsample the Stage 1 inputs and priors once to this voxel size in mm, anti-aliased "
+                             "and cached in tmp_LR/inputs (default: use the images of --input-list-LR as they are)")
+    parser.add_argument("--LR-priors", nargs="+", default=None,
+                        help="Initial templates of Stage 1 (-z), one per modality (default: average of the inputs)")
     parser.add_argument("--ite1", type=int, default=1,help="Number of iterations for Stage 1 (default: 1)")
     parser.add_argument("--q1", default="50x30x15",help="Steps for Stage 1 -q option (default: 50x30x15)")
     parser.add_argument("--w1", default="0.5x0.5x1",help="Weights for Stage 1 modalities (default: 0.5x0.5x1)" )
@@ -27,16 +168,33 @@ def main():
     parser.add_argument("--ite2", type=int, default=1,help="Number of iterations for Stage 2 (default: 1)")
     parser.add_argument("--q2", default="70x50x30",help="Steps for Stage 2 -q option (default: 70x50x30)")
     parser.add_argument("--w2", default="1x1x1",help="Weights for Stage 2 modalities (default: 1x1x1)")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="Start the registrations of each iteration from the transforms of the previous one, "
+                             "and those of Stage 2 from the Stage 1 transforms (same subject order in both CSV)")
+    parser.add_argument("--warm-q1", default=None,
+                        help="With --warm-start, Stage 1 -q steps of the warm-started registrations, e.g. 0x30x15 (default: --q1)")
+    parser.add_argument("--warm-q2", default=None,
+                        help="With --warm-start, Stage 2 -q steps of the warm-started registrations, e.g. 0x50x30 (default: --q2)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Update the final/ templates with the inputs of --input-list-HR instead of rebuilding them: "
+                             "no Stage 1, the final/ templates are the Stage 2 initial templates, inputs of the previous "
+                             "run start from their tmp_HR transforms, new inputs are registered from scratch (implies --warm-start)")
+    parser.add_argument("--converge-tol", type=float, default=None,
+                        help="Stop a stage once the normalised RMS change of its templates between two iterations "
+                             "is below this tolerance, e.g. 0.01 (default: run all --ite1 / --ite2 iterations)")
+    parser.add_argument("--converge-warp-tol", type=float, default=None,
+                        help="With --converge-tol, also require a mean template shape update below this value (mm)")
+    parser.add_argument("--converge-min-ite", type=int, default=2,
+                        help="With --converge-tol, iterations always run in each stage (default: 2)")
     parser.add_argument('--res-HR', type=float, default=0.4, help="pixel resolution in mm (default: 0.4)")
     parser.add_argument('--dry-run', action="store_true", help="Print commands without executing them")
 
 
     args = parser.parse_args()
-
-    # Load CSV and determine modalities count for stage 1
-    df = pd.read_csv(args.input_list_LR)
-    modalities = list(df.columns)
-    modalities_count = len(modalities)
+    if not args.incremental and not args.input_list_LR:
+        parser.error("--input-list-LR is required without --incremental")
+    if args.incremental:
+        args.warm_start = True
 
     res_HR = args.res_HR
     dry_run = args.dry_run
@@ -44,8 +202,6 @@ def main():
     LR_reg_metrics = args.LR_reg_metrics
     HR_reg_metrics = args.HR_reg_metrics
 
-    print(f"[INFO] Detected {modalities_count} modalities: {modalities}")
-
     # Define output directories under BIDS derivatives/template
     derivatives_dir = os.path.join(args.bids_root, "derivatives", "template")
     subject_dir = f"sub-{args.subject}"
@@ -53,38 +209,75 @@ def main():
     output_base = os.path.join(derivatives_dir, subject_dir, session_dir)
     tmp_LR = os.path.join(output_base, "tmp_LR")
     tmp_HR = os.path.join(output_base, "tmp_HR")
+    convergence_LR = os.path.join(tmp_LR, "convergence.json")
+    convergence_HR = os.path.join(tmp_HR, "convergence.json")
     final_dir = os.path.join(output_base, "final")
 
     for d in [tmp_LR, tmp_HR, final_dir]:
         os.makedirs(d, exist_ok=True)
 
+    # curves of a previous run would be taken for the ones of this run
+    if args.converge_tol is not None and not dry_run:
+        for path in [convergence_LR, convergence_HR]:
+            if os.path.exists(path):
+                os.remove(path)
+
     print(f"[INFO] All outputs will go to: {output_base}")
 
-    # Stage 1: low-resolution template building
-    print(f"[INFO] Starting Stage 1: Low-resolution template construction")
+    ants_script_path, ants_env = template_script(args)
 
-    ants_script_path = os.path.join("$ANTSPATH", "antsMultivariateTemplateConstruction2.sh")
+    if args.incremental:
+        # the current templates are the initial templates of Stage 2
+        print("[INFO] Incremental update of the final templates, no Stage 1")
+        paths = [os.path.join(final_dir, f"sub-{args.subject}_{args.session}_desc-sharpen_{modality}.nii.gz")
+                 for modality in args.modalities]
+        missing = [p for p in paths if not os.path.exists(p)]
+        if missing and not dry_run:
+            print(f"[ERROR] --incremental needs the templates of a previous run, missing: {' '.join(missing)}")
+            sys.exit(1)
+    else:
+        # Stage 1: low-resolution template building
+        print(f"[INFO] Starting Stage 1: Low-resolution template construction")
 
-    run_command([
-        f"{ants_script_path} "
-        f"-d 3 -i {args.ite1} -k {modalities_count} -c 2 -j {args.jobs} "
-        f"-f 4x2x1 -s 2x1x0vox -q {args.q1} "
-        f"-w {args.w1} -t SyN -A 1 -n 0 -m {LR_reg_metrics} "
-        f"-o {tmp_LR}/MY {args.input_list_LR}"
-    ], dry_run, workdir='./', shell=True)
+        # Load CSV and determine modalities count for stage 1
+        df = pd.read_csv(args.input_list_LR)
+        modalities = list(df.columns)
+        modalities_count = len(modalities)
+        print(f"[INFO] Detected {modalities_count} modalities: {modalities}")
 
-    print(f"[INFO] Resampling Stage 1 outputs to higher resolution at {res_HR} ")
-    for i in range(modalities_count):
-        in_file = os.path.join(tmp_LR, "intermediateTemplates", f"SyN_iteration{args.ite1 - 1}_MYtemplate{i}.nii.gz")
-        out_file = os.path.join(tmp_HR, f"{args.subject}_{args.session}_SyN_iteration{args.ite1 - 1}_MYtemplate{i}.nii.gz")
+        input_list_LR = args.input_list_LR
+        priors_LR = args.LR_priors or []
+        if args.LR_voxel_size:
+            print(f"[INFO] Downsampling Stage 1 inputs to {args.LR_voxel_size} mm")
+            pyramid = LRPyramid(os.path.join(tmp_LR, "inputs"), args.LR_voxel_size)
+            input_list_LR = pyramid.rewrite_list(args.input_list_LR, os.path.join(tmp_LR, "input_list_LR.csv"),
+                                                 args.jobs, dry_run)
+            priors_LR = pyramid.get_all(priors_LR, args.jobs, dry_run)
+        z_opts_LR = "".join(f"-z {p} " for p in priors_LR)
 
         run_command([
-            "mri_convert", "-i",
-            f"{in_file}",
-            "-o",
-            f"{out_file}",
-            "-vs", f"{res_HR}", f"{res_HR}", f"{res_HR}"
-        ], dry_run)
+            f"{ants_script_path} "
+            f"-d 3 -i {args.ite1} -k {modalities_count} -c {args.control} -j {args.jobs} "
+            f"-f 4x2x1 -s 2x1x0vox -q {args.q1} "
+            f"-w {args.w1} -t SyN {z_opts_LR}-A 1 -n 0 -m {LR_reg_metrics} "
+            f"{warm_start_options(args, args.warm_q1)}"
+            f"-o {tmp_LR}/MY {input_list_LR}"
+        ], dry_run, env=convergence_env(args, ants_env, convergence_LR), workdir='./', shell=True,
+            subject=args.subject, session=args.session, step="stage1_LR")
+        ite1_last = last_iteration(args, args.ite1, convergence_LR)
+
+        print(f"[INFO] Resampling Stage 1 outputs to higher resolution at {res_HR} ")
+        for i in range(modalities_count):
+            in_file = os.path.join(tmp_LR, "intermediateTemplates", f"SyN_iteration{ite1_last}_MYtemplate{i}.nii.gz")
+            out_file = os.path.join(tmp_HR, f"{args.subject}_{args.session}_SyN_iteration{ite1_last}_MYtemplate{i}.nii.gz")
+
+            run_command([
+                "mri_convert", "-i",
+                f"{in_file}",
+                "-o",
+                f"{out_file}",
+                "-vs", f"{res_HR}", f"{res_HR}", f"{res_HR}"
+            ], dry_run, subject=args.subject, session=args.session, step="resample_LR_to_HR")
 
     # Stage 2: high-resolution template building using resampled priors
 
@@ -95,23 +288,53 @@ def main():
 
     print(f"[INFO] Detected {modalities_count} modalities: {modalities}")
 
+    rows = read_inputs(args.input_list_HR)
+    initial_prefix = None
+    warm_q2 = args.warm_q2
+    if args.incremental:
+        # transforms of the previous run (matched by image name), kept in tmp_HR/previous as the
+        # first iteration removes them from tmp_HR; new inputs have none and start from scratch.
+        # tmp_HR/previous is removed once Stage 2 completes: if it is there, an update was
+        # interrupted and tmp_HR holds its partial transforms
+        previous = os.path.join(tmp_HR, "previous")
+        src_prefix = os.path.join(previous, "MY") if os.path.isdir(previous) else f"{tmp_HR}/MY"
+        initial_prefix, n_cached = link_transforms(src_prefix, modalities_count, rows, modalities_count,
+                                                   previous, by_name=True, dry_run=dry_run)
+        print(f"[INFO] {n_cached} of {len(rows)} inputs start from their previous transforms, {len(rows) - n_cached} new")
+        if warm_q2 is None:
+            # already registered inputs: finest level only
+            levels = args.q2.split("x")
+            warm_q2 = "x".join(["0"] * (len(levels) - 1) + levels[-1:])
+    elif args.warm_start:
+        # Stage 1 transforms of each input (matched by row), to warm-start the first Stage 2 iteration
+        rows_LR = read_inputs(args.input_list_LR)
+        if len(rows_LR) == len(rows):
+            initial_prefix, _ = link_transforms(f"{tmp_LR}/MY", len(rows_LR[0]), rows, modalities_count,
+                                                os.path.join(tmp_HR, "initial"), dry_run=dry_run)
+        else:
+            print(f"[WARN] {len(rows)} Stage 2 inputs for {len(rows_LR)} in Stage 1: Stage 2 starts without the Stage 1 transforms")
+
     print("[INFO] Starting Stage 2: High-resolution template construction")
-    paths = [
-        os.path.join(
-            tmp_HR,
-            f"{args.subject}_{args.session}_SyN_iteration{args.ite1 - 1}_MYtemplate{i}.nii.gz"
-        )
-        for i in range(modalities_count)
-    ]
+    if not args.incremental:
+        paths = [
+            os.path.join(
+                tmp_HR,
+                f"{args.subject}_{args.session}_SyN_iteration{ite1_last}_MYtemplate{i}.nii.gz"
+            )
+            for i in range(modalities_count)
+        ]
 
     z_opts = " ".join([f"-z {p}" for p in paths])
     run_command([
         f"{ants_script_path} "
-        f"-d 3 -i {args.ite2} -k {modalities_count} -c 2 -j {args.jobs} "
+        f"-d 3 -i {args.ite2} -k {modalities_count} -c {args.control} -j {args.jobs} "
         f"-f 4x2x1 -s 2x1x0vox -q {args.q2} "
         f"-t SyN -w {args.w2} {z_opts} -A 1 -n 0 -m {HR_reg_metrics} "
+        f"{warm_start_options(args, warm_q2, initial_prefix)}"
         f"-o {tmp_HR}/MY {args.input_list_HR}"
-    ], dry_run , workdir='./', shell=True)
+    ], dry_run , env=convergence_env(args, ants_env, convergence_HR), workdir='./', shell=True,
+        subject=args.subject, session=args.session, step="stage2_HR")
+    ite2_last = last_iteration(args, args.ite2, convergence_HR)
 
     # Copy final outputs with BIDS-style names
     print("[INFO] Copying final templates to BIDS-style outputs")
@@ -123,12 +346,16 @@ def main():
         desc = f"desc-sharpen_{modality}"
 
         dst_name = f"sub-{args.subject}_{args.session}_{desc}.nii.gz"
-        src = os.path.join(tmp_HR, "intermediateTemplates", f"SyN_iteration{args.ite2 - 1}_MYtemplate{i}.nii.gz")
+        src = os.path.join(tmp_HR, "intermediateTemplates", f"SyN_iteration{ite2_last}_MYtemplate{i}.nii.gz")
         dst = os.path.join(final_dir, dst_name)
         run_command([f"cp -f {src} {dst}"], dry_run , workdir='./', shell=True)
         print(f"{dst}")
         i += 1
 
+    # the transforms in tmp_HR are now the ones of the final templates
+    if not dry_run:
+        shutil.rmtree(os.path.join(tmp_HR, "previous"), ignore_errors=True)
+
     print(f"[INFO] Template construction complete! Results in {final_dir}")
 
 if __name__ == "__main__":
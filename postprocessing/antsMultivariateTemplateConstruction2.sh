@@ -17,6 +17,12 @@ SGE=waitForSGEQJobs.pl
 PBS=waitForPBSQJobs.pl
 XGRID=waitForXGridJobs.pl
 SLURM=waitForSlurmJobs.pl
+# local scheduler of -c 6 (BABACOOL utils/template_jobs.py), with its options (split on spaces,
+# IFS does not split words on them here)
+IFS=' ' read -r -a LOCALSCHED <<< "${ANTS_TEMPLATE_SCHEDULER:-python3 -m utils.template_jobs}"
+# optional convergence check run after each iteration (BABACOOL utils/template_convergence.py):
+# exit status 0 stops the iterations
+IFS=' ' read -r -a CONVERGENCE <<< "${ANTS_TEMPLATE_CONVERGENCE:-}"
 
 fle_error=0
 for FLE in $ANTS $WARP $N4 $PEXEC $SGE $XGRID $PBS $SLURM
@@ -87,6 +93,9 @@ Optional arguments:
           3 = Apple XGrid
           4 = PBS qsub
           5 = SLURM
+          6 = use the Python local scheduler ($ANTS_TEMPLATE_SCHEDULER, default
+              "python3 -m utils.template_jobs"): memory-aware, per-job ITK threads,
+              timeouts and retries (localhost)
 
      -e   use single precision ( default 1 )
 
@@ -95,9 +104,13 @@ Optional arguments:
           0.25 is an upper (aggressive) limit for this parameter.
 
      -i:  Iteration limit (default 4): iterations of the template construction
-          (Iteration limit)*NumImages registrations.
+          (Iteration limit)*NumImages registrations. If $ANTS_TEMPLATE_CONVERGENCE is set, this
+          command is run after each iteration with the arguments "--iteration <k> --transformation <T>
+          --prefix <OutputPrefix basename> --modalities <n> <intermediateTemplates directory>", and
+          the iterations stop early when it exits with status 0 (e.g. "python3 -m
+          utils.template_convergence --tol 0.01 --json convergence.json").
 
-     -j:  Number of cpu cores to use locally for pexec option (default 2; requires "-c 2")
+     -j:  Number of cpu cores to use locally for pexec option (default 2; requires "-c 2" or "-c 6")
 
      -k:  Number of modalities used to construct the template (default 1):  For example,
           if one wanted to create a multimodal template consisting of T1,T2,and FA
@@ -126,6 +139,22 @@ Optional arguments:
           of components as the number of iterations and shrink factors. The kernel may be specified in
           mm units or voxels with "AxBxCmm" or "AxBxCvox". Missing units implies vox.
 
+     -W:  Warm-start the deformable registrations of the iterations after the first one: 0 == off,
+          1 == on (default 0). Each input starts from its affine and warp of the previous iteration,
+          carried through the template shape update, and is refined by the "-t" stage only (no
+          linear stages, no center of mass initialization). The affine is kept, so the averaged
+          affine still centers the template.
+
+     -I:  Transforms of the first iteration's warm start (implies "-W 1"), given as the OutputPrefix
+          of a previous run (e.g. tmp_LR/MY): its {prefix}input####-*-0GenericAffine.mat,
+          {prefix}input####-*-1Warp.nii.gz and {prefix}template0GenericAffine.mat / 0warp.nii.gz
+          are matched to the inputs by their index (same input order), so the run may use images
+          of another resolution. An input without transforms starts from scratch. The initial
+          template ("-z") should be the final template of that run, e.g. resampled.
+
+     -Q:  Max iterations of the warm-started registrations (default = "-q"), in the same form as
+          "-q" with the same number of levels, e.g. "0x0x70x20" skips the coarse levels.
+
      -n:  N4BiasFieldCorrection of moving image: 0 == off, 1 == on (default 1).
 
      -o:  OutputPrefix; A prefix that is prepended to all output files (default = "antsBTP").
@@ -276,6 +305,8 @@ function reportMappingParameters {
  Gradient step:            $GRADIENTSTEP
  Transformation:           $TRANSFORMATIONTYPE
  Max iterations:           $MAXITERATIONS
+ Warm start:               $WARMSTART ${WARMSTARTPREFIX}
+ Warm-start iterations:    $WARMITERATIONS
  Smoothing factors:        $SMOOTHINGFACTORS
  Shrink factors:           $SHRINKFACTORS
  Output prefix:            $OUTPUTNAME
@@ -575,6 +606,9 @@ QSUBOPTS="" # EDIT THIS
 OUTPUTNAME=antsBTP
 TEMPLATENAME=${OUTPUTNAME}template
 AFFINE_UPDATE_FULL=1
+WARMSTART=0
+WARMSTARTPREFIX=""
+WARMITERATIONS=""
 
 ##Getting system info from linux can be done with these variables.
 # RAM=`cat /proc/meminfo | sed -n -e '/MemTotal/p' | awk '{ printf "%s %s\n", $2, $3 ; }' | cut -d " " -f 1`
@@ -595,7 +629,7 @@ if [[ $# -eq 0 || "$1" == "-h" ]];
   fi
 
 # reading command line arguments
-while getopts "A:a:b:c:d:e:f:g:h:i:j:k:l:m:n:o:p:q:s:r:t:u:v:w:x:y:z:" OPT
+while getopts "A:a:b:c:d:e:f:g:h:I:i:j:k:l:m:n:o:p:Q:q:s:r:t:u:v:W:w:x:y:z:" OPT
   do
   case $OPT in
       h) #help
@@ -616,9 +650,9 @@ while getopts "A:a:b:c:d:e:f:g:h:i:j:k:l:m:n:o:p:q:s:r:t:u:v:w:x:y:z:" OPT
    ;;
       c) #use SGE cluster
    DOQSUB=$OPTARG
-   if [[ $DOQSUB -gt 5 ]];
+   if [[ $DOQSUB -gt 6 ]];
      then
-       echo " DOQSUB must be an integer value (0=serial, 1=SGE qsub, 2=try pexec, 3=XGrid, 4=PBS qsub, 5=SLURM) you passed  -c $DOQSUB "
+       echo " DOQSUB must be an integer value (0=serial, 1=SGE qsub, 2=try pexec, 3=XGrid, 4=PBS qsub, 5=SLURM, 6=local scheduler) you passed  -c $DOQSUB "
        exit 1
      fi
    ;;
@@ -650,6 +684,16 @@ while getopts "A:a:b:c:d:e:f:g:h:i:j:k:l:m:n:o:p:q:s:r:t:u:v:w:x:y:z:" OPT
    ;;
       q) #max iterations other than default
    MAXITERATIONS=$OPTARG
+   ;;
+      Q) #max iterations of the warm-started registrations
+   WARMITERATIONS=$OPTARG
+   ;;
+      W) #warm-start from the transforms of the previous iteration
+   WARMSTART=$OPTARG
+   ;;
+      I) #transforms of the first iteration's warm start
+   WARMSTARTPREFIX=$OPTARG
+   WARMSTART=1
    ;;
       f) #shrink factors
    SHRINKFACTORS=$OPTARG
@@ -1204,7 +1248,7 @@ if [[ "$RIGID" -eq 1 ]];
             id=`qsub -N antsrigid -v  $QSUBOPTS -q nopreempt -l nodes=1:ppn=1 -l mem=${MEMORY} -l walltime=${WALLTIME} $qscript | awk '{print $1}'`
             jobIDs="$jobIDs $id"
             sleep 0.5
-        elif [[ $DOQSUB -eq 2 ]];
+        elif [[ $DOQSUB -eq 2 || $DOQSUB -eq 6 ]];
           then
             # Send pexe and exe2 to same job file so that they execute in series
             echo $pexe >> ${outdir}/job${count}_r.sh
@@ -1271,6 +1315,19 @@ if [[ "$RIGID" -eq 1 ]];
         chmod +x ${outdir}/job*_r.sh
         $PEXEC -j ${CORES} "sh" ${outdir}/job*_r.sh
       fi
+    if [[ $DOQSUB -eq 6 ]];
+      then
+        echo
+        echo "--------------------------------------------------------------------------------------"
+        echo " Starting ANTS rigid registration with the local scheduler on max ${CORES} cpucores. "
+        echo " Progress can be viewed in ${outdir}/job*_metriclog.txt and ${outdir}/jobs_status.json"
+        echo "--------------------------------------------------------------------------------------"
+        if ! "${LOCALSCHED[@]}" -j ${CORES} --status ${outdir}/jobs_status.json ${outdir}/job*_r.sh;
+          then
+            echo "local scheduler: jobs failed"
+            exit 1;
+          fi
+      fi
     if [[ $DOQSUB -eq 3 ]];
       then
         # Run jobs on XGrid and wait to finish
@@ -1345,7 +1402,7 @@ if [[ "$RIGID" -eq 1 ]];
         elif [[ $DOQSUB -eq 4 ]];
           then
             mv ${outdir}/antsrigid* ${outdir}/job* ${outdir}/rigid/
-        elif [[ $DOQSUB -eq 2 ]];
+        elif [[ $DOQSUB -eq 2 || $DOQSUB -eq 6 ]];
           then
             mv ${outdir}/job*.txt ${outdir}/rigid/
         elif [[ $DOQSUB -eq 3 ]];
@@ -1391,6 +1448,18 @@ if [[ $NUMLEVELS -ne $NUMSMOOTH ]]
     exit 1
   fi
 
+if [[ -z "$WARMITERATIONS" ]]
+  then
+    WARMITERATIONS=$MAXITERATIONS
+  fi
+
+WARMLEVEL=( $(echo $WARMITERATIONS | tr 'x' '\n') )
+if [[ ${#WARMLEVEL[@]} -ne $NUMLEVELS ]]
+  then
+    echo "Number of warm-start iteration levels in [ $WARMITERATIONS ] does not match number of iteration levels in [ $MAXITERATIONS ]"
+    exit 1
+  fi
+
 #
 # debugging only
 #echo $ITERATLEVEL
@@ -1410,6 +1479,28 @@ i=0
 while [[ $i -lt ${ITERATIONLIMIT} ]];
   do
     itdisplay=$((i+1))
+    # Warm start: keep the transforms of the previous iteration (and the template shape update
+    # applied after it) before they are removed, or use the ones of a previous run (-I)
+    WARMSOURCE=""
+    if [[ $WARMSTART -eq 1 && $NOWARP -eq 0 ]];
+      then
+        if [[ $i -gt 0 ]];
+          then
+            mkdir -p ${outdir}/warmstart
+            rm -f ${outdir}/warmstart/*
+            mv ${OUTPUTNAME}input*-0GenericAffine.mat ${OUTPUTNAME}input*-1Warp.nii.gz ${outdir}/warmstart/
+            cp -f ${TEMPLATENAME}0GenericAffine.mat ${outdir}/warmstart/
+            if [[ -f "${TEMPLATENAME}0warp.nii.gz" ]];
+              then
+                cp -f ${TEMPLATENAME}0warp.nii.gz ${outdir}/warmstart/
+              fi
+            WARMSOURCE=${outdir}/warmstart/`basename ${OUTPUTNAME}`
+        elif [[ -n "${WARMSTARTPREFIX}" ]];
+          then
+            mkdir -p ${outdir}/warmstart
+            WARMSOURCE=${WARMSTARTPREFIX}
+          fi
+      fi
     rm -f ${OUTPUTNAME}*WarpedToTemplate.nii.gz
     rm -f ${OUTPUTNAME}*Warp.nii*
     rm -f ${OUTPUTNAME}*warp.nii*
@@ -1544,7 +1635,38 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
         exebase=$exe
         pexebase=$pexe
 
-        if [[ $DOLINEAR -eq 0 ]];
+        # Warm start from the previous affine A and warp W of this input (to the previous template,
+        # x -> W -> A). The template has since been warped by the shape update U (-t [ U,1 ] -t u x4),
+        # so the input starts from A U^-1 and U W u u u u U^-1 (a single field on the new template grid)
+        # and the "-t" stage refines the field: collapsed, the output is still 0GenericAffine.mat + 1Warp.nii.gz
+        WARMAFFINE=""
+        WARMWARP=""
+        if [[ -n "${WARMSOURCE}" ]];
+          then
+            WARMAFFINE=`ls ${WARMSOURCE}input$(printf "%04d" $j)-*0GenericAffine.mat 2> /dev/null | head -n 1 || true`
+            WARMWARP=`ls ${WARMSOURCE}input$(printf "%04d" $j)-*1Warp.nii.gz 2> /dev/null | head -n 1 || true`
+          fi
+        if [[ -n "${WARMAFFINE}" && -n "${WARMWARP}" ]];
+          then
+            WARMUPDATE=""
+            WARMUPDATEINV=""
+            if [[ -f "${WARMSOURCE}template0GenericAffine.mat" ]];
+              then
+                WARMUPDATE="-t ${WARMSOURCE}template0GenericAffine.mat"
+                WARMUPDATEINV="-t [ ${WARMSOURCE}template0GenericAffine.mat,1 ]"
+              fi
+            WARMUPDATEWARP=""
+            if [[ -f "${WARMSOURCE}template0warp.nii.gz" ]];
+              then
+                WARMUPDATEWARP="-t ${WARMSOURCE}template0warp.nii.gz -t ${WARMSOURCE}template0warp.nii.gz -t ${WARMSOURCE}template0warp.nii.gz -t ${WARMSOURCE}template0warp.nii.gz"
+              fi
+            WARMFN=${outdir}/warmstart/${OUTWARPFN}init
+            warminit="${WARP} -d ${DIM} --float $USEFLOAT --verbose 1 -o Linear[ ${WARMFN}Affine.mat ] ${WARMUPDATEINV} -t ${WARMAFFINE} -r ${TEMPLATES[0]}"
+            warminitwarp="${WARP} -d ${DIM} --float $USEFLOAT --verbose 1 -o [ ${WARMFN}Warp.nii.gz,1 ] ${WARMUPDATEINV} ${WARMUPDATEWARP} -t ${WARMWARP} ${WARMUPDATE} -r ${TEMPLATES[0]}"
+            stagewarm="-r ${WARMFN}Warp.nii.gz -r ${WARMFN}Affine.mat -t ${TRANSFORMATION} ${IMAGEMETRICSET} -c [ ${WARMITERATIONS},1e-9,10 ] -f ${SHRINKFACTORS} -s ${SMOOTHINGFACTORS} -o ${outdir}/${OUTWARPFN}"
+            exe="$exe ${warminit}\n ${warminitwarp}\n ${basecall} ${stagewarm}\n"
+            pexe="$pexe ${warminit} >> ${outdir}/job_${count}_metriclog.txt\n ${warminitwarp} >> ${outdir}/job_${count}_metriclog.txt\n ${basecall} ${stagewarm} >> ${outdir}/job_${count}_metriclog.txt\n"
+        elif [[ $DOLINEAR -eq 0 ]];
           then
             exe="$exe ${basecall} ${stageId} ${stage3}\n"
             pexe="$pexe ${basecall} ${stageId} ${stage3} >> ${outdir}/job_${count}_metriclog.txt\n"
@@ -1571,7 +1693,7 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
         qscript="${outdir}/job_${count}_${i}.sh"
 
         echo -e $exe >> ${outdir}/job_${count}_${i}_metriclog.txt
-        # 6 submit to SGE (DOQSUB=1), PBS (DOQSUB=4), PEXEC (DOQSUB=2), XGrid (DOQSUB=3), SLURM (DOQSUB=5) or else run locally (DOQSUB=0)
+        # 6 submit to SGE (DOQSUB=1), PBS (DOQSUB=4), PEXEC or local scheduler (DOQSUB=2/6), XGrid (DOQSUB=3), SLURM (DOQSUB=5) or else run locally (DOQSUB=0)
         if [[ $DOQSUB -eq 1 ]];
           then
             echo "$SCRIPTPREPEND" > $qscript
@@ -1586,7 +1708,7 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
             id=`qsub -N antsdef${i} -v  -q nopreempt -l nodes=1:ppn=1 -l mem=${MEMORY} -l walltime=${WALLTIME} $QSUBOPTS $qscript | awk '{print $1}'`
             jobIDs="$jobIDs $id"
             sleep 0.5
-        elif [[ $DOQSUB -eq 2 ]];
+        elif [[ $DOQSUB -eq 2 || $DOQSUB -eq 6 ]];
           then
             echo -e $pexe >> ${outdir}/job${count}_r.sh
         elif [[ $DOQSUB -eq 3 ]];
@@ -1654,6 +1776,20 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
         $PEXEC -j ${CORES} sh ${outdir}/job*.sh
       fi
 
+    if [[ $DOQSUB -eq 6 ]];
+      then
+        echo
+        echo "--------------------------------------------------------------------------------------"
+        echo " Starting ANTS registration with the local scheduler on max ${CORES} cpucores. Iteration: $itdisplay of $ITERATIONLIMIT"
+        echo " Progress can be viewed in job*_${i}_metriclog.txt and ${outdir}/jobs_status.json"
+        echo "--------------------------------------------------------------------------------------"
+        if ! "${LOCALSCHED[@]}" -j ${CORES} --status ${outdir}/jobs_status.json ${outdir}/job*.sh;
+          then
+            echo "local scheduler: jobs failed"
+            exit 1;
+          fi
+      fi
+
     if [[ $DOQSUB -eq 3 ]];
       then
         # Run jobs on XGrid and wait to finish
@@ -1727,6 +1863,15 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
         cp ${TEMPLATENAME}0warp.nii.gz ${intermediateTemplateDir}/${TRANSFORMATIONTYPE}_iteration${i}_shapeUpdateWarp.nii.gz
       fi
 
+    CONVERGED=0
+    if [[ ${#CONVERGENCE[@]} -gt 0 ]];
+      then
+        if "${CONVERGENCE[@]}" --iteration ${i} --transformation ${TRANSFORMATIONTYPE} --prefix `basename ${OUTPUTNAME}` --modalities ${NUMBEROFMODALITIES} ${intermediateTemplateDir};
+          then
+            CONVERGED=1
+          fi
+      fi
+
     if [[ $BACKUPEACHITERATION -eq 1 ]];
       then
         echo
@@ -1742,7 +1887,7 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
         elif [[ $DOQSUB -eq 4 ]];
             then
             mv ${outdir}/antsdef* ${outdir}/ANTs_iteration_${i}
-        elif [[ $DOQSUB -eq 2 ]];
+        elif [[ $DOQSUB -eq 2 || $DOQSUB -eq 6 ]];
             then
             mv ${outdir}/job*.txt ${outdir}/ANTs_iteration_${i}
         elif [[ $DOQSUB -eq 3 ]];
@@ -1758,11 +1903,17 @@ while [[ $i -lt ${ITERATIONLIMIT} ]];
     fi
     echo "Iteration $itdisplay completed"
     i=$(( i + 1 ))
+    if [[ $CONVERGED -eq 1 ]];
+      then
+        echo "Template converged after iteration $itdisplay of $ITERATIONLIMIT: stopping"
+        break
+      fi
 done
 
 # end main loop
 
 rm -f job*.sh
+rm -rf ${outdir}/warmstart
 #cleanup of 4D files
 if [[ "${range}" -gt 1 && "${TDIM}" -eq 4 ]];
   then
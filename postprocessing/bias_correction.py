@@ -1,6 +1,10 @@
 import argparse
-import subprocess
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, trace_tags
+from utils.bias_field import t1xt2_bias_correction
 
 def build_template_image(bids_root, template_name, template_session, template_folder, reference_suffix):
     return os.path.join(
@@ -27,6 +31,10 @@ def main():
                         help="Will keep temporary files (adds the -k flag).")
     parser.add_argument("--s_value", type=int, default=2,
                         help="size of gauss kernel in mm when performing mean filtering (default=2).")
+    parser.add_argument("--engine", choices=["fsl", "numpy"], default="fsl",
+                        help="fsl: T1xT2BiasFieldCorrection.sh (default), numpy: in-memory bias field.")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads for the Gaussian filtering of the numpy engine (default: 4).")
 
     parser.add_argument(
         '--dry-run', action="store_true",
@@ -34,6 +42,8 @@ def main():
     )
 
     args = parser.parse_args()
+    if args.k and args.engine == "numpy":
+        parser.error("--k keeps the temporary files of T1xT2BiasFieldCorrection.sh: the numpy engine writes none, use --engine fsl")
     dry_run = args.dry_run
 
     for ses in args.sessions:
@@ -53,33 +63,41 @@ def main():
             print(f"Skipping session {ses}.")
             continue
 
-        cmd = [
-            "postprocessing/T1xT2BiasFieldCorrection.sh",
-            "-t1", t1,
-            "-t2", t2,
-            "-s", str(args.s_value),
-            "-os", "_debiased"
-        ]
-
+        brain_mask = None
         if args.brain_mask_suffix:
             #brain_mask = f"{path_template}/sub-{args.template_name}_{ses}_{args.brain_mask_suffix}.nii.gz"
             #brain_mask = f"{args.brain_mask_suffix}.nii.gz"
             brain_mask = build_template_image(args.bids_root, args.template_name, ses,
                                                          args.template_folder, f"{args.brain_mask_suffix}.nii.gz")
 
-            if os.path.exists(brain_mask):
-                cmd.extend(["-b", brain_mask])
-            else:
+            if not os.path.exists(brain_mask):
                 print(f"Warning: Brain mask file not found for session {ses}: {brain_mask}")
                 print("Skipping -b option for this session.")
+                brain_mask = None
+
+        if args.engine == "numpy":
+            print(f"\nBias correction for {ses} (numpy engine):")
+            with trace_tags(session=ses, step="bias_correction"):
+                t1xt2_bias_correction(t1, t2, args.s_value, brain_mask, "_debiased",
+                                      threads=args.threads, dry_run=dry_run)
+            continue
+
+        cmd = [
+            "postprocessing/T1xT2BiasFieldCorrection.sh",
+            "-t1", t1,
+            "-t2", t2,
+            "-s", str(args.s_value),
+            "-os", "_debiased"
+        ]
+
+        if brain_mask:
+            cmd.extend(["-b", brain_mask])
 
         if args.k:
             cmd.append("-k")
 
-        print(f"\nRunning command for {ses}:\n{' '.join(cmd)}\n")
-
-        if not dry_run:
-            subprocess.run(cmd, check=True)
+        print(f"\nRunning command for {ses}:")
+        run_command(cmd, dry_run, session=ses, step="bias_correction")
 
 if __name__ == "__main__":
     main()
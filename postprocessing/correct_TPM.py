@@ -1,13 +1,17 @@
 import os
+import sys
 import argparse
-import subprocess
 import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
 
-def run_command(cmd, dry_run=False, env=None):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True, env=env)
-
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, trace_tags
+from utils.tpm_labels import threshold_label
 
 def write_tpm_json(mask_files_thr, mask_files, threshold, thr_str, dry_run=False):
     """
@@ -41,16 +45,221 @@ def write_tpm_json(mask_files_thr, mask_files, threshold, thr_str, dry_run=False
                 json.dump(json_content, f, indent=4)
             print(f"JSON file written: {json_path}")
 
+def tpm_paths(bids_root, template_name, template_folder, ses, TPM_suffix, thr_str):
+    """Input and output filenames of the TPM correction for one session."""
+    template_path = os.path.join(
+        bids_root, "derivatives", "template",
+        f"sub-{template_name}", ses, template_folder)
+    prefix = os.path.join(template_path, f"sub-{template_name}_{ses}")
+
+    return {
+        "input": {t: f"{prefix}_label-{t}_{TPM_suffix}.nii.gz" for t in ["CSF", "WM", "GM"]},
+        "sum": f"{prefix}_label-BM_{TPM_suffix}.nii.gz",
+        "thr": {t: f"{prefix}_label-{t}_desc-{thr_str}_probseg.nii.gz" for t in ["CSF", "WM", "GM"]},
+        "corr": {t: f"{prefix}_label-{t}_desc-corr_probseg.nii.gz" for t in ["CSF", "WM", "GM"]},
+        "bm": f"{prefix}_label-BM_desc-{thr_str}_mask.nii.gz",
+        "pad": {t: f"{prefix}_label-{t}_desc-{thr_str}_padded_probseg.nii.gz" for t in ["CSF", "WM", "GM"]},
+        "bm_pad": f"{prefix}_label-BM_desc-{thr_str}_padded_mask.nii.gz"
+    }
+
+# =====================
+# FSL engine
+# =====================
+
+def correct_session_fsl(paths, threshold, pad, pad_size, dry_run=False):
+    """Original fslmaths / ImageMath command sequence."""
+    mask_files = paths["input"]
+    mask_files_thr = paths["thr"]
+    mask_files_corrected = paths["corr"]
+
+    cmd = ["fslmaths", f"{mask_files['CSF']}", "-add", f"{mask_files['GM']}", "-add",
+           f"{mask_files['WM']}", f"{paths['sum']}"]
+    run_command(cmd, dry_run)
+
+    print(f"threshold TPM ")
+    for tissue in ["GM", "CSF", "WM"]:
+        cmd = ["fslmaths", f"{mask_files[tissue]}", "-thr", f"{threshold}", f"{mask_files_thr[tissue]}"]
+        run_command(cmd, dry_run)
+
+    print(f"compute corrected brainmask")
+
+    print(f"generate WM TPM from BM,GM,CSG where WM+CSF+GM=1 in BM ")
+    cmd = ["fslmaths", f"{mask_files_thr['CSF']}", "-add",  f"{mask_files_thr['GM']}", "-add",  f"{mask_files_thr['WM']}", "-fillh26", "-bin" , f"{paths['bm']}"]
+    run_command(cmd, dry_run)
+
+    cmd = ["fslmaths", f"{paths['bm']}", "-sub", f"{mask_files_thr['GM']}", "-sub", f"{mask_files_thr['CSF']}", f"{mask_files_thr['WM']}"]
+    run_command(cmd, dry_run)
+    for tissue in ["WM", "GM", "CSF"]:
+        cmd = ["fslmaths", f"{mask_files[tissue]}", "-mul", f"{paths['bm']}", f"{mask_files_corrected[tissue]}"]
+        run_command(cmd, dry_run)
+
+    print(f"threshold TPM ")
+    for tissue in ["GM", "CSF", "WM"]:
+        cmd = ["fslmaths", f"{mask_files_corrected[tissue]}", "-thr", f"{threshold}", f"{mask_files_thr[tissue]}"]
+        run_command(cmd, dry_run)
+
+    if pad:
+        for tissue in ["WM", "GM", "CSF"]:
+            cmd = ["ImageMath", "3", f"{paths['pad'][tissue]}", "PadImage", f"{mask_files_thr[tissue]}", f"{pad_size}"]
+            run_command(cmd, dry_run)
+        cmd = ["ImageMath", "3", f"{paths['bm_pad']}", "PadImage", f"{paths['bm']}", f"{pad_size}"]
+        run_command(cmd, dry_run)
+
+# =====================
+# NumPy engine
+# =====================
+
+def fsl_threshold(data, threshold):
+    """fslmaths -thr: zero everything below the threshold (compared in float32)."""
+    return np.where(data >= np.float32(threshold), data, np.float32(0))
+
+def save_like(data, ref_img, path, dtype=None, affine=None):
+    """Save data with the header of ref_img, as fslmaths does (output type of the first input)."""
+    img = nib.Nifti1Image(data, ref_img.affine if affine is None else affine, ref_img.header)
+    img.set_data_dtype(dtype or ref_img.get_data_dtype())
+    nib.save(img, path)
+
+def pad_image(data, affine, pad_size):
+    """ImageMath PadImage: zero-pad each border, shifting the origin to keep the physical position."""
+    padded = np.pad(data, pad_size, mode="constant")
+    padded_affine = affine.copy()
+    padded_affine[:3, 3] = (affine @ np.array([-pad_size, -pad_size, -pad_size, 1]))[:3]
+    return padded, padded_affine
+
+def correct_session_numpy(paths, threshold, pad, pad_size, dry_run=False):
+    """
+    Same operations as correct_session_fsl, computed in float32 in memory (as fslmaths does)
+    so that the written volumes are voxel-identical.
+    """
+    if dry_run:
+        print(f"[DRY RUN] numpy TPM correction, outputs: {paths['sum']}, {paths['bm']}, "
+              f"{', '.join(paths['corr'].values())}, {', '.join(paths['thr'].values())}")
+        if pad:
+            print(f"[DRY RUN] padded outputs: {', '.join(paths['pad'].values())}, {paths['bm_pad']}")
+        return
+
+    imgs = {t: nib.load(p) for t, p in paths["input"].items()}
+    tpm = {t: img.get_fdata(dtype=np.float32) for t, img in imgs.items()}
+    ref = imgs["CSF"]
+
+    save_like((tpm["CSF"] + tpm["GM"]) + tpm["WM"], ref, paths["sum"])
+
+    thr = {t: fsl_threshold(tpm[t], threshold) for t in ["CSF", "GM", "WM"]}
+
+    # -fillh26 -bin: fill the background components not connected to the border (26-connectivity)
+    bm = (thr["CSF"] + thr["GM"]) + thr["WM"]
+    bm = ndimage.binary_fill_holes(bm > 0, structure=np.ones((3, 3, 3), dtype=bool)).astype(np.float32)
+    save_like(bm, ref, paths["bm"])
+    # the BM - GM - CSF WM map of the fslmaths sequence is overwritten by the thresholded
+    # corrected WM below, so it is not computed here
+
+    for tissue in ["WM", "GM", "CSF"]:
+        corrected = tpm[tissue] * bm
+        save_like(corrected, imgs[tissue], paths["corr"][tissue])
+        thr[tissue] = fsl_threshold(corrected, threshold)
+        save_like(thr[tissue], imgs[tissue], paths["thr"][tissue])
+
+    if pad:
+        for tissue in ["WM", "GM", "CSF"]:
+            padded, padded_affine = pad_image(thr[tissue], imgs[tissue].affine, pad_size)
+            save_like(padded, imgs[tissue], paths["pad"][tissue], np.float32, padded_affine)
+        padded, padded_affine = pad_image(bm, ref.affine, pad_size)
+        save_like(padded, ref, paths["bm_pad"], np.float32, padded_affine)
+
+# =====================
+# Engine comparison
+# =====================
+
+def synthetic_tpms(shape=(40, 44, 36), seed=0):
+    """
+    Smooth CSF/GM/WM probability maps summing to 1 in an ellipsoid brain, with an empty cavity
+    (filled by -fillh26) and voxels exactly at 0.2, on an oblique grid with anisotropic voxels.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.indices(shape, dtype=np.float32)
+    center = (np.array(shape, dtype=np.float32) - 1) / 2
+    radius = ((grid - center[:, None, None, None]) ** 2 /
+              (0.4 * np.array(shape, dtype=np.float32)[:, None, None, None]) ** 2).sum(axis=0)
+    brain = radius < 1
+    cavity = radius < 0.05
+
+    fields = np.stack([ndimage.gaussian_filter(rng.random(shape, dtype=np.float32), 2) for _ in range(3)])
+    fields = np.exp(12 * fields)
+    tpm = (fields / fields.sum(axis=0)).astype(np.float32) * (brain & ~cavity)
+    tpm[0][rng.random(shape) < 0.02] = np.float32(0.2)
+
+    affine = np.array([[0.5, 0.05, 0, -10.3], [0, 0.6, 0.02, -12.7], [0, -0.03, 0.7, -8.1], [0, 0, 0, 1]])
+    return {tissue: nib.Nifti1Image(tpm[i], affine) for i, tissue in enumerate(["CSF", "GM", "WM"])}
+
+def compare_engines(threshold, pad_size, tmpdir=None):
+    """
+    Run the fsl and numpy engines on the same synthetic TPMs and compare every output
+    (values and voxel to world affine). Returns True if all outputs are identical.
+    """
+    tmpdir = tmpdir or tempfile.mkdtemp(prefix="correct_TPM_engines_")
+    thr_str = threshold_label(threshold)
+    paths = {}
+    for engine, correct in [("fsl", correct_session_fsl), ("numpy", correct_session_numpy)]:
+        paths[engine] = tpm_paths(os.path.join(tmpdir, engine), "synthetic", "final", "ses-0",
+                                  "desc-average_probseg", thr_str)
+        os.makedirs(os.path.dirname(paths[engine]["sum"]), exist_ok=True)
+        for tissue, img in synthetic_tpms().items():
+            nib.save(img, paths[engine]["input"][tissue])
+        print(f"Correct synthetic TPM ({engine} engine)")
+        correct(paths[engine], threshold, True, pad_size)
+
+    outputs = ["sum", "bm", "bm_pad"] + [f"{key}:{t}" for key in ["corr", "thr", "pad"] for t in ["CSF", "GM", "WM"]]
+    identical = True
+    for output in outputs:
+        key, _, tissue = output.partition(":")
+        fsl_img, numpy_img = (nib.load(paths[e][key][tissue] if tissue else paths[e][key]) for e in ["fsl", "numpy"])
+        fsl_data, numpy_data = fsl_img.get_fdata(dtype=np.float32), numpy_img.get_fdata(dtype=np.float32)
+        if fsl_data.shape != numpy_data.shape:
+            print(f"[compare] {os.path.basename(numpy_img.get_filename())}: shape {numpy_data.shape} != {fsl_data.shape}")
+            identical = False
+            continue
+        n_diff = int(np.count_nonzero(fsl_data != numpy_data))
+        affine_diff = float(np.abs(fsl_img.affine - numpy_img.affine).max())
+        ok = n_diff == 0 and affine_diff < 1e-4
+        identical &= ok
+        print(f"[compare] {'OK  ' if ok else 'DIFF'} {os.path.basename(numpy_img.get_filename())}: "
+              f"{n_diff} voxel(s) differ (max {float(np.abs(fsl_data - numpy_data).max()):g}), "
+              f"affine max diff {affine_diff:g}")
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    return identical
+
+def correct_session(ses, args, thr_str):
+    """Correct the TPM of one session. Returns False if inputs are missing."""
+    paths = tpm_paths(args.bids_root, args.template_name, args.template_folder, ses, args.TPM_suffix, thr_str)
+
+    missing = [p for p in paths["input"].values() if not os.path.exists(p)]
+    if missing:
+        for mask_path in missing:
+            print(f"ERROR: mask not found: {mask_path}. Skipping session {ses}.")
+        return False
+
+    print(f"Correct TPM for {ses} ({args.engine} engine)")
+    with trace_tags(session=ses, step="correct_TPM"):
+        if args.engine == "fsl":
+            correct_session_fsl(paths, args.TPM_threshold, args.pad, args.pad_size, args.dry_run)
+        else:
+            correct_session_numpy(paths, args.TPM_threshold, args.pad, args.pad_size, args.dry_run)
+
+    write_tpm_json(paths["thr"], paths["input"], args.TPM_threshold, thr_str, dry_run=args.dry_run)
+    print(f"done {ses}")
+    return True
+
 def main():
     parser = argparse.ArgumentParser(description="Correct TPM BM=(CSF+GM+WM)=1 and  for selected sessions.")
-    parser.add_argument("--bids_root", required=True,
+    parser.add_argument("--bids_root",
                         help="Path to the root of the BIDS dataset.")
-    parser.add_argument("--sessions", nargs="+", required=True,
+    parser.add_argument("--sessions", nargs="+",
                         help="List of session identifiers (e.g., ses-0 ses-1 ses-2 ses-3).")
     parser.add_argument("--template_name", default="BaBa21",
                         help="Template name (default: BaBa21).")
-    parser.add_argument("--TPM_suffix",
-                        help="Suffix for TPM mask files (if not set, equals desc-average_probseg).")
+    parser.add_argument("--TPM_suffix", default="desc-average_probseg",
+                        help="Suffix for TPM mask files (default: desc-average_probseg).")
     parser.add_argument("--template_folder", default="final",
                         help="Folder under template where input images are found and outputs will be saved (default: final).")
     parser.add_argument("--TPM_threshold", type=float, default=0.2,
@@ -59,113 +268,48 @@ def main():
                         help="If set, generate TPM padded.")
     parser.add_argument("--pad_size", type=int, default=25,
                         help="padding size (in pixel for each border) (default: 25).")
+    parser.add_argument("--engine", choices=["fsl", "numpy"], default="fsl",
+                        help="fsl: fslmaths/ImageMath commands (default), numpy: single pass in memory.")
+    parser.add_argument("--compare-engines", action="store_true",
+                        help="Run both engines on synthetic TPMs (--TPM_threshold, --pad_size) and compare their outputs, then exit.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of sessions processed in parallel (default: 1).")
     parser.add_argument(
         '--dry-run', action="store_true",
         help="Print commands without executing them"
     )
     args = parser.parse_args()
 
-    TPM_suffix = args.TPM_suffix
-    dry_run = args.dry_run
-
-    for ses in args.sessions:
-
-        template_path = os.path.join(
-            args.bids_root, "derivatives", "template",
-            f"sub-{args.template_name}", ses, args.template_folder)
-
-        mask_files = {
-            "CSF": os.path.join(template_path,f"sub-{args.template_name}_{ses}_label-CSF_{TPM_suffix}.nii.gz"),
-            "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_{TPM_suffix}.nii.gz"),
-            "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_{TPM_suffix}.nii.gz")
-        }
-
-        for key, mask_path in mask_files.items():
-            if not os.path.exists(mask_path):
-                print(f"ERROR: {key} mask not found: {mask_path}. Skipping session {ses}.")
-                continue
-
-        brainmask_files = {
-            "BM": os.path.join(template_path,
-                               f"sub-{args.template_name}_{ses}_label-BM_{TPM_suffix}.nii.gz")
-        }
-        cmd = ["fslmaths", f"{mask_files['CSF']}", "-add", f"{mask_files['GM']}", "-add",
-               f"{mask_files['WM']}", f"{brainmask_files['BM']}"]
-        run_command(cmd, dry_run)
-
-        print(f"threshold TPM ")
-
-        thr_str = f"thr{str(args.TPM_threshold).replace('.', 'p')}"
-
-        mask_files_thr = {
-            "CSF": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-CSF_desc-{thr_str}_probseg.nii.gz"),
-            "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_desc-{thr_str}_probseg.nii.gz"),
-            "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_desc-{thr_str}_probseg.nii.gz")
-        }
-
-        mask_files_corrected = {
-            "CSF": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-CSF_desc-corr_probseg.nii.gz"),
-            "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_desc-corr_probseg.nii.gz"),
-            "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_desc-corr_probseg.nii.gz")
-        }
-
-        cmd = ["fslmaths", f"{mask_files['GM']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['GM']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files['CSF']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['CSF']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files['WM']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['WM']}"]
-        run_command(cmd, dry_run)
-
-        print(f"compute corrected brainmask")
+    if args.compare_engines:
+        sys.exit(0 if compare_engines(args.TPM_threshold, args.pad_size) else 1)
+    if not args.bids_root or not args.sessions:
+        parser.error("--bids_root and --sessions are required")
 
-        brainmask_files_filled = {
-            "BM": os.path.join(template_path,
-                               f"sub-{args.template_name}_{ses}_label-BM_desc-{thr_str}_mask.nii.gz")
-        }
+    thr_str = threshold_label(args.TPM_threshold)
+    jobs = max(1, args.jobs)
 
-        print(f"generate WM TPM from BM,GM,CSG where WM+CSF+GM=1 in BM ")
-        cmd = ["fslmaths", f"{mask_files_thr['CSF']}", "-add",  f"{mask_files_thr['GM']}", "-add",  f"{mask_files_thr['WM']}", "-fillh26", "-bin" , f"{brainmask_files_filled['BM']}"]
-        run_command(cmd, dry_run)
+    failed = []
+    if jobs > 1 and len(args.sessions) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(correct_session, ses, args, thr_str): ses for ses in args.sessions}
+            for future in as_completed(futures):
+                ses = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"ERROR: TPM correction failed for {ses}: {e}")
+                    failed.append(ses)
+    else:
+        for ses in args.sessions:
+            try:
+                correct_session(ses, args, thr_str)
+            except Exception as e:
+                print(f"ERROR: TPM correction failed for {ses}: {e}")
+                failed.append(ses)
 
-        cmd = ["fslmaths", f"{brainmask_files_filled['BM']}", "-sub", f"{mask_files_thr['GM']}", "-sub", f"{mask_files_thr['CSF']}", f"{mask_files_thr['WM']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files['WM']}", "-mul", f"{brainmask_files_filled['BM']}", f"{mask_files_corrected['WM']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files['GM']}", "-mul", f"{brainmask_files_filled['BM']}", f"{mask_files_corrected['GM']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files['CSF']}", "-mul", f"{brainmask_files_filled['BM']}", f"{mask_files_corrected['CSF']}"]
-        run_command(cmd, dry_run)
-
-        print(f"threshold TPM ")
-
-        cmd = ["fslmaths", f"{mask_files_corrected['GM']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['GM']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files_corrected['CSF']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['CSF']}"]
-        run_command(cmd, dry_run)
-        cmd = ["fslmaths", f"{mask_files_corrected['WM']}", "-thr", f"{args.TPM_threshold}", f"{mask_files_thr['WM']}"]
-        run_command(cmd, dry_run)
-
-        write_tpm_json(mask_files_thr, mask_files, args.TPM_threshold, thr_str, dry_run=args.dry_run)
-
-        mask_files_pad = {
-            "CSF": os.path.join(template_path,f"sub-{args.template_name}_{ses}_label-CSF_desc-{thr_str}_padded_probseg.nii.gz"),
-            "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_desc-{thr_str}_padded_probseg.nii.gz"),
-            "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_desc-{thr_str}_padded_probseg.nii.gz")
-        }
-        brainmask_files_padded = {
-            "BM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-BM_desc-{thr_str}_padded_mask.nii.gz")
-        }
-
-        if args.pad:
-            cmd = ["ImageMath", "3", f"{mask_files_pad['WM']}", "PadImage", f"{mask_files_thr['WM']}", f"{args.pad_size}"]
-            run_command(cmd, dry_run)
-            cmd = ["ImageMath", "3", f"{mask_files_pad['GM']}", "PadImage", f"{mask_files_thr['GM']}", f"{args.pad_size}"]
-            run_command(cmd, dry_run)
-            cmd = ["ImageMath", "3", f"{mask_files_pad['CSF']}", "PadImage", f"{mask_files_thr['CSF']}",f"{args.pad_size}"]
-            run_command(cmd, dry_run)
-            cmd = ["ImageMath", "3", f"{brainmask_files_padded['BM']}", "PadImage", f"{brainmask_files_filled['BM']}",f"{args.pad_size}"]
-            run_command(cmd, dry_run)
-        print(f"done")
+    if failed:
+        print(f"Failed sessions: {' '.join(failed)}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,11 @@
 import os
+import sys
 import argparse
-import subprocess
 import pandas as pd
 import glob
 
-def run_command(cmd, dry_run=False, env=None):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True, env=env)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command
 
 def read_subjects(csv_path):
     df = pd.read_csv(csv_path)
@@ -79,7 +77,7 @@ def apply_transform(pattern, input_mask, template_image, output_mask, warp, affi
         "--interpolation", "Linear",
         "--verbose", "1"
     ]
-    run_command(cmd, dry_run)
+    run_command(cmd, dry_run, subject=sub, session=ses, step=f"warp_{pattern}")
 
 def main():
     parser = argparse.ArgumentParser(
@@ -213,7 +211,7 @@ def main():
 
         cmd = ["AverageImages", "3", final_output, "0"] + all_warped_images
         print(f"Averaging {len(all_warped_images)} images for modality '{modality}'")
-        run_command(cmd, dry_run)
+        run_command(cmd, dry_run, session=args.template_session, step=f"average_{modality}")
 
 
 if __name__ == "__main__":
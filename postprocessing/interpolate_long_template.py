@@ -1,7 +1,21 @@
 import os
+import sys
 import argparse
-import subprocess
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, trace_tags, itk_env, job_options, run_graph
+from utils.morph import MorphPair, compute_blending
+from utils.nifti_stream import Nifti4DWriter
+from utils.warp_cache import WarpCache, long_chain
+from utils.tissue_volumes import parse_tissues, voxel_volume, frame_volumes, VolumeTable
+from utils.long_template import template_session_ages
 
 def relpath_from_cwd(filepath):
     """Return path relative to current working directory."""
@@ -19,22 +33,31 @@ def check_file(filepath, label, missing_list, bids_root):
         missing_list.append(relpath_from_cwd(filepath))
         return False
 
-def run_command(cmd, dry_run=False):
-    """Run a shell command unless dry_run is True."""
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True)
-
 # =====================
 # Morphing stubs (Step 1)
 # =====================
 
-def compute_blending(n, numsteps):
-    """Compute blending coefficients A and B, plus blend percentage name."""
-    blending_a = round(n / numsteps, 2)
-    blending_b = round(1 - blending_a, 2)
-    blend_name = int(blending_a * 100)
-    return blending_a, blending_b, blend_name
+def morph_inputs(ses_from, ses_to, args, bids_root, contrasts):
+    """Warp fields of the pair and (moving, fixed) images of each contrast."""
+    long_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+
+    # Input warps (already computed if --compute-reg was used)
+    warp_in = long_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp.nii.gz"
+    invwarp_in = long_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0InverseWarp.nii.gz"
+
+    if not args.dry_run and (not warp_in.exists() or not invwarp_in.exists()):
+        raise FileNotFoundError(
+            f"Missing warp fields: {warp_in} or {invwarp_in}. "
+            f"Run with --compute-reg first to generate them."
+        )
+
+    template_dir = bids_root / "derivatives" / "template" / f"sub-{args.template_name}"
+    images = {
+        contrast: (template_dir / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_{contrast}.nii.gz",
+                   template_dir / ses_to / args.template_path / f"sub-{args.template_name}_{ses_to}_{contrast}.nii.gz")
+        for contrast in contrasts
+    }
+    return warp_in, invwarp_in, images
 
 def morph_frame(n, ses_from, ses_to, args, bids_root, contrasts):
     """
@@ -48,15 +71,7 @@ def morph_frame(n, ses_from, ses_to, args, bids_root, contrasts):
     tmpdir = long_dir / args.morph_tmpdir
     tmpdir.mkdir(parents=True, exist_ok=True)
 
-    # Input warps (already computed if --compute-reg was used)
-    warp_in = long_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp.nii.gz"
-    invwarp_in = long_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0InverseWarp.nii.gz"
-
-    if not warp_in.exists() or not invwarp_in.exists():
-        raise FileNotFoundError(
-            f"Missing warp fields: {warp_in} or {invwarp_in}. "
-            f"Run with --compute-reg first to generate them."
-        )
+    warp_in, invwarp_in, images = morph_inputs(ses_from, ses_to, args, bids_root, contrasts)
 
     # Scaled warp outputs
     warp_scaled = tmpdir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_inter{blend_name}_0Warp.nii.gz"
@@ -81,8 +96,7 @@ def morph_frame(n, ses_from, ses_to, args, bids_root, contrasts):
         temp_tgt = tmpdir / f"{contrast}_tgt_{blend_name}.nii.gz"
 
         # Input images
-        fixed_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_to / args.template_path / f"sub-{args.template_name}_{ses_to}_{contrast}.nii.gz"
-        moving_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_{contrast}.nii.gz"
+        moving_img, fixed_img = images[contrast]
 
         # Apply scaled warps
         run_command(["antsApplyTransforms", "-d", "3", "-i", str(moving_img), "-r", str(fixed_img),
@@ -103,50 +117,245 @@ def morph_frame(n, ses_from, ses_to, args, bids_root, contrasts):
 
     return morph_outputs
 
-def morph_series(ses_from, ses_to, args, bids_root, contrasts):
+def morph_frame_numpy(n, pair, args, tmpdir, contrasts):
     """
-    Generate the full morphing series across steps for all contrasts.
-    Returns a dictionary: {contrast: [morph_step1, morph_step2, ...]}
+    In-memory engine: same frame as morph_frame() from the warps and contrasts loaded once in
+    pair (utils.morph.MorphPair), without temporary images.
+    Returns the frame images and the _morph_ filenames they are saved to (unless --morph-4d-only).
     """
-    print(f"=== Morphing series {ses_from} → {ses_to} ===")
-
-    morphs_per_contrast = {contrast: [] for contrast in contrasts}
+    blending_a, blending_b, blend_name = compute_blending(n, args.morph_numsteps)
+    morph_files = [tmpdir / f"{contrast}_morph_{blend_name}.nii.gz" for contrast in contrasts]
 
-    for n in range(0, args.morph_numsteps + 1, args.morph_step):
-        print(f"\n--- Morph step {n} ---")
-        morph_outputs = morph_frame(n, ses_from, ses_to, args, bids_root, contrasts)
+    if args.dry_run:
+        print(f"[DRY RUN] numpy morph a={blending_a} b={blending_b}: {', '.join(str(f) for f in morph_files)}")
+        return [], morph_files
 
-        for contrast, morph_file in zip(contrasts, morph_outputs):
-            morphs_per_contrast[contrast].append(morph_file)
+    frames = pair.frame_images(blending_a, blending_b, threads=args.threads)
+    if not args.morph_4d_only:
+        for frame, morph_out in zip(frames, morph_files):
+            nib.save(frame, str(morph_out))
+            print(f"[morph_frame] Generated {morph_out}")
+    return frames, morph_files
 
-    return morphs_per_contrast
+def open_4d_writers(ses_from, ses_to, args, bids_root, images):
+    """One streaming 4D writer per contrast, on the grid of the fixed (ses_to) image."""
+    out_prefix = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+    writers = {}
+    for contrast, (_, fixed_img) in images.items():
+        out_4d = out_prefix / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{contrast}_morph_4D.nii.gz"
+        if args.dry_run:
+            print(f"[DRY RUN] 4D morph: {out_4d}")
+            continue
+        writers[contrast] = (Nifti4DWriter(out_4d, nib.load(str(fixed_img))), out_4d)
+    return writers
 
+def tissue_voxel_volumes(images, args):
+    """Voxel volume (mm3) of the frames of each --morph-volumes contrast (grid of the fixed image)."""
+    return {contrast: voxel_volume(nib.load(str(images[contrast][1]))) for _, contrast in args.morph_tissues}
 
-def merge_4d(morph_files_dict, ses_from, ses_to, args, bids_root):
+def frame_tissue_volumes(frame_data, contrasts, args, dvs):
+    """
+    {tissue: (probabilistic, thresholded) volume} of a frame (--morph-volumes), frame_data being
+    the arrays (or image proxies) of the frame in contrast order.
     """
-    Merge intermediate morph frames into a 4D file per contrast using fslmerge.
+    volumes = {}
+    for tissue, contrast in args.morph_tissues:
+        data = np.asanyarray(frame_data[contrasts.index(contrast)])
+        volumes[tissue] = frame_volumes(data, dvs[contrast], args.morph_volume_threshold)
+    return volumes
 
-    morph_files_dict: dict of {contrast: [morph_step1, morph_step2, ...]}
-    ses_from, ses_to: session names
+def morph_series(ses_from, ses_to, args, bids_root, contrasts, volumes=None):
     """
-    print(f"\n=== Merging 4D morphs {ses_from} → {ses_to} ===")
-    out_prefix = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
-    tmpdir = out_prefix / args.morph_tmpdir
+    Generate the full morphing series across steps for all contrasts.
+    With --morph-merge4d, each frame is appended to the 4D file of its contrast as soon as
+    it is produced (frames in step order); --morph-4d-only leaves no per-frame file.
+    With a VolumeTable (--morph-volumes), the tissue volumes of each frame are added to it
+    while the frame is in memory.
+    Returns a dictionary: {contrast: [morph_step1, morph_step2, ...]} of the frame files kept.
+    """
+    print(f"=== Morphing series {ses_from} → {ses_to} ({args.morph_engine} engine) ===")
+
+    morphs_per_contrast = {contrast: [] for contrast in contrasts}
+
+    tmpdir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / args.morph_tmpdir
     tmpdir.mkdir(parents=True, exist_ok=True)
+    warp_in, invwarp_in, images = morph_inputs(ses_from, ses_to, args, bids_root, contrasts)
+
+    pair = None
+    if args.morph_engine == "numpy" and not args.dry_run:
+        pair = MorphPair(warp_in, invwarp_in, [images[contrast] for contrast in contrasts])
+
+    writers = open_4d_writers(ses_from, ses_to, args, bids_root, images) if args.morph_merge4d else {}
+    dvs = tissue_voxel_volumes(images, args) if volumes is not None else {}
+    try:
+        for n in range(0, args.morph_numsteps + 1, args.morph_step):
+            print(f"\n--- Morph step {n} ---")
+            if args.morph_engine == "numpy":
+                frames, morph_outputs = morph_frame_numpy(n, pair, args, tmpdir, contrasts)
+                frame_data = [np.asanyarray(frame.dataobj) for frame in frames]
+            else:
+                morph_outputs = morph_frame(n, ses_from, ses_to, args, bids_root, contrasts)
+                frame_data = []
+                if writers:
+                    frame_data = [nib.load(str(f)).get_fdata(dtype=np.float32) for f in morph_outputs]
+
+            for contrast, data in zip(contrasts, frame_data):
+                if contrast in writers:
+                    writers[contrast][0].append(data)
+
+            if volumes is not None and not args.dry_run:
+                blending_a, _, _ = compute_blending(n, args.morph_numsteps)
+                data = frame_data or [nib.load(str(f)).dataobj for f in morph_outputs]
+                volumes.add(ses_from, ses_to, n, blending_a, frame_tissue_volumes(data, contrasts, args, dvs))
+
+            for contrast, morph_file in zip(contrasts, morph_outputs):
+                if args.morph_4d_only:
+                    if morph_file.exists():
+                        morph_file.unlink()
+                else:
+                    morphs_per_contrast[contrast].append(morph_file)
+    except BaseException:
+        close_4d_writers(writers, failed=True)
+        raise
+
+    close_4d_writers(writers)
+    return morphs_per_contrast
 
-    for contrast, files in morph_files_dict.items():
-        # Ensure files exist
-        existing_files = [str(f) for f in files if f.exists()]
-        if not existing_files:
-            print(f"No morph files found for contrast {contrast}, skipping 4D merge.")
-            continue
+def close_4d_writers(writers, failed=False):
+    """Finish the 4D files, or remove them if the series failed (no truncated series left behind)."""
+    for writer, out_4d in writers.values():
+        writer.close()
+        if failed:
+            out_4d.unlink()
+        else:
+            print(f"[merge_4d] Created 4D morph: {out_4d} ({writer.count} frames)")
 
-        # Output 4D file
-        out_4d = out_prefix / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{contrast}_morph_4D.nii.gz"
-        cmd = ["fslmerge", "-t", str(out_4d)] + existing_files
-        run_command(cmd, dry_run=args.dry_run)
+# =====================
+# Parallel morphing (--jobs)
+# =====================
+
+# pairs memory-mapped in this worker process, by shared directory
+_worker_pairs = {}
+
+def morph_frame_task(n, ses_from, ses_to, args, bids_root, contrasts, spec, dvs=None):
+    """
+    Frame n of a session pair in a worker process. Returns the per-contrast files the parent
+    appends to the 4D outputs: .npy frames (numpy engine, deleted once streamed) or _morph_ frames,
+    and the tissue volumes of the frame (with the voxel volumes dvs of --morph-volumes, else None).
+    """
+    with trace_tags(session=f"{ses_from}_to_{ses_to}", step="morph"):
+        if args.morph_engine == "ants":
+            morph_files = morph_frame(n, ses_from, ses_to, args, bids_root, contrasts)
+            if dvs is None or args.dry_run:
+                return morph_files, None
+            data = [nib.load(str(f)).dataobj for f in morph_files]
+            return morph_files, frame_tissue_volumes(data, contrasts, args, dvs)
+
+        if spec is not None and spec["directory"] not in _worker_pairs:
+            _worker_pairs[spec["directory"]] = MorphPair.from_shared(spec)
+        pair = _worker_pairs[spec["directory"]] if spec is not None else None
+
+        tmpdir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / args.morph_tmpdir
+        frames, morph_files = morph_frame_numpy(n, pair, args, tmpdir, contrasts)
+        volumes = None
+        if frames and dvs is not None:
+            volumes = frame_tissue_volumes([frame.dataobj for frame in frames], contrasts, args, dvs)
+        if not frames or not args.morph_merge4d:
+            return morph_files, volumes
+
+        _, _, blend_name = compute_blending(n, args.morph_numsteps)
+        frame_files = []
+        for i, frame in enumerate(frames):
+            frame_file = Path(spec["directory"]) / f"frame_{i}_{blend_name}.npy"
+            np.save(frame_file, np.asanyarray(frame.dataobj))
+            frame_files.append(frame_file)
+        return frame_files, volumes
+
+def stream_frame(files, writers, contrasts, args):
+    """Append one frame (files in contrast order) to the 4D writers, then drop the temporary files."""
+    for contrast, frame_file in zip(contrasts, files):
+        if frame_file.suffix == ".npy":
+            if contrast in writers:
+                writers[contrast][0].append(np.load(frame_file, mmap_mode="r"))
+            frame_file.unlink()
+        else:
+            if contrast in writers:
+                writers[contrast][0].append(nib.load(str(frame_file)).get_fdata(dtype=np.float32))
+            if args.morph_4d_only and frame_file.exists():
+                frame_file.unlink()
 
-        print(f"[merge_4d] Created 4D morph: {out_4d}")
+def morph_pairs_parallel(pairs, args, bids_root, contrasts, volumes=None):
+    """
+    --jobs: compute the frames of every (pair, step) concurrently in worker processes.
+    The warps and contrasts of each pair are decompressed once by the parent and memory-mapped
+    by the workers; frames are appended to the 4D outputs in step order as they complete.
+    The _morph_ frames and the ants temporary images are named by contrast and step only, so
+    pairs run concurrently only with --morph-4d-only and the numpy engine, otherwise one after
+    the other (steps in parallel). The tissue volumes computed by the workers are added to
+    volumes (VolumeTable, --morph-volumes) in step order too.
+    """
+    long_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+    steps = list(range(0, args.morph_numsteps + 1, args.morph_step))
+    if args.morph_engine == "numpy" and args.morph_4d_only:
+        groups = [pairs]
+    else:
+        groups = [[pair] for pair in pairs]
+
+    for group in groups:
+        specs, writers, dvs = {}, {}, {}
+        for ses_from, ses_to in group:
+            print(f"=== Morphing series {ses_from} → {ses_to} ({args.morph_engine} engine, {args.jobs} jobs) ===")
+            (long_dir / args.morph_tmpdir).mkdir(parents=True, exist_ok=True)
+            warp_in, invwarp_in, images = morph_inputs(ses_from, ses_to, args, bids_root, contrasts)
+            specs[(ses_from, ses_to)] = None
+            if args.morph_engine == "numpy" and not args.dry_run:
+                shared_dir = long_dir / args.morph_tmpdir / "shared" / f"{ses_from}_to_{ses_to}"
+                pair = MorphPair(warp_in, invwarp_in, [images[contrast] for contrast in contrasts])
+                specs[(ses_from, ses_to)] = pair.share(shared_dir)
+                del pair
+            writers[(ses_from, ses_to)] = open_4d_writers(ses_from, ses_to, args, bids_root, images) \
+                if args.morph_merge4d else {}
+            dvs[(ses_from, ses_to)] = tissue_voxel_volumes(images, args) if volumes is not None else None
+
+        try:
+            # called from a registration thread of main(): forking a multi-threaded process can
+            # deadlock the workers on a lock held by another thread, so they start from a forkserver
+            with ProcessPoolExecutor(max_workers=args.jobs,
+                                     mp_context=multiprocessing.get_context("forkserver")) as executor:
+                futures = {}
+                for (ses_from, ses_to), spec in specs.items():
+                    for index, n in enumerate(steps):
+                        future = executor.submit(morph_frame_task, n, ses_from, ses_to, args, bids_root, contrasts,
+                                                 spec, dvs[(ses_from, ses_to)])
+                        futures[future] = ((ses_from, ses_to), index)
+
+                # frames complete in any order: keep them until the previous steps are written
+                ready = {pair: {} for pair in specs}
+                next_index = {pair: 0 for pair in specs}
+                for future in as_completed(futures):
+                    pair, index = futures[future]
+                    ready[pair][index] = future.result()
+                    while next_index[pair] in ready[pair]:
+                        files, frame_vols = ready[pair].pop(next_index[pair])
+                        stream_frame(files, writers[pair], contrasts, args)
+                        if frame_vols is not None:
+                            n = steps[next_index[pair]]
+                            volumes.add(pair[0], pair[1], n, compute_blending(n, args.morph_numsteps)[0], frame_vols)
+                        next_index[pair] += 1
+        except BaseException:
+            for pair_writers in writers.values():
+                close_4d_writers(pair_writers, failed=True)
+            raise
+
+        for pair_writers in writers.values():
+            close_4d_writers(pair_writers)
+        if not args.keep_tmp:
+            for spec in specs.values():
+                if spec is not None:
+                    shutil.rmtree(spec["directory"], ignore_errors=True)
+            shared_root = long_dir / args.morph_tmpdir / "shared"
+            if shared_root.exists() and not any(shared_root.iterdir()):
+                shared_root.rmdir()
 
 
 # =====================
@@ -187,15 +396,20 @@ def parse_metrics_arg(modalities, metrics):
 
     return metrics_dict
 
-def interpolate_contrast(template_name, ses_from, ses_to, fixed, moving, template_path, output_path, contrasts, bids_root, args, keep_tmp=False):
-
+def interpolate_contrast(ses_from, ses_to, reference, contrasts, bids_root, args, warp_cache):
+    """
+    Propagate contrasts of ses_from onto the reference grid of ses_to (any pair of sessions) with a
+    single antsApplyTransforms: the adjacent Warps / InverseWarps in between are composed once
+    into one displacement field, cached in long/cache (utils/warp_cache.py).
+    """
     out_prefix = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}"
 
-    out_path = out_prefix / output_path
+    out_path = out_prefix / args.output_path
     out_path.mkdir(parents=True, exist_ok=True)
 
-    warp_prefix = out_prefix / "long" / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp.nii.gz"
-    invwarp_prefix = out_prefix / "long" / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0InverseWarp.nii.gz"
+    chain = long_chain(out_prefix / "long", args.sessions, args.reg_long_type, ses_from, ses_to)
+    transform = warp_cache.get(f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp", chain, reference,
+                               threads=args.threads, dry_run=args.dry_run)
 
     for modality in contrasts:
         print(f"\nPropagating modality '{modality}' from session {ses_from} to {ses_to}")
@@ -203,34 +417,20 @@ def interpolate_contrast(template_name, ses_from, ses_to, fixed, moving, templat
         ses_dir = bids_root / "derivatives" / "template" / f"sub-{args.template_name}"
 
         contrast_from = ses_dir / f"{ses_from}" / args.template_path / f"sub-{args.template_name}_{ses_from}_{modality}.nii.gz"
-        contrast_to = ses_dir / f"{ses_to}" / args.template_path / f"sub-{args.template_name}_{ses_to}_{modality}.nii.gz"
-
         warped = out_path / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{modality}.nii.gz"
-        inverse_warped = out_path / f"{ses_to}_to_{ses_from}_{args.reg_long_type}_{modality}.nii.gz"
 
         cmd = [
              "antsApplyTransforms", "-d", "3",
              "-i", relpath_from_cwd(contrast_from),
-             "-r", relpath_from_cwd(fixed),
+             "-r", relpath_from_cwd(reference),
              "-o", relpath_from_cwd(warped),
-             "-t", relpath_from_cwd(warp_prefix),
-             "--interpolation", "Linear",
-             "--verbose", "1"
-         ]
-
-        run_command(cmd, dry_run=args.dry_run)
-
-        cmd = [
-             "antsApplyTransforms", "-d", "3",
-             "-i", relpath_from_cwd(contrast_to),
-             "-r", relpath_from_cwd(moving),
-             "-o", relpath_from_cwd(inverse_warped),
-             "-t", relpath_from_cwd(invwarp_prefix),
+             "-t", relpath_from_cwd(transform),
              "--interpolation", "Linear",
              "--verbose", "1"
          ]
 
-        run_command(cmd, dry_run=args.dry_run)
+        run_command(cmd, dry_run=args.dry_run, session=f"{ses_from}_to_{ses_to}", step="propagate",
+                    env=itk_env(args.threads_per_job))
 
 
 def main():
@@ -250,6 +450,9 @@ def main():
     parser.add_argument("--compute-reg", action="store_true",default=False, help="compute registration")
     parser.add_argument("--contrasts_to_interpolate", nargs='*', default=[],
                         help="Contrasts to interpolate across timepoints")
+    parser.add_argument("--propagate", action="store_true",
+                        help="Propagate --contrasts_to_interpolate between every pair of sessions into --output_path, "
+                             "through one composed (cached) warp per pair")
     parser.add_argument("--keep-tmp", action="store_true", help="Keep temporary files")
     parser.add_argument("--dry-run", action="store_true", help="Don't actually run commands")
 
@@ -263,13 +466,43 @@ def main():
     parser.add_argument("--morph-tmpdir", default="tmp",
                         help="Temporary directory for morphing images")
     parser.add_argument("--morph-merge4d", action="store_true",
-                        help="Merge all morphs into one 4D file with fslmerge")
+                        help="Write all morphs into one 4D file per contrast, streamed frame by frame")
+    parser.add_argument("--morph-engine", choices=["numpy", "ants"], default="numpy",
+                        help="numpy: in-memory frames from warps loaded once per pair (default), "
+                             "ants: MultiplyImages/antsApplyTransforms/ImageMath per frame")
+    parser.add_argument("--morph-4d-only", action="store_true",
+                        help="With --morph-merge4d, only keep the 4D files (no per-frame files)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="Number of threads of the numpy morph engine, per job (default: 4)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of session pairs registered concurrently, each with its own log in long/logs, "
+                             "and of morph frames computed concurrently, across steps and session pairs (default: 1)")
+    parser.add_argument("--threads-per-job", type=int, default=None,
+                        help="ITK threads of each registration job (default: number of CPUs / jobs)")
+    parser.add_argument("--morph-volumes", nargs="*", default=[],
+                        help="Tissue volumes of every frame, as tissue:contrast with TPM contrasts of "
+                             "--contrasts_to_interpolate (e.g. WM:label-WM_desc-thr0p2_probseg)")
+    parser.add_argument("--morph-volume-threshold", type=float, default=0.5,
+                        help="Probability threshold of the thresholded tissue volumes (default: 0.5)")
+    parser.add_argument("--morph-volumes-csv", default=None,
+                        help="CSV of the tissue volumes (default: long/sub-<name>_<reg_long_type>_morph_volumes.csv)")
+    parser.add_argument("--ages", nargs="*", default=[],
+                        help="Age of each session for the tissue volumes, as ses:age (default: sessions.tsv)")
 
     args = parser.parse_args()
     bids_root = Path(args.bids_root)
     missing_files = []
     templates = {}
 
+    if args.morph_4d_only and not args.morph_merge4d:
+        parser.error("--morph-4d-only requires --morph-merge4d")
+    if args.threads_per_job is None:
+        args.threads_per_job = max(1, (os.cpu_count() or 1) // max(1, args.jobs))
+    try:
+        args.morph_tissues = parse_tissues(args.morph_volumes, args.contrasts_to_interpolate)
+    except ValueError as e:
+        parser.error(str(e))
+
     # Parse metrics and match to modalities
     metrics_dict = parse_metrics_arg(args.registration_modalities, args.registration_metrics)
 
@@ -299,7 +532,26 @@ def main():
     else:
         print("\nAll required files found!")
 
-    print("\n=== Registration sessions ===")
+    print(f"\n=== Registration sessions ({args.jobs} job(s), {args.threads_per_job} ITK thread(s) each) ===")
+
+    # Each pair registration is a task, its morphing starts as soon as it is registered and the
+    # propagation between two sessions once the pairs in between are (--jobs tasks at a time)
+    tasks = {}
+    morph_pairs = []
+    # morphing tasks run one at a time: each one uses --jobs processes and the tmp frame names
+    morph_lock = threading.Lock()
+
+    volumes = None
+    if args.morph_enable and args.morph_tissues and not args.dry_run:
+        long_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+        long_dir.mkdir(parents=True, exist_ok=True)
+        volumes_csv = Path(args.morph_volumes_csv) if args.morph_volumes_csv else \
+            long_dir / f"sub-{args.template_name}_{args.reg_long_type}_morph_volumes.csv"
+        ages = {ses: float(age) for ses, age in (item.split(":", 1) for item in args.ages)} or \
+            template_session_ages(str(bids_root), args.template_name, args.sessions)
+        if not all(ses in ages for ses in args.sessions):
+            print("No age for every session (sessions.tsv or --ages): the age column of the volumes is left empty")
+        volumes = VolumeTable(volumes_csv, ages)
 
     # --- Pipeline complet sécurisé ---
     for i in range(len(args.sessions) - 1):
@@ -364,7 +616,9 @@ def main():
                 "--shrink-factors", "8x4x2x1",
                 "--smoothing-sigmas", "3x2x1x0vox",
             ]
-            run_command(cmd, dry_run=args.dry_run)
+            tasks[f"register_{ses_from}_to_{ses_to}"] = (set(), lambda cmd=cmd, f=ses_from, t=ses_to: run_command(
+                cmd, dry_run=args.dry_run, session=f"{f}_to_{t}", step="register",
+                **job_options(args, bids_root, f"{f}_to_{t}_register")))
         else:
             print("Registration skipped (Warp/InverseWarp already exist)")
 
@@ -374,14 +628,54 @@ def main():
                 print("--morph_enable is set but no contrasts provided. Skipping morphing.")
             else:
                 print("\n=== Morphing enabled ===")
-                morph_files_dict = morph_series(ses_from, ses_to, args, bids_root, args.contrasts_to_interpolate)
-
-                # --- Merge 4D if requested ---
-                if args.morph_merge4d:
-                    merge_4d(morph_files_dict, ses_from, ses_to, args, bids_root)
+                morph_pairs.append((ses_from, ses_to))
         else:
             print("=== Morphing disabled ===")
 
+    def morph(pairs):
+        with morph_lock:
+            if args.jobs > 1:
+                print(f"\n=== Morphing {len(pairs)} session pair(s) with {args.jobs} jobs ===")
+                morph_pairs_parallel(pairs, args, bids_root, args.contrasts_to_interpolate, volumes)
+                return
+            for ses_from, ses_to in pairs:
+                # frames are streamed to the 4D files (--morph-merge4d) while they are generated
+                with trace_tags(session=f"{ses_from}_to_{ses_to}", step="morph"):
+                    morph_series(ses_from, ses_to, args, bids_root, args.contrasts_to_interpolate, volumes)
+
+    registered = [name for name in tasks if name.startswith("register_")]
+    if morph_pairs and not registered:
+        # all the pairs are morphed together (steps of all pairs queued with --jobs)
+        tasks["morph"] = (set(), lambda: morph(morph_pairs))
+    else:
+        for ses_from, ses_to in morph_pairs:
+            tasks[f"morph_{ses_from}_to_{ses_to}"] = ({f"register_{ses_from}_to_{ses_to}"},
+                                                      lambda f=ses_from, t=ses_to: morph([(f, t)]))
+
+    if args.propagate and args.contrasts_to_interpolate:
+        warp_cache = WarpCache(bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / "cache")
+        reference_modality = args.registration_modalities[0]
+        pairs = list(zip(args.sessions[:-1], args.sessions[1:]))
+        for i, ses_from in enumerate(args.sessions):
+            for j, ses_to in enumerate(args.sessions):
+                if ses_from != ses_to:
+                    tasks[f"propagate_{ses_from}_to_{ses_to}"] = (
+                        {f"register_{f}_to_{t}" for f, t in pairs[min(i, j):max(i, j)]},
+                        lambda f=ses_from, t=ses_to: interpolate_contrast(
+                            f, t, templates[t][reference_modality], args.contrasts_to_interpolate,
+                            bids_root, args, warp_cache))
+
+    failed = run_graph(tasks, args.jobs)
+
+    if volumes is not None:
+        volumes.close()
+        print(f"\nTissue volumes ({volumes.rows} rows) written to {relpath_from_cwd(volumes.path)}")
+
+    if failed:
+        print("\nSummary: failed steps:")
+        for name in failed:
+            print(" -", name)
+        exit(1)
 
 
 if __name__ == "__main__":
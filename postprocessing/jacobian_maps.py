@@ -0,0 +1,127 @@
+import os
+import sys
+import csv
+import shutil
+import argparse
+from pathlib import Path
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import trace_tags
+from utils.jacobian import memmap_volume, jacobian_determinant, tissue_summary
+from utils.morph import compute_blending
+
+def relpath_from_cwd(filepath):
+    """Return path relative to current working directory."""
+    filepath_abs = os.path.abspath(filepath)
+    cwd_abs = os.path.abspath(os.getcwd())
+    return os.path.relpath(filepath_abs, cwd_abs)
+
+def save_map(data, img, out_path):
+    """Save a float32 3D map with the geometry of the (4D/5D) field image."""
+    header = img.header.copy()
+    header.set_data_shape(data.shape)
+    header.set_intent("none")
+    out = nib.Nifti1Image(data, img.affine, header)
+    out.set_data_dtype(np.float32)
+    nib.save(out, str(out_path))
+
+def main():
+    parser = argparse.ArgumentParser(description="Log-Jacobian maps of the longitudinal SyN warps, summarised per tissue")
+    parser.add_argument("--bids_root", required=True, help="Root BIDS directory")
+    parser.add_argument("--template_name", required=True, help="Template subject name")
+    parser.add_argument("--sessions", nargs='+', required=True, help="List of sessions (ordered, as registered)")
+    parser.add_argument("--reg_long_type", default="CACP_MM", help="name of registration type")
+    parser.add_argument("--template_path", default="final", help="Subfolder for template")
+    parser.add_argument("--output_path", default="jacobian", help="Output subfolder of transforms/sub-<name>")
+    parser.add_argument("--tpm_suffixes", nargs='*', default=[],
+                        help="Tissue TPMs of the sessions, as tissue:suffix (e.g. WM:label-WM_desc-thr0p2_probseg)")
+    parser.add_argument("--morph-numsteps", type=int, default=0,
+                        help="Also compute the map of every morph step (scaled warp b * Warp), 0 for none (default=0)")
+    parser.add_argument("--morph-step", type=int, default=1, help="Morphing increment (default=1)")
+    parser.add_argument("--slab", type=int, default=8, help="Number of z slices per slab (default=8)")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads (default: 4)")
+    parser.add_argument("--keep-tmp", action="store_true", help="Keep the decompressed warps")
+    parser.add_argument("--dry-run", action="store_true", help="Don't actually compute")
+    args = parser.parse_args()
+
+    bids_root = Path(args.bids_root)
+    long_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+    out_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / args.output_path
+    tmpdir = out_dir / "tmp"
+    template_dir = bids_root / "derivatives" / "template" / f"sub-{args.template_name}"
+    tissues = [item.split(":", 1) for item in args.tpm_suffixes]
+
+    steps = [(None, 1.0, None)]
+    if args.morph_numsteps > 0:
+        steps += [compute_blending(n, args.morph_numsteps) for n in range(0, args.morph_numsteps + 1, args.morph_step)]
+
+    summary_rows = []
+    for ses_from, ses_to in zip(args.sessions[:-1], args.sessions[1:]):
+        warp = long_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp.nii.gz"
+        print(f"\n=== Log-Jacobian {ses_from} → {ses_to} ===")
+        if not warp.exists():
+            print(f"  Missing warp: {relpath_from_cwd(warp)}, run interpolate_long_template.py --compute-reg first")
+            continue
+
+        tpms = []
+        for tissue, suffix in tissues:
+            tpm_path = template_dir / ses_to / args.template_path / f"sub-{args.template_name}_{ses_to}_{suffix}.nii.gz"
+            if tpm_path.exists():
+                tpms.append((tissue, tpm_path))
+            else:
+                print(f"  Missing {tissue} TPM: {relpath_from_cwd(tpm_path)}")
+
+        if args.dry_run:
+            for _, blending_b, blend_name in steps:
+                name = "logjacobian" if blend_name is None else f"logjacobian_{blend_name}"
+                print(f"[DRY RUN] log-Jacobian (scale {blending_b}) of {relpath_from_cwd(warp)} -> "
+                      f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{name}.nii.gz")
+            continue
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with trace_tags(session=f"{ses_from}_to_{ses_to}", step="jacobian"):
+            field, field_img = memmap_volume(warp, tmpdir)
+            voxel_volume = float(np.prod(field_img.header.get_zooms()[:3]))
+
+            # TPMs on the grid of the warp (the ses_to template)
+            tissue_maps = []
+            for tissue, tpm_path in tpms:
+                tpm, tpm_img = memmap_volume(tpm_path, tmpdir)
+                if tpm_img.shape[:3] != field_img.shape[:3] or not np.allclose(tpm_img.affine, field_img.affine, atol=1e-4):
+                    print(f"  Skipping {tissue}: {relpath_from_cwd(tpm_path)} is not on the warp grid")
+                    continue
+                tissue_maps.append((tissue, tpm))
+
+            for blending_a, blending_b, blend_name in steps:
+                name = "logjacobian" if blend_name is None else f"logjacobian_{blend_name}"
+                out_path = out_dir / f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{name}.nii.gz"
+                log_jacobian = jacobian_determinant(field, field_img.affine, scale=blending_b,
+                                                    threads=args.threads, slab_size=args.slab)
+                save_map(log_jacobian, field_img, out_path)
+                print(f"  Saved {relpath_from_cwd(out_path)}")
+
+                for tissue, tpm in tissue_maps:
+                    stats = tissue_summary(log_jacobian, tpm, voxel_volume, args.slab)
+                    summary_rows.append({"ses_from": ses_from, "ses_to": ses_to,
+                                         "step": "" if blend_name is None else blend_name,
+                                         "blend": "" if blending_a is None else blending_a,
+                                         "tissue": tissue, **stats,
+                                         "volume_ratio": stats["volume_moving_mm3"] / stats["volume_fixed_mm3"]
+                                         if stats["volume_fixed_mm3"] > 0 else float("nan")})
+            del field
+
+        if not args.keep_tmp and tmpdir.exists():
+            shutil.rmtree(tmpdir)
+
+    if summary_rows:
+        summary_csv = out_dir / f"sub-{args.template_name}_{args.reg_long_type}_jacobian_summary.csv"
+        with open(summary_csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary_rows[0]))
+            writer.writeheader()
+            writer.writerows(summary_rows)
+        print(f"\nTissue summary written to {relpath_from_cwd(summary_csv)}")
+
+if __name__ == "__main__":
+    main()
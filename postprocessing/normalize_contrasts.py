@@ -1,7 +1,11 @@
 import os
+import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import nibabel as nib
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import json
 
@@ -58,121 +62,187 @@ def write_anat_json(modality, source_fname, filepath, a, b):
     print(f"JSON file written: {json_path}")
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Normalize contrast for selected sessions.")
-    parser.add_argument("--bids_root", required=True,
-                        help="Path to the root of the BIDS dataset.")
-    parser.add_argument("--sessions", nargs="+", required=True,
-                        help="List of session identifiers (e.g., ses-0 ses-1 ses-2 ses-3).")
-    parser.add_argument("--modality", choices=["T1w", "T2w"], required=True,
-                        help="Contrast modality to normalize.")
-    parser.add_argument("--wm-norm", type=float, required=True,
-                        help="Target value for white matter.")
-    parser.add_argument("--gm-norm", type=float, required=True,
-                        help="Target value for gray matter.")
-    parser.add_argument("--wm-p", type=int, required=True,
-                        help="Percentile used for WM (e.g., 90 for T1w, 10 for T2w).")
-    parser.add_argument("--gm-p", type=int, required=True,
-                        help="Percentile used for GM (e.g., 10 for T1w, 90 for T2w).")
-    parser.add_argument("--template_name", default="BaBa21",
-                        help="Template name (default: BaBa21).")
-    parser.add_argument("--template_suffix", default="desc-average_padded_debiased",
-                        help="Template suffix for input template (e.g., desc-average_padded_debiased).")
-    parser.add_argument("--TPM_suffix",
-                        help="Suffix for TPM mask files (if not set, equals template_suffix).")
-    parser.add_argument("--template_path", default="final",
-                        help="Folder under template where input images are found and outputs will be saved (default: final).")
-    parser.add_argument("--generate_cropped_template", action="store_true",
-                        help="If set, generate cropped (masked) version of the normalized image.")
-    parser.add_argument("--brainmask_threshold", type=float, default=0.5,
-                        help="Threshold used to binarize the brainmask before cropping (default: 0.5).")
-    parser.add_argument("--QC", action="store_true",
-                        help="If set, generate QC histogram for the normalized images.")
-    args = parser.parse_args()
+def masked_percentile(data, mask, p):
+    """
+    Equivalent of `fslstats data -k mask -p p`: value of rank int(n*p/100) among the
+    n voxels where mask > 0, printed by fslstats with 6 significant digits.
+    """
+    values = data[mask > 0]
+    if values.size == 0:
+        raise ValueError("empty mask")
+    k = min(int(values.size * p / 100.0), values.size - 1)
+    return float(f"{np.partition(values, k)[k]:.6g}")
 
-    if args.TPM_suffix is None:
-        TPM_suffix = args.template_suffix
-    else:
-        TPM_suffix = args.TPM_suffix
+def normalize_session(ses, args, contrasts, TPM_suffix):
+    """
+    Normalize every contrast of one session. The tissue masks are loaded once and all the
+    computations stay in float32 (as fslmaths does).
+    """
+    template_path = os.path.join(args.bids_root, "derivatives", "template",
+                                 f"sub-{args.template_name}", ses, args.template_path)
+
+    mask_files = {
+        "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_{TPM_suffix}_probseg.nii.gz"),
+        "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_{TPM_suffix}_probseg.nii.gz"),
+        "CSF": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-CSF_{TPM_suffix}_probseg.nii.gz"),
+        "BM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-BM_{TPM_suffix}_mask.nii.gz")
+    }
+
+    for key, mask_path in mask_files.items():
+        if not os.path.exists(mask_path):
+            print(f"ERROR: {key} mask not found: {mask_path}. Skipping session {ses}.")
+            return False
 
-    for ses in args.sessions:
-        template_path = os.path.join(args.bids_root, "derivatives", "template",
-                                  f"sub-{args.template_name}", ses, args.template_path)
+    masks = {key: nib.load(mask_files[key]).get_fdata(dtype=np.float32) for key in ["WM", "GM", "BM"]}
 
+    bm_bin = None
+    if args.generate_cropped_template:
+        # fslmaths BM -thr t -bin
+        bm_bin = (masks["BM"] >= np.float32(args.brainmask_threshold)) & (masks["BM"] > 0)
+
+    for contrast in contrasts:
+        modality = contrast["modality"]
         img_in = os.path.join(template_path,
-                              f"sub-{args.template_name}_{ses}_{args.template_suffix}_{args.modality}.nii.gz")
+                              f"sub-{args.template_name}_{ses}_{args.template_suffix}_{modality}.nii.gz")
 
         if not os.path.exists(img_in):
-            print(f"ERROR: Input image not found: {img_in}. Skipping session {ses}.")
+            print(f"ERROR: Input image not found: {img_in}. Skipping {modality} for session {ses}.")
             continue
 
-        mask_files = {
-            "WM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-WM_{TPM_suffix}_probseg.nii.gz"),
-            "GM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-GM_{TPM_suffix}_probseg.nii.gz"),
-            "CSF": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-CSF_{TPM_suffix}_probseg.nii.gz"),
-            "BM": os.path.join(template_path, f"sub-{args.template_name}_{ses}_label-BM_{TPM_suffix}_mask.nii.gz")
-        }
-
-        for key, mask_path in mask_files.items():
-            if not os.path.exists(mask_path):
-                print(f"ERROR: {key} mask not found: {mask_path}. Skipping session {ses}.")
-                continue
+        print(f"Compute {modality} Normalization for {ses} session")
 
-        print(f"Compute {args.modality} Normalization for {ses} session")
+        img = nib.load(img_in)
+        data = img.get_fdata(dtype=np.float32)
 
-        # Get percentiles from fslstats
-        mean_wm = float(os.popen(f"fslstats {img_in} -k {mask_files['WM']} -p {args.wm_p}").read())
-        mean_gm = float(os.popen(f"fslstats {img_in} -k {mask_files['GM']} -p {args.gm_p}").read())
+        mean_wm = masked_percentile(data, masks["WM"], contrast["wm_p"])
+        mean_gm = masked_percentile(data, masks["GM"], contrast["gm_p"])
 
-        a = (args.gm_norm - args.wm_norm) / (mean_gm - mean_wm)
-        b = args.wm_norm - a * mean_wm
+        a = (contrast["gm_norm"] - contrast["wm_norm"]) / (mean_gm - mean_wm)
+        b = contrast["wm_norm"] - a * mean_wm
 
-        print(f"Normalization linear transform: a = {a:.4f}, b = {b:.4f}")
+        print(f"[{ses} {modality}] Normalization linear transform: a = {a:.4f}, b = {b:.4f}")
         print(f"Equation: normalized_value = a * original_value + b")
 
         img_out = os.path.join(template_path,
-                               f"sub-{args.template_name}_{ses}_{args.template_suffix}_norm_{args.modality}.nii.gz")
+                               f"sub-{args.template_name}_{ses}_{args.template_suffix}_norm_{modality}.nii.gz")
 
-        os.system(f"fslmaths {img_in} -mul {a} -add {b} {img_out}")
+        # fslmaths img -mul a -add b (in float32, output in the input datatype)
+        normalized = data * np.float32(a) + np.float32(b)
+        del data
+        out = nib.Nifti1Image(normalized, img.affine, img.header)
+        out.set_data_dtype(img.get_data_dtype())
+        nib.save(out, img_out)
 
+        norm_data = normalized
         if args.generate_cropped_template:
-            bm_bin = os.path.join(template_path, "tmp_brainmask_bin.nii.gz")
-            os.system(f"fslmaths {mask_files['BM']} -thr {args.brainmask_threshold} -bin {bm_bin}")
             img_out_cropped = os.path.join(template_path,
-                                           f"sub-{args.template_name}_{ses}_{args.template_suffix}_cropped_norm_{args.modality}.nii.gz")
-            os.system(f"fslmaths {img_out} -mul {bm_bin} {img_out_cropped}")
+                                           f"sub-{args.template_name}_{ses}_{args.template_suffix}_cropped_norm_{modality}.nii.gz")
+            norm_data = normalized * bm_bin
+            out = nib.Nifti1Image(norm_data, img.affine, img.header)
+            out.set_data_dtype(img.get_data_dtype())
+            nib.save(out, img_out_cropped)
 
-            write_anat_json(args.modality, img_in, img_out_cropped, a, b)
-
-            os.remove(bm_bin)
+            write_anat_json(modality, img_in, img_out_cropped, a, b)
 
         if args.QC:
-            norm_img_path = img_out
-            if args.generate_cropped_template:
-                norm_img_path = img_out_cropped
+            save_histogram(norm_data, masks["GM"], masks["WM"], masks["BM"], modality, ses, template_path, "after_cor",-10, 110, 120)
 
-            img = nib.load(norm_img_path)
-            data = img.get_fdata()
+            data = img.get_fdata(dtype=np.float32)
+            masked_data = data[masks["BM"] > args.brainmask_threshold]
+            min_val = masked_data.min()
+            max_val = masked_data.max()
 
-            gm_data = nib.load(mask_files['GM']).get_fdata()
-            wm_data = nib.load(mask_files['WM']).get_fdata()
-            bm_data = nib.load(mask_files['BM']).get_fdata()
+            print(f"Masked image values: min = {min_val:.4f}, max = {max_val:.4f}")
 
-            save_histogram(data, gm_data, wm_data, bm_data, args.modality, ses, template_path, "after_cor",-10, 110, 120)
+            save_histogram(data, masks["GM"], masks["WM"], masks["BM"], modality, ses, template_path, "before_cor",min_val,max_val, 100)
 
-            norm_img_path = img_in
-            img = nib.load(norm_img_path)
-            data = img.get_fdata()
+    print(f"done {ses}")
+    return True
 
-            masked_data = data[bm_data > args.brainmask_threshold]
-            min_val = masked_data.min()
-            max_val = masked_data.max()
+def per_modality(values, modalities, name):
+    """Accept one value per modality, or a single value shared by all of them."""
+    if len(values) == 1:
+        return values * len(modalities)
+    if len(values) != len(modalities):
+        raise ValueError(f"{name} expects 1 or {len(modalities)} values (one per modality), got {len(values)}")
+    return values
 
-            print(f"Masked image values: min = {min_val:.4f}, max = {max_val:.4f}")
+def main():
+    parser = argparse.ArgumentParser(description="Normalize contrast for selected sessions.")
+    parser.add_argument("--bids_root", required=True,
+                        help="Path to the root of the BIDS dataset.")
+    parser.add_argument("--sessions", nargs="+", required=True,
+                        help="List of session identifiers (e.g., ses-0 ses-1 ses-2 ses-3).")
+    parser.add_argument("--modality", nargs="+", choices=["T1w", "T2w"], required=True,
+                        help="Contrast modality (or modalities) to normalize.")
+    parser.add_argument("--wm-norm", type=float, nargs="+", required=True,
+                        help="Target value for white matter (one per modality).")
+    parser.add_argument("--gm-norm", type=float, nargs="+", required=True,
+                        help="Target value for gray matter (one per modality).")
+    parser.add_argument("--wm-p", type=int, nargs="+", required=True,
+                        help="Percentile used for WM (e.g., 90 for T1w, 10 for T2w) (one per modality).")
+    parser.add_argument("--gm-p", type=int, nargs="+", required=True,
+                        help="Percentile used for GM (e.g., 10 for T1w, 90 for T2w) (one per modality).")
+    parser.add_argument("--template_name", default="BaBa21",
+                        help="Template name (default: BaBa21).")
+    parser.add_argument("--template_suffix", default="desc-average_padded_debiased",
+                        help="Template suffix for input template (e.g., desc-average_padded_debiased).")
+    parser.add_argument("--TPM_suffix",
+                        help="Suffix for TPM mask files (if not set, equals template_suffix).")
+    parser.add_argument("--template_path", default="final",
+                        help="Folder under template where input images are found and outputs will be saved (default: final).")
+    parser.add_argument("--generate_cropped_template", action="store_true",
+                        help="If set, generate cropped (masked) version of the normalized image.")
+    parser.add_argument("--brainmask_threshold", type=float, default=0.5,
+                        help="Threshold used to binarize the brainmask before cropping (default: 0.5).")
+    parser.add_argument("--QC", action="store_true",
+                        help="If set, generate QC histogram for the normalized images.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of sessions processed in parallel (default: 1).")
+    args = parser.parse_args()
 
-            save_histogram(data, gm_data, wm_data, bm_data, args.modality, ses, template_path, "before_cor",min_val,max_val, 100)
+    if args.TPM_suffix is None:
+        TPM_suffix = args.template_suffix
+    else:
+        TPM_suffix = args.TPM_suffix
 
-        print(f"done")
+    modalities = args.modality
+    try:
+        contrasts = [
+            {"modality": m, "wm_norm": wm_norm, "gm_norm": gm_norm, "wm_p": wm_p, "gm_p": gm_p}
+            for m, wm_norm, gm_norm, wm_p, gm_p in zip(
+                modalities,
+                per_modality(args.wm_norm, modalities, "--wm-norm"),
+                per_modality(args.gm_norm, modalities, "--gm-norm"),
+                per_modality(args.wm_p, modalities, "--wm-p"),
+                per_modality(args.gm_p, modalities, "--gm-p"))
+        ]
+    except ValueError as e:
+        parser.error(str(e))
+
+    jobs = max(1, args.jobs)
+    failed = []
+    if jobs > 1 and len(args.sessions) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(normalize_session, ses, args, contrasts, TPM_suffix): ses for ses in args.sessions}
+            for future in as_completed(futures):
+                ses = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"ERROR: normalization failed for {ses}: {e}")
+                    failed.append(ses)
+    else:
+        for ses in args.sessions:
+            try:
+                normalize_session(ses, args, contrasts, TPM_suffix)
+            except Exception as e:
+                print(f"ERROR: normalization failed for {ses}: {e}")
+                failed.append(ses)
+
+    if failed:
+        print(f"Failed sessions: {' '.join(failed)}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
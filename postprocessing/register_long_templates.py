@@ -1,8 +1,13 @@
 import os
+import sys
 import argparse
-import subprocess
 from pathlib import Path
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, job_options, run_graph
+from utils.transforms import fsl_to_itk
+from utils.warp_cache import WarpCache
+
 #sub- → ses- → task- → acq- → ce- → dir- → run- → mod- → echo- → flip- → inv- → mt- → part- → rec- → space- → split- → desc- → suffix (T1w).
 #sub-BaBa21_ses-3_desc-sym_space-CACP_desc-symmetric-sharpen_desc-debiased_desc-norm_desc-cropped_T1w.nii.gz
 # --> sub-BaBa21_ses-3_space-CACP_desc-symmetric-sharpen-debiased-norm-cropped_T1w.nii.gz
@@ -30,10 +35,226 @@ def check_file(filepath, label, missing_list, bids_root):
         missing_list.append(relpath_from_cwd(filepath, bids_root))
         return False
 
-def run_command(cmd, dry_run=False):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True)
+def register_pair(ses_from, ses_to, args, bids_root, templates, brainmasks):
+    """Rigid + affine antsRegistration of ses_from onto ses_to (long/<ses_from>_to_<ses_to>_0GenericAffine.mat)."""
+    print(f"Registering {ses_from} → {ses_to}")
+    out_prefix = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_"
+    warped_prefix = f"{out_prefix}"+"desc-warped.nii.gz"
+    out_prefix.parent.mkdir(parents=True, exist_ok=True)
+
+    fixed_brainmask = brainmasks[ses_to]
+    moving_brainmask = brainmasks[ses_from]
+
+    # Retrieve fixed and moving images for each modality
+    fixed_images = {}
+    moving_images = {}
+    missing_modalities = False
+
+    for modality in args.template_modalities:
+        fixed = templates[ses_to].get(modality)
+        moving = templates[ses_from].get(modality)
+
+        if not fixed or not moving:
+            print(f"Missing modality {modality} for registration {ses_from} → {ses_to}")
+            missing_modalities = True
+
+        fixed_images[modality] = fixed
+        moving_images[modality] = moving
+
+    # Also check for brainmasks
+    if not fixed_brainmask or not moving_brainmask or missing_modalities:
+        print(f"Skipping registration {ses_from} → {ses_to} due to missing files")
+        return
+
+    # Start building the ANTs command
+    cmd = [
+        "antsRegistration", "--verbose", "1", "--dimensionality", "3", "--float", "0",
+        "--collapse-output-transforms", "1",
+        "--output", f"[{relpath_from_cwd(out_prefix)},{relpath_from_cwd(warped_prefix)}]",
+        "--interpolation", "Linear", "--use-histogram-matching", "0",
+        "--winsorize-image-intensities", "[0.005,0.995]",
+    ]
+
+    # Use T1w as reference for initial transform if available
+    ref_modality = "T1w" if "T1w" in fixed_images else args.template_modalities[0]
+
+    cmd += [
+        "--initial-moving-transform",
+        f"[{relpath_from_cwd(fixed_images[ref_modality])},{relpath_from_cwd(moving_images[ref_modality])},1]"
+    ]
+
+    # Rigid stage
+    cmd += ["--transform", "Rigid[0.1]"]
+    for modality in args.template_modalities:
+        cmd += [
+            "--metric",
+            f"MI[{relpath_from_cwd(fixed_images[modality])},{relpath_from_cwd(moving_images[modality])},1,32,Regular,0.25]"
+        ]
+    cmd += [
+        "--convergence", "[1000x500x250x100,1e-6,10]",
+        "--shrink-factors", "12x8x4x2",
+        "--smoothing-sigmas", "4x3x2x1vox",
+    ]
+
+    # Affine stage
+    cmd += ["--transform", "Affine[0.1]"]
+    for modality in args.template_modalities:
+        cmd += [
+            "--metric",
+            f"MI[{relpath_from_cwd(fixed_images[modality])},{relpath_from_cwd(moving_images[modality])},1,32,Regular,0.25]"
+        ]
+    cmd += [
+        "--convergence", "[1000x500x250x100,1e-6,10]",
+        "--shrink-factors", "12x8x4x2",
+        "--smoothing-sigmas", "4x3x2x1vox",
+    ]
+
+    # Run the command
+    run_command(cmd, dry_run=args.dry_run, session=f"{ses_from}_to_{ses_to}", step="register",
+                **job_options(args, bids_root, f"{ses_from}_to_{ses_to}_register"))
+
+def propagate_segmentation(ses_to, seg_path, args, bids_root, templates, warp_cache):
+    """Propagate the segmentation mask of the first session onto ses_to through the chain of pair affines."""
+    ref_ses = args.sessions[0]
+    long_dir = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long"
+
+    # affines of the pairs from the first session up to ses_to, the last pair first
+    cumulative_transforms = []
+    for i in range(args.sessions.index(ses_to)):
+        current_source, next_ses = args.sessions[i], args.sessions[i + 1]
+        affine = long_dir / f"{current_source}_to_{next_ses}_0GenericAffine.mat"
+        #warp = long_dir / f"{current_source}_to_{next_ses}_1Warp.nii.gz"
+        if not affine.exists() and not args.dry_run:
+            print(f"❌ Missing transforms for {current_source} → {next_ses}")
+            return
+        cumulative_transforms = [relpath_from_cwd(affine)] + cumulative_transforms
+
+    # Output path → template/sub-XXX/ses-Y/paper/sub-XXX_ses-Y_....nii.gz
+    seg_fname_out = f"sub-{args.template_name}_{ses_to}_{args.segmentation_mask_suffix}.nii.gz"
+    out_seg = (
+            bids_root
+            / "derivatives"
+            / "template"
+            / f"sub-{args.template_name}"
+            / ses_to
+            / args.template_path
+            / seg_fname_out
+    )
+    ref_T1w = templates[ses_to].get("T1w")
+
+    if not ref_T1w:
+        print(f"No T1w for session {ses_to}, skipping.")
+        return
+
+    out_seg.parent.mkdir(parents=True, exist_ok=True)
+
+    cmd = [
+        "antsApplyTransforms", "-d", "3",
+        "-i", relpath_from_cwd(seg_path),
+        "-r", relpath_from_cwd(ref_T1w),
+        "-o", relpath_from_cwd(out_seg),
+        "--interpolation", "NearestNeighbor",
+        "--verbose", "1"
+    ]
+
+    transforms = cumulative_transforms
+    if not args.no_warp_cache:
+        transforms = [warp_cache.get(f"{ref_ses}_to_{ses_to}_segmentation_affine", cumulative_transforms,
+                                     ref_T1w, threads=args.threads_per_job, dry_run=args.dry_run)]
+    for transform in transforms:
+        cmd += ["-t", transform]
+
+    run_command(cmd, dry_run=args.dry_run, session=ses_to, step="propagate_segmentation",
+                **job_options(args, bids_root, f"{ses_to}_propagate_segmentation"))
+
+def flirt_pair(ses_from, ses_to, args, bids_root):
+    """Stage 2: FLIRT rigid registration of the 3-axis masks of a pair, converted to an ANTs transform."""
+    print(f"FLIRT registration {ses_from} → {ses_to}")
+    options = job_options(args, bids_root, f"{ses_from}_to_{ses_to}_cacp_flirt")
+
+    from_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_{args.segmentation_mask_suffix}.nii.gz"
+    to_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_to / args.template_path / f"sub-{args.template_name}_{ses_to}_{args.segmentation_mask_suffix}.nii.gz"
+
+    flirt_mat = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_flirt.mat"
+    flirt_mat.parent.mkdir(parents=True, exist_ok=True)
+
+    flirt_out = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_flirt_warped.nii.gz"
+    flirt_out.parent.mkdir(parents=True, exist_ok=True)
+
+    # 1. FLIRT
+    cmd_flirt = [
+        "flirt", "-in", relpath_from_cwd(from_mask), "-ref",  relpath_from_cwd(to_mask),
+        "-o", relpath_from_cwd(flirt_out), "-omat", relpath_from_cwd(flirt_mat),
+        "-dof", "6",
+        "-searchrx", "-30", "30",
+        "-searchry", "0", "0",
+        "-searchrz", "0", "0",
+        "-v"
+    ]
+    run_command(cmd_flirt, dry_run=args.dry_run, session=f"{ses_from}_to_{ses_to}", step="cacp_flirt", **options)
+
+    # 2. Convert FLIRT matrix to ITK format
+    ants_mat = flirt_mat.with_name(flirt_mat.stem.replace(".mat", "") + "_ants_rig.mat")
+    # (same conversion as c3d_affine_tool -ref to -src from flirt.mat -fsl2ras -oitk, in-process)
+    if args.dry_run:
+        print(f"[DRY RUN] fsl2ras/oitk: {relpath_from_cwd(flirt_mat)} -> {relpath_from_cwd(ants_mat)}")
+    else:
+        fsl_to_itk(str(flirt_mat), str(ants_mat), str(from_mask), str(to_mask))
+
+    # 3. Apply transform using ANTs
+    ants_out = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_space-CACP_desc-3axis-mask.nii.gz"
+
+    cmd_apply = [
+        "antsApplyTransforms", "-d", "3",
+        "-i", relpath_from_cwd(from_mask),
+        "-o", relpath_from_cwd(ants_out),
+        "-r", relpath_from_cwd(to_mask),
+        "-t", relpath_from_cwd(ants_mat)
+    ]
+    run_command(cmd_apply, dry_run=args.dry_run, session=f"{ses_from}_to_{ses_to}", step="cacp_flirt", **options)
+
+def propagate_to_reference(src_ses, args, bids_root, warp_cache):
+    """Stage 3: propagate --contrasts_to_warp of src_ses into the reference (first) session using inverse transforms."""
+    reference_ses = args.sessions[0]
+    reference_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / reference_ses / args.template_path / f"sub-{args.template_name}_{reference_ses}_space-CACP_desc-3axis-mask.nii.gz"
+
+    src_idx = args.sessions.index(src_ses)
+    inverse_transforms = []
+
+    for i in reversed(range(0, src_idx)):
+        src_i = args.sessions[i + 1]
+        tgt_i = args.sessions[i]
+        mat_path = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{tgt_i}_to_{src_i}_flirt_ants_rig.mat"
+        inverse_transforms.append(f"[{str(mat_path)},1]")
+
+    # one composed affine instead of one transform per session hop
+    composed_transforms = inverse_transforms
+    if not args.no_warp_cache and args.contrasts_to_warp:
+        composed_transforms = [warp_cache.get(f"{src_ses}_to_{reference_ses}_flirt_ants_rig", inverse_transforms,
+                                              reference_mask, threads=args.threads_per_job, dry_run=args.dry_run)]
+
+    options = job_options(args, bids_root, f"{src_ses}_propagate_cacp") if args.contrasts_to_warp else {}
+    for modality in args.contrasts_to_warp or []:
+
+        src_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / src_ses / args.template_path / f"sub-{args.template_name}_{src_ses}_{modality}.nii.gz"
+        out_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / src_ses / args.template_path / f"sub-{args.template_name}_{src_ses}_space-CACP_{modality}.nii.gz"
+
+        print(f"\nPropagating modality '{modality}' from {src_ses} to {reference_ses}")
+        print(f"  ➤ Source image : {relpath_from_cwd(src_img)}")
+        print(f"  ➤ Target space : {relpath_from_cwd(reference_mask)}")
+        print(f"  ➤ Output       : {relpath_from_cwd(out_img)}")
+        print(f"  ➤ Applied inverse transforms:")
+        for tfm in inverse_transforms:
+            print(f"     - {tfm}")
+
+        cmd = [
+            "antsApplyTransforms", "-d", "3", "-i", str(src_img), "-o", str(out_img), "-r", str(reference_mask),
+            "--verbose", "1"
+        ]
+        for tfm in composed_transforms:
+            cmd += ["-t", tfm]
+
+        run_command(cmd, dry_run=args.dry_run, session=src_ses, step="propagate_cacp", **options)
 
 def main():
     parser = argparse.ArgumentParser(description="Register templates across sessions in CA-CP space")
@@ -47,14 +268,24 @@ def main():
     parser.add_argument("--segmentation_mask_suffix", help="Segmentation mask suffix")
     parser.add_argument("--compute-reg", action="store_true", default=False, help="compute registration")
     parser.add_argument("--contrasts_to_warp", nargs='*', help="Contrasts to warp in CA-CP space (")
+    parser.add_argument("--no-warp-cache", action="store_true",
+                        help="Pass the chain of transforms to antsApplyTransforms instead of one composed cached transform")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of session pairs registered concurrently, each with its own log in long/logs (default: 1)")
+    parser.add_argument("--threads-per-job", type=int, default=None,
+                        help="ITK threads of each job (default: number of CPUs / jobs)")
     parser.add_argument("--dry-run", action="store_true", help="Don't actually run commands")
 
     args = parser.parse_args()
+    if args.threads_per_job is None:
+        args.threads_per_job = max(1, (os.cpu_count() or 1) // max(1, args.jobs))
     #bids_root = Path(args.bids_root).resolve()
     bids_root = Path(args.bids_root)
     missing_files = []
     templates = {}
     brainmasks = {}
+    # chains of session transforms are composed once into long/cache (utils/warp_cache.py)
+    warp_cache = WarpCache(bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / "cache")
 
     print("\n=== Checking input files ===")
     for ses in args.sessions:
@@ -88,91 +319,21 @@ def main():
     else:
         print("\nAll required files found!")
 
+    # Each step is a task started as soon as the steps it depends on are done (--jobs at a time):
+    # pair registrations are independent, the segmentation of a session needs the registrations
+    # of the pairs before it, the FLIRT of a pair the segmentations of its two sessions, and
+    # Stage 3 of a session the FLIRT of the pairs before it.
+    pairs = list(zip(args.sessions[:-1], args.sessions[1:]))
+    tasks = {}
+
     if args.compute_reg:
-        print("\n=== compute registration ===")
-
-        for i in range(len(args.sessions) - 1):
-            ses_from = args.sessions[i]
-            ses_to = args.sessions[i + 1]
-
-            print(f"Registering {ses_from} → {ses_to}")
-            out_prefix = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_"
-            warped_prefix = f"{out_prefix}"+"desc-warped.nii.gz"
-            out_prefix.parent.mkdir(parents=True, exist_ok=True)
-
-            fixed_brainmask = brainmasks[ses_to]
-            moving_brainmask = brainmasks[ses_from]
-
-            # Retrieve fixed and moving images for each modality
-            fixed_images = {}
-            moving_images = {}
-            missing_modalities = False
-
-            for modality in args.template_modalities:
-                fixed = templates[ses_to].get(modality)
-                moving = templates[ses_from].get(modality)
-
-                if not fixed or not moving:
-                    print(f"Missing modality {modality} for registration {ses_from} → {ses_to}")
-                    missing_modalities = True
-
-                fixed_images[modality] = fixed
-                moving_images[modality] = moving
-
-            # Also check for brainmasks
-            if not fixed_brainmask or not moving_brainmask or missing_modalities:
-                print(f"Skipping registration {ses_from} → {ses_to} due to missing files")
-                continue
-
-            # Start building the ANTs command
-            cmd = [
-                "antsRegistration", "--verbose", "1", "--dimensionality", "3", "--float", "0",
-                "--collapse-output-transforms", "1",
-                "--output", f"[{relpath_from_cwd(out_prefix)},{relpath_from_cwd(warped_prefix)}]",
-                "--interpolation", "Linear", "--use-histogram-matching", "0",
-                "--winsorize-image-intensities", "[0.005,0.995]",
-            ]
-
-            # Use T1w as reference for initial transform if available
-            ref_modality = "T1w" if "T1w" in fixed_images else args.template_modalities[0]
-
-            cmd += [
-                "--initial-moving-transform",
-                f"[{relpath_from_cwd(fixed_images[ref_modality])},{relpath_from_cwd(moving_images[ref_modality])},1]"
-            ]
-
-            # Rigid stage
-            cmd += ["--transform", "Rigid[0.1]"]
-            for modality in args.template_modalities:
-                cmd += [
-                    "--metric",
-                    f"MI[{relpath_from_cwd(fixed_images[modality])},{relpath_from_cwd(moving_images[modality])},1,32,Regular,0.25]"
-                ]
-            cmd += [
-                "--convergence", "[1000x500x250x100,1e-6,10]",
-                "--shrink-factors", "12x8x4x2",
-                "--smoothing-sigmas", "4x3x2x1vox",
-            ]
-
-            # Affine stage
-            cmd += ["--transform", "Affine[0.1]"]
-            for modality in args.template_modalities:
-                cmd += [
-                    "--metric",
-                    f"MI[{relpath_from_cwd(fixed_images[modality])},{relpath_from_cwd(moving_images[modality])},1,32,Regular,0.25]"
-                ]
-            cmd += [
-                "--convergence", "[1000x500x250x100,1e-6,10]",
-                "--shrink-factors", "12x8x4x2",
-                "--smoothing-sigmas", "4x3x2x1vox",
-            ]
-
-            # Run the command
-            run_command(cmd, dry_run=args.dry_run)
+        print(f"\n=== compute registration ({args.jobs} job(s), {args.threads_per_job} ITK thread(s) each) ===")
 
-        if args.segmentation_mask_suffix:
-            print("\n=== Propagating segmentation mask ===")
+        for ses_from, ses_to in pairs:
+            tasks[f"register_{ses_from}_to_{ses_to}"] = (
+                set(), lambda f=ses_from, t=ses_to: register_pair(f, t, args, bids_root, templates, brainmasks))
 
+        if args.segmentation_mask_suffix:
             ref_ses = args.sessions[0]
             seg_fname_ref = f"sub-{args.template_name}_{ref_ses}_{args.segmentation_mask_suffix}.nii.gz"
             seg_path = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ref_ses / args.template_path / seg_fname_ref
@@ -180,156 +341,29 @@ def main():
             if not seg_path.exists():
                 print(f"Segmentation mask not found: {relpath_from_cwd(seg_path)}")
             else:
-                cumulative_transforms = []
-                current_source = ref_ses
-
-                for ses_to in args.sessions[1:]:
-                    # Transform files location (in sub-BaBa21/long/)
-                    transform_prefix = (
-                            bids_root
-                            / "derivatives"
-                            / "transforms"
-                            / f"sub-{args.template_name}"
-                            / "long"
-                            / f"{current_source}_to_{ses_to}_"
-                    )
-
-                    affine = transform_prefix.with_name(transform_prefix.name + "0GenericAffine.mat")
-                    warp = transform_prefix.with_name(transform_prefix.name + "1Warp.nii.gz")
-
-                    #if not (affine.exists() and warp.exists()):
-                    if not (affine.exists()):
-                        print(f"❌ Missing transforms for {current_source} → {ses_to}")
-                        break
-
-                    #cumulative_transforms = [relpath_from_cwd(warp), relpath_from_cwd(affine)] + cumulative_transforms
-                    cumulative_transforms = [relpath_from_cwd(affine)] + cumulative_transforms
-
-                    # Output path → template/sub-XXX/ses-Y/paper/sub-XXX_ses-Y_....nii.gz
-                    seg_fname_out = f"sub-{args.template_name}_{ses_to}_{args.segmentation_mask_suffix}.nii.gz"
-                    out_seg = (
-                            bids_root
-                            / "derivatives"
-                            / "template"
-                            / f"sub-{args.template_name}"
-                            / ses_to
-                            / args.template_path
-                            / seg_fname_out
-                    )
-                    ref_T1w = templates[ses_to].get("T1w")
-
-                    if not ref_T1w:
-                        print(f"No T2w for session {ses_to}, skipping.")
-                        continue
-
-                    out_seg.parent.mkdir(parents=True, exist_ok=True)
-
-                    cmd = [
-                        "antsApplyTransforms", "-d", "3",
-                        "-i", relpath_from_cwd(seg_path),
-                        "-r", relpath_from_cwd(ref_T1w),
-                        "-o", relpath_from_cwd(out_seg),
-                        "--interpolation", "NearestNeighbor",
-                        "--verbose", "1"
-                    ]
-
-                    for transform in cumulative_transforms:
-                        cmd += ["-t", transform]
-
-                    run_command(cmd, dry_run=args.dry_run)
-
-                    # Next step: propagate from this target
-                    current_source = ses_to
-
-        print("\n=== Stage 2: FLIRT rigid registration and ANTs transform ===")
-        for i in range(len(args.sessions) - 1):
-            ses_from = args.sessions[i]
-            ses_to = args.sessions[i + 1]
-
-            print(f"FLIRT registration {ses_from} → {ses_to}")
-
-            from_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_{args.segmentation_mask_suffix}.nii.gz"
-            to_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_to / args.template_path / f"sub-{args.template_name}_{ses_to}_{args.segmentation_mask_suffix}.nii.gz"
-
-            flirt_mat = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_flirt.mat"
-            flirt_mat.parent.mkdir(parents=True, exist_ok=True)
-
-            flirt_out = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{ses_from}_to_{ses_to}_flirt_warped.nii.gz"
-            flirt_out.parent.mkdir(parents=True, exist_ok=True)
-
-            # 1. FLIRT
-            cmd_flirt = [
-                "flirt", "-in", relpath_from_cwd(from_mask), "-ref",  relpath_from_cwd(to_mask),
-                "-o", relpath_from_cwd(flirt_out), "-omat", relpath_from_cwd(flirt_mat),
-                "-dof", "6",
-                "-searchrx", "-30", "30",
-                "-searchry", "0", "0",
-                "-searchrz", "0", "0",
-                "-v"
-            ]
-            run_command(cmd_flirt, dry_run=args.dry_run)
-
-            # 2. Convert FLIRT matrix to ITK format
-            ants_mat = flirt_mat.with_name(flirt_mat.stem.replace(".mat", "") + "_ants_rig.mat")
-            cmd_c3d = [
-                "c3d_affine_tool",
-                "-ref", relpath_from_cwd(to_mask),
-                "-src", relpath_from_cwd(from_mask),
-                relpath_from_cwd(flirt_mat),
-                "-fsl2ras",
-                "-oitk", relpath_from_cwd(ants_mat)
-            ]
-            run_command(cmd_c3d, dry_run=args.dry_run)
-
-            # 3. Apply transform using ANTs
-            ants_out = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / ses_from / args.template_path / f"sub-{args.template_name}_{ses_from}_space-CACP_desc-3axis-mask.nii.gz"
-
-            cmd_apply = [
-                "antsApplyTransforms", "-d", "3",
-                "-i", relpath_from_cwd(from_mask),
-                "-o", relpath_from_cwd(ants_out),
-                "-r", relpath_from_cwd(to_mask),
-                "-t", relpath_from_cwd(ants_mat)
-            ]
-            run_command(cmd_apply, dry_run=args.dry_run)
+                for k, ses_to in enumerate(args.sessions[1:], start=1):
+                    tasks[f"segmentation_{ses_to}"] = (
+                        {f"register_{f}_to_{t}" for f, t in pairs[:k]},
+                        lambda t=ses_to: propagate_segmentation(t, seg_path, args, bids_root, templates, warp_cache))
+
+        for ses_from, ses_to in pairs:
+            tasks[f"flirt_{ses_from}_to_{ses_to}"] = (
+                {f"segmentation_{ses_from}", f"segmentation_{ses_to}"},
+                lambda f=ses_from, t=ses_to: flirt_pair(f, t, args, bids_root))
     else:
         print("\n=== skip registration ===")
 
-    print("\n=== Stage 3: Propagate modalities into reference session using inverse transforms ===")
-    reference_ses = args.sessions[0]
-    reference_mask = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / reference_ses / args.template_path / f"sub-{args.template_name}_{reference_ses}_space-CACP_desc-3axis-mask.nii.gz"
-
-    for src_ses in args.sessions[1:]:
-        src_idx = args.sessions.index(src_ses)
-        inverse_transforms = []
+    for k, src_ses in enumerate(args.sessions[1:], start=1):
+        tasks[f"propagate_{src_ses}"] = (
+            {f"flirt_{f}_to_{t}" for f, t in pairs[:k]},
+            lambda s=src_ses: propagate_to_reference(s, args, bids_root, warp_cache))
 
-        for i in reversed(range(0, src_idx)):
-            src_i = args.sessions[i + 1]
-            tgt_i = args.sessions[i]
-            mat_path = bids_root / "derivatives" / "transforms" / f"sub-{args.template_name}" / "long" / f"{tgt_i}_to_{src_i}_flirt_ants_rig.mat"
-            inverse_transforms.append(f"[{str(mat_path)},1]")
-
-        for modality in args.contrasts_to_warp:
-
-            src_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / src_ses / args.template_path / f"sub-{args.template_name}_{src_ses}_{modality}.nii.gz"
-            out_img = bids_root / "derivatives" / "template" / f"sub-{args.template_name}" / src_ses / args.template_path / f"sub-{args.template_name}_{src_ses}_space-CACP_{modality}.nii.gz"
-
-            print(f"\nPropagating modality '{modality}' from {src_ses} to {reference_ses}")
-            print(f"  ➤ Source image : {relpath_from_cwd(src_img)}")
-            print(f"  ➤ Target space : {relpath_from_cwd(reference_mask)}")
-            print(f"  ➤ Output       : {relpath_from_cwd(out_img)}")
-            print(f"  ➤ Applied inverse transforms:")
-            for tfm in inverse_transforms:
-                print(f"     - {tfm}")
-
-            cmd = [
-                "antsApplyTransforms", "-d", "3", "-i", str(src_img), "-o", str(out_img), "-r", str(reference_mask),
-                "--verbose", "1"
-            ]
-            for tfm in inverse_transforms:
-                cmd += ["-t", tfm]
-
-            run_command(cmd, dry_run=args.dry_run)
+    failed = run_graph(tasks, args.jobs)
+    if failed:
+        print("\nSummary: failed steps:")
+        for name in failed:
+            print(" -", name)
+        exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,10 +1,14 @@
 import os
+import sys
 import argparse
-import subprocess
 from pathlib import Path
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, trace_tags
+from utils.flip import flip_lr
+
 
 def decompose_transformation(txt_file):
     """
@@ -38,16 +42,10 @@ def check_file(filepath, label, missing_list, bids_root):
         return False
 
 
-def run_command(cmd, dry_run=False):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True)
-
-
 def flip_anatomical_image(anat_path, flipped_path, dry_run):
     print(f"Flipping: {anat_path}")
-    run_command(["fslswapdim", anat_path, "-x", "y", "z", flipped_path], dry_run=dry_run)
-    run_command(["CopyImageHeaderInformation", anat_path, flipped_path, flipped_path, "1", "1", "1"], dry_run=dry_run)
+    if not dry_run:
+        flip_lr(anat_path, flipped_path)
 
 
 def average_images(img1, img2, output, dry_run):
@@ -278,21 +276,23 @@ def main():
     for ses_current in args.sessions:
         if args.compute_reg:
             print("\n=== compute registration ===")
-            symmetrize_session(ses_current, args, templates, bids_root, keep_tmp=args.keep_tmp)
+            with trace_tags(session=ses_current, step="symmetrize"):
+                symmetrize_session(ses_current, args, templates, bids_root, keep_tmp=args.keep_tmp)
         else:
             print("\n=== skip registration ===")
 
         print("\n=== Propagate symmetrization on other contrasts ===")
         if args.contrasts_to_sym:
-            propagate_symmetrization(
-                args.template_name,
-                ses_current,
-                args.template_path,
-                args.contrasts_to_sym,
-                bids_root,
-                args=args,
-                keep_tmp=args.keep_tmp
-            )
+            with trace_tags(session=ses_current, step="propagate"):
+                propagate_symmetrization(
+                    args.template_name,
+                    ses_current,
+                    args.template_path,
+                    args.contrasts_to_sym,
+                    bids_root,
+                    args=args,
+                    keep_tmp=args.keep_tmp
+                )
 
 
 if __name__ == "__main__":
@@ -8,6 +8,9 @@ import sys
 import csv
 import glob
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.bias_field import t1xt2_bias_correction
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Batch Debias BIDS T1w/T2w images using HCP script, saving outputs in BIDS derivatives folder."
@@ -26,7 +29,11 @@ def parse_args():
     )
     parser.add_argument(
         "--threads", type=int, default=12,
-        help="Number of threads for ITK/ANTs (default: 12)"
+        help="Number of threads for ITK/ANTs, and for the Gaussian filtering of the numpy engine (default: 12)"
+    )
+    parser.add_argument(
+        "--engine", choices=["fsl", "numpy"], default="fsl",
+        help="fsl: T1xT2BiasFieldCorrection.sh (default), numpy: in-memory bias field"
     )
 
     parser.add_argument("--brain_mask_suffix",
@@ -41,7 +48,10 @@ def parse_args():
         "--dry-run", action="store_true",
         help="Print commands without executing them"
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.k and args.engine == "numpy":
+        parser.error("--k keeps the temporary files of T1xT2BiasFieldCorrection.sh: the numpy engine writes none, use --engine fsl")
+    return args
 
 def find_input_mask(mask_input_dir, sub, ses, mask):
     pattern = f"{sub}_{ses}_{mask}.nii.gz"
@@ -137,14 +147,7 @@ def main():
                 print(f"\noutputs\n")
                 print(unbiased_T1w, unbiased_T2w)
 
-                cmd = [
-                    "postprocessing/T1xT2BiasFieldCorrection.sh",
-                    "-t1", T1w,
-                    "-t2", T2w,
-                    "-s", str(args.s_value),
-                    "-os", "_debiased"
-                ]
-
+                mask_path = None
                 if args.brain_mask_suffix:
                     input_mask = os.path.join(derivatives_seg, subj, sess,"anat",f"{subj}_{sess}_{brainmask}.nii.gz")
 
@@ -153,22 +156,36 @@ def main():
                     #input_mask = find_input_mask(derivatives_seg, subj, sess, brainmask)
                     print(input_mask)
                     if os.path.exists(input_mask):
-                        cmd.extend(["-b", input_mask])
+                        mask_path = input_mask
                     else:
-                        print(f"Warning: Brain mask file not found for session {sess}: {brain_mask}")
+                        print(f"Warning: Brain mask file not found for session {sess}: {input_mask}")
                         print("Skipping -b option for this session.")
 
-                if args.k:
-                    cmd.append("-k")
-
-                print(f"\nRunning command for {sess}:\n{' '.join(cmd)}\n")
+                if args.engine == "numpy":
+                    print(f"\nBias correction for {sess} (numpy engine)\n")
+                    t1xt2_bias_correction(T1w, T2w, args.s_value, mask_path, "_debiased",
+                                          threads=threads, dry_run=dry_run)
+                else:
+                    cmd = [
+                        "postprocessing/T1xT2BiasFieldCorrection.sh",
+                        "-t1", T1w,
+                        "-t2", T2w,
+                        "-s", str(args.s_value),
+                        "-os", "_debiased"
+                    ]
+                    if mask_path:
+                        cmd.extend(["-b", mask_path])
+                    if args.k:
+                        cmd.append("-k")
+
+                    print(f"\nRunning command for {sess}:\n{' '.join(cmd)}\n")
+                    if not dry_run:
+                        subprocess.run(cmd, check=True)
 
                 cmd_mv_T1w = ["mv", unbiased_tmp_T1w, unbiased_T1w]
                 cmd_mv_T2w = ["mv", unbiased_tmp_T2w, unbiased_T2w]
 
                 if not dry_run:
-                    subprocess.run(cmd, check=True)
-
                     subprocess.run(cmd_mv_T1w, check=True)
                     subprocess.run(cmd_mv_T2w, check=True)
 
@@ -6,6 +6,10 @@ import pandas as pd
 import subprocess
 import sys
 import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -25,7 +29,11 @@ def parse_args():
     )
     parser.add_argument(
         "--threads", type=int, default=12,
-        help="Number of threads for ITK/ANTs (default: 12)"
+        help="Number of threads for ITK/ANTs (default: 12). With --jobs, this is the total budget split across jobs"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of images denoised concurrently (default: 1)"
     )
     parser.add_argument(
         "--dry-run", action="store_true",
@@ -33,6 +41,45 @@ def parse_args():
     )
     return parser.parse_args()
 
+def denoised_filename(fname):
+    """
+    Build output filename with suffix '_desc-denoised' before modality and extension.
+    """
+    parts = fname.split("_")
+    modality_part = parts[-1]  # e.g. T1w.nii.gz
+    modality = modality_part.replace(".nii.gz", "")
+    return "_".join(parts[:-1] + [f"desc-denoised_{modality}.nii.gz"])
+
+def denoise_image(in_path, out_path, threads, dry_run=False):
+    """
+    Run ANTs DenoiseImage on a single volume.
+    Returns the output path, or "" if the command failed.
+    """
+    cmd = [
+        "DenoiseImage",
+        "-d", "3",
+        "-i", in_path,
+        "-o", out_path,
+        "-r", "3x3x3",
+        "-v"
+    ]
+
+    cmd_str = " ".join(cmd)
+    env = os.environ.copy()
+    env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
+
+    if dry_run:
+        print(f"[DRY RUN] {cmd_str} (threads={threads})")
+        return ""
+
+    try:
+        run_command(cmd, env=env, step="denoise", image=os.path.basename(in_path), threads=threads)
+        print(f"Denoised saved: {out_path}")
+        return out_path
+    except subprocess.CalledProcessError as e:
+        print(f"Error running DenoiseImage on {in_path}: {e}")
+        return ""
+
 def main():
     args = parse_args()
 
@@ -63,14 +110,21 @@ def main():
         print(f"Error: CSV must contain columns: {required_cols}")
         sys.exit(1)
 
+    jobs = max(1, args.jobs)
+    threads_per_job = max(1, threads // jobs)
+
     print(f"Found {len(df)} subject-session rows in {csv_path}")
-    print(f"Using {threads} threads for ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+    if jobs > 1:
+        print(f"Running {jobs} jobs with {threads_per_job} threads each for ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
+    else:
+        print(f"Using {threads} threads for ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS")
 
     # Base output derivatives folder
     derivatives_base = os.path.join(bids_root, "derivatives", "denoised")
 
-    # Collect lines for CSV output
+    # Collect lines for CSV output, one [T1w, T2w] entry per subject-session in input order
     csv_lines = []
+    tasks = []
 
     for idx, row in df.iterrows():
         subj = row["subject"]
@@ -87,52 +141,37 @@ def main():
         print(f"Processing: {anat_input_dir}")
         print(f"Output folder: {anat_output_dir}")
 
-        denoised_T1w = ""
-        denoised_T2w = ""
+        # Add a line even if one of the two is missing
+        line_idx = len(csv_lines)
+        csv_lines.append(["", ""])
 
         for fname in sorted(os.listdir(anat_input_dir)):
             if fname.endswith("_T1w.nii.gz") or fname.endswith("_T2w.nii.gz"):
                 in_path = os.path.join(anat_input_dir, fname)
-
-                # Build output filename with suffix '_desc-denoised' before modality and extension
-                parts = fname.split("_")
-                modality_part = parts[-1]  # e.g. T1w.nii.gz
-                modality = modality_part.replace(".nii.gz", "")
-                out_fname = "_".join(parts[:-1] + [f"desc-denoised_{modality}.nii.gz"])
-
-                out_path = os.path.join(anat_output_dir, out_fname)
-
-                cmd = [
-                    "DenoiseImage",
-                    "-d", "3",
-                    "-i", in_path,
-                    "-o", out_path,
-                    "-r", "3x3x3",
-                    "-v"
-                ]
-
-                cmd_str = " ".join(cmd)
-                env = os.environ.copy()
-                env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
-
-                if dry_run:
-                    print(f"[DRY RUN] {cmd_str} (threads={threads})")
-                else:
-                    print(f"Running: {cmd_str} (threads={threads})")
-                    try:
-                        subprocess.run(cmd, check=True, env=env)
-                        print(f"Denoised saved: {out_path}")
-
-                        if "_T1w" in fname:
-                            denoised_T1w = out_path
-                        elif "_T2w" in fname:
-                            denoised_T2w = out_path
-
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error running DenoiseImage on {in_path}: {e}")
-
-        # Add a line even if one of the two is missing
-        csv_lines.append([denoised_T1w, denoised_T2w])
+                out_path = os.path.join(anat_output_dir, denoised_filename(fname))
+                column = 0 if "_T1w" in fname else 1
+                tasks.append((line_idx, column, in_path, out_path))
+
+    results = [""] * len(tasks)
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(denoise_image, in_path, out_path, threads_per_job, dry_run): task_idx
+                for task_idx, (_, _, in_path, out_path) in enumerate(tasks)
+            }
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(f"Error: denoising job failed for {tasks[futures[future]][2]}: {e}")
+    else:
+        for task_idx, (_, _, in_path, out_path) in enumerate(tasks):
+            results[task_idx] = denoise_image(in_path, out_path, threads, dry_run)
+
+    # Fill the CSV lines in input order (last successful image wins, as in sorted folder order)
+    for (line_idx, column, _, _), out_path in zip(tasks, results):
+        if out_path:
+            csv_lines[line_idx][column] = out_path
 
     # Write the CSV output
     print(f"\nWriting CSV log to {output_csv_path}")
@@ -1,13 +1,15 @@
 import os
+import sys
 import argparse
-import subprocess
+import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
-import nibabel as nib
 
-def run_command(cmd, dry_run=False, env=None):
-    print("Running:", " ".join(map(str, cmd)))
-    if not dry_run:
-        subprocess.run(cmd, check=True, env=env)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.runner import run_command, trace_tags
+from utils.flip import flip_lr, virtual_flip_lr
+from utils.transforms import resample_volumes, flip_x_matrices, write_fsl_matrix, write_itk_affine
 
 def update_subjects_list(csv_path):
     df = pd.read_csv(csv_path)
@@ -18,6 +20,286 @@ def build_desc_str(descriptions):
         return "_".join(descriptions)
     return None
 
+# =====================
+# Per-subject manifest
+# =====================
+
+def file_signature(path):
+    """Return size and mtime of a file, used to detect stale steps."""
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime": st.st_mtime}
+
+def load_manifest(manifest_path):
+    """Load a step manifest, or return an empty one."""
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Failed to read manifest {manifest_path}: {e}")
+    return {"steps": {}}
+
+def save_manifest(manifest_path, manifest):
+    """Write the manifest atomically so that a crash never leaves it truncated."""
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+def step_is_current(manifest, name, inputs, outputs, params):
+    """
+    A step is up to date if it was recorded with the same parameters and outputs,
+    its inputs still have the recorded size and mtime, and all outputs exist.
+    """
+    record = manifest["steps"].get(name)
+    if not record:
+        return False
+    if record.get("params") != params or record.get("outputs") != list(outputs):
+        return False
+    if not all(os.path.exists(p) for p in outputs):
+        return False
+    for path in inputs:
+        if not os.path.exists(path) or record["inputs"].get(path) != file_signature(path):
+            return False
+    return True
+
+def run_step(manifest, manifest_path, name, inputs, outputs, params, action, dry_run=False, force=False):
+    """
+    Run action() unless the manifest shows the step is already done with unchanged inputs,
+    then record the step (inputs size/mtime, outputs, parameters) in the manifest.
+    """
+    outputs = [str(p) for p in outputs]
+    if not force and step_is_current(manifest, name, inputs, outputs, params):
+        print(f"Step '{name}' up to date, skipping.")
+        return
+    with trace_tags(step=name):
+        action()
+    if dry_run:
+        return
+    manifest["steps"][name] = {
+        "inputs": {path: file_signature(path) for path in inputs},
+        "outputs": outputs,
+        "params": params
+    }
+    save_manifest(manifest_path, manifest)
+
+def command_step(manifest, manifest_path, name, inputs, outputs, cmds, dry_run=False, env=None, force=False):
+    """Run a list of commands as a single manifest step."""
+    def action():
+        for cmd in cmds:
+            run_command(cmd, dry_run, env)
+    params = [[str(c) for c in cmd] for cmd in cmds]
+    run_step(manifest, manifest_path, name, inputs, outputs, params, action, dry_run, force)
+
+def write_flip_matrix(haiko_template_pad, flip_fsl_mat, flip_ants_mat):
+    """Write the FSL and ITK matrices flipping the padded Haiko template along x."""
+    print("Generating flipped x matrix from padded Haiko template...")
+    fsl_matrix, itk_transform = flip_x_matrices(haiko_template_pad)
+    for row in fsl_matrix:
+        print(" ".join(f"{value: .10f}" for value in row))
+
+    write_fsl_matrix(flip_fsl_mat, fsl_matrix)
+    print(f"Matrix FSL saved : {flip_fsl_mat}")
+    write_itk_affine(flip_ants_mat, itk_transform)
+    print(f"Matrix ITK saved : {flip_ants_mat}")
+
+def process_subject(sub, ses, config):
+    """Realign one subject/session, tagging the traced commands with its labels."""
+    with trace_tags(subject=sub, session=ses):
+        realign_subject(sub, ses, config)
+
+def realign_subject(sub, ses, config):
+    """
+    Register one subject/session to the padded Haiko template and warp (and optionally flip)
+    its contrasts and tissue masks. Completed steps are recorded in a JSON manifest under
+    derivatives/transforms/<sub>/<ses>/ so that a re-run only does missing or stale steps.
+    """
+    print(f"Processing {sub} {ses}")
+
+    dry_run = config["dry_run"]
+    force = config["force"]
+    bids_root = config["bids_root"]
+    derivatives_dir = config["derivatives_dir"]
+    haiko_template_pad = config["haiko_template_pad"]
+    desc_str = config["desc_str"]
+
+    anat_dir = os.path.join(config["input_dir"], f"{sub}", f"{ses}", "anat")
+    suffix = f"_desc-{desc_str}" if desc_str else ""
+
+    t1w_in = os.path.join(anat_dir, f"{sub}_{ses}{suffix}_T1w.nii.gz")
+    t2w_in = os.path.join(anat_dir, f"{sub}_{ses}{suffix}_T2w.nii.gz")
+
+    if not os.path.exists(t1w_in) or not os.path.exists(t2w_in):
+        print(f"Warning: Missing denoised T1w or T2w for {sub} {ses}, skipping.")
+        return
+
+    # SUBJECT BRAINMASK (must exist)
+    subject_brainmask = os.path.join(derivatives_dir, "segmentation",
+        sub, ses, "anat", f"{sub}_{ses}_space-orig_desc-brain_mask.nii.gz"
+    )
+
+    if not os.path.exists(subject_brainmask):
+        print(f"Warning: Brainmask not found for {sub} {ses}: {subject_brainmask}. Skipping.")
+        return
+
+    transforms_dir = os.path.join(derivatives_dir, "transforms", f"{sub}", f"{ses}")
+    os.makedirs(transforms_dir, exist_ok=True)
+
+    output_dir = os.path.join(derivatives_dir, config["output_derivatives"], f"{sub}", f"{ses}")
+    #output_dir = os.path.join(derivatives_dir, "warped", f"{sub}", f"{ses}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_path = os.path.join(transforms_dir, f"{sub}_{ses}_realign_manifest.json")
+    manifest = load_manifest(manifest_path)
+
+    def step(name, inputs, outputs, cmds, env=None):
+        command_step(manifest, manifest_path, name, inputs, outputs, cmds, dry_run, env, force)
+
+    transfo_prefix = os.path.join(transforms_dir, f"{sub}_{ses}_from-native_to-Haiko89_rigid")
+    transfo_affine = f"{transfo_prefix}0GenericAffine.mat"
+
+    output_t1w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_T1w.nii.gz")
+    output_t2w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_T2w.nii.gz")
+
+    t1w_in_masked = os.path.join(anat_dir, f"{sub}_{ses}_desc-masked_T1w.nii.gz")
+
+    if config["generate_brainmask"]:
+        print("Generating Haiko brainmask TPM by combining CSF, GM, WM and thresholding...")
+        step("mask_T1w", [t1w_in, subject_brainmask], [t1w_in_masked], [[
+            "fslmaths", t1w_in,
+            "-mul", subject_brainmask,
+            t1w_in_masked
+        ]])
+
+
+    antsreg_cmd = [
+        "antsRegistration",
+        "--verbose", "1",
+        "--dimensionality", "3",
+        "--initial-moving-transform" ,f"[{haiko_template_pad},{t1w_in_masked},1]",
+        "--float", "0",
+        "--collapse-output-transforms", "1",
+        "--output", f"[{transfo_prefix}]",
+        "--interpolation", "Linear",
+        "--use-histogram-matching", "0",
+        "--winsorize-image-intensities", "[0.005,0.995]",
+        "--transform", "Rigid[0.1]",
+        "--metric", f"MI[{haiko_template_pad},{t1w_in_masked},1,32,Regular,0.25 ]",
+        "--convergence", "[1000x500x250x0,1e-6,10]",
+        "--shrink-factors", "8x4x2x1",
+        "--smoothing-sigmas", "3x2x1x0vox"
+    ]
+
+    env = os.environ.copy()
+    env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(config["threads"])
+    step("register", [haiko_template_pad, t1w_in_masked], [transfo_affine], [antsreg_cmd], env)
+
+    # SUBJECT 3 TISSUES (must exist)
+    segmentation_dir = os.path.join(bids_root, "derivatives", "segmentation", sub, ses, "anat")
+    subject_tissues = {
+        "WM": os.path.join(segmentation_dir, f"{sub}_{ses}_space-orig_label-WM_mask.nii.gz"),
+        "GM": os.path.join(segmentation_dir, f"{sub}_{ses}_space-orig_label-GM_mask.nii.gz"),
+        "CSF": os.path.join(segmentation_dir, f"{sub}_{ses}_space-orig_label-CSF_mask.nii.gz"),
+        "BM": os.path.join(segmentation_dir, f"{sub}_{ses}_space-orig_desc-brain_mask.nii.gz")
+    }
+    tissues_found = True
+    for tissue, tissue_path in subject_tissues.items():
+        if not os.path.exists(tissue_path):
+            print(f"Warning: {tissue} mask not found for {sub} {ses}: {tissue_path}. Skipping.")
+            tissues_found = False
+            break
+
+    output_wm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-WM_mask.nii.gz")
+    output_gm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-GM_mask.nii.gz")
+    output_csf = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-CSF_mask.nii.gz")
+    output_bm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_brain_mask.nii.gz")
+
+    ##"NearestNeighbor" or  "Linear" ?
+    ##"label-CSF_mask" or  "CSF_probseg" ?
+
+    resample_jobs = [("apply_T1w", t1w_in, output_t1w, "Linear"),
+                     ("apply_T2w", t2w_in, output_t2w, "Linear")]
+    if tissues_found:
+        resample_jobs += [("apply_WM", subject_tissues["WM"], output_wm, "NearestNeighbor"),
+                          ("apply_GM", subject_tissues["GM"], output_gm, "NearestNeighbor"),
+                          ("apply_CSF", subject_tissues["CSF"], output_csf, "NearestNeighbor"),
+                          ("apply_BM", subject_tissues["BM"], output_bm, "NearestNeighbor")]
+
+    if config["resampler"] == "python":
+        # one pass: the affine and the reference grid are read once for all volumes
+        volumes = [(vol_in, vol_out, interpolation) for _, vol_in, vol_out, interpolation in resample_jobs]
+
+        def resample():
+            print(f"Resampling {len(volumes)} volumes to {haiko_template_pad} ({config['threads']} threads)")
+            if not dry_run:
+                resample_volumes(volumes, haiko_template_pad, transfo_affine, threads=config["threads"])
+
+        run_step(manifest, manifest_path, "resample",
+                 [vol_in for vol_in, _, _ in volumes] + [haiko_template_pad, transfo_affine],
+                 [vol_out for _, vol_out, _ in volumes], [["python"] + list(v) for v in volumes],
+                 resample, dry_run, force)
+    else:
+        for name, vol_in, vol_out, interpolation in resample_jobs:
+            antsapply_cmd = [
+                "antsApplyTransforms", "-d", "3",
+                "-i", vol_in, "-r", haiko_template_pad, "-o", vol_out,
+                "-t", transfo_affine, "--interpolation", interpolation
+            ]
+            step(name, [vol_in, haiko_template_pad, transfo_affine], [vol_out], [antsapply_cmd], env)
+
+    if config["padding"]:
+        transfo_output_mat = os.path.join(transforms_dir, f"{sub}_{ses}_from-Haiko89_flip-x_fsl.mat")
+        transfo_output_ants_mat = os.path.join(transforms_dir, f"{sub}_{ses}_from-Haiko89_flip-x_ants.mat")
+
+        # the matrices only depend on the padded template: computed once in main(), copied here
+        def flip_matrix():
+            print(f"Copying flip-x matrices to {transforms_dir}")
+            if not dry_run:
+                shutil.copyfile(config["flip_fsl_mat"], transfo_output_mat)
+                shutil.copyfile(config["flip_ants_mat"], transfo_output_ants_mat)
+
+        run_step(manifest, manifest_path, "flip_matrix", [config["flip_fsl_mat"], config["flip_ants_mat"]],
+                 [transfo_output_mat, transfo_output_ants_mat], ["copy"],
+                 flip_matrix, dry_run, force)
+
+    if not tissues_found:
+        return
+
+    # -----------------------------
+    # Optionally flip Left/Right
+    # -----------------------------
+    if config["flipping_LR"]:
+        print("Flipping outputs Left-Right...")
+        flip = virtual_flip_lr if config["virtual_flip"] else flip_lr
+
+        def flip_step(name, warped, flipped):
+            def action():
+                print(f"Flipping ({flip.__name__}): {warped} -> {flipped}")
+                if not dry_run:
+                    flip(warped, flipped)
+            run_step(manifest, manifest_path, name, [warped], [flipped], [flip.__name__],
+                     action, dry_run, force)
+
+        flipped_t1w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T1w.nii.gz")
+        flipped_t2w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T2w.nii.gz")
+
+        # tissues
+        flipped_wm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-WM_mask.nii.gz")
+        flipped_gm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-GM_mask.nii.gz")
+        flipped_csf = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-CSF_mask.nii.gz")
+        flipped_bm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_brain_mask.nii.gz")
+
+        # T1w, T2w and tissues flip
+        for name, warped, flipped in [("flip_T1w", output_t1w, flipped_t1w),
+                                      ("flip_T2w", output_t2w, flipped_t2w),
+                                      ("flip_WM", output_wm, flipped_wm),
+                                      ("flip_GM", output_gm, flipped_gm),
+                                      ("flip_CSF", output_csf, flipped_csf),
+                                      ("flip_BM", output_bm, flipped_bm)]:
+            flip_step(name, warped, flipped)
+
+        print(f"Flipped images saved")
+
 def main():
     parser = argparse.ArgumentParser(description="Register BIDS subjects T1w/T2w to Haiko89 template using ANTs")
     parser.add_argument('--bids_root', required=True, help="Root directory of BIDS dataset")
@@ -31,8 +313,12 @@ def main():
     parser.add_argument('--pad_size', type=int, default=50, help="Padding size in pixels (default: 50)")
     parser.add_argument('--generate_brainmask', action='store_true', help="Generate brainmask TPM from Haiko TPMs")
     parser.add_argument('--flipping_LR', action='store_true', default=False, help="Flip warped T1w/T2w images Left-Right (default: False)")
+    parser.add_argument('--virtual_flip', action='store_true', default=False, help="With --flipping_LR, only mirror the header affine instead of the voxel data (for consumers that resample)")
     parser.add_argument('--dry-run', action="store_true", help="Print commands without executing them")
-    parser.add_argument('--threads', type=int, default=12, help="Number of threads for ITK/ANTs (default: 12)")
+    parser.add_argument('--threads', type=int, default=12, help="Number of threads for ITK/ANTs (default: 12). With --jobs, this is the total budget split across jobs")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of subjects/sessions processed concurrently (default: 1)")
+    parser.add_argument('--force', action='store_true', help="Ignore the per-subject manifests and re-run every step")
+    parser.add_argument('--resampler', choices=["python", "ants"], default="python", help="python: resample T1w, T2w and tissue masks in a single pass (default), ants: one antsApplyTransforms call per volume")
 
     args = parser.parse_args()
 
@@ -42,6 +328,7 @@ def main():
     pad_size = args.pad_size
     resolution = args.resolution
     desc_str = build_desc_str(args.bids_description)
+    jobs = max(1, args.jobs)
 
     derivatives_dir =  os.path.join(bids_root, "derivatives")
     haiko_sub_dir = os.path.join(derivatives_dir, "atlas", "sub-Haiko89", "ses-Adult", "anat")
@@ -68,38 +355,56 @@ def main():
     print(f"WM TPM: {haiko_wm}")
     print(f"Brainmask TPM: {haiko_brainmask}")
 
+    # Template preparation steps are recorded like a subject, under transforms/sub-Haiko89/ses-Adult
+    haiko_transforms_dir = os.path.join(derivatives_dir, "transforms", "sub-Haiko89", "ses-Adult")
+    os.makedirs(haiko_transforms_dir, exist_ok=True)
+    haiko_manifest_path = os.path.join(haiko_transforms_dir, f"{prefix}_realign_manifest.json")
+    haiko_manifest = load_manifest(haiko_manifest_path)
+
     if args.padding:
         print("Generating padded Haiko template...")
-        run_command([
+        command_step(haiko_manifest, haiko_manifest_path, "pad_template", [haiko_template], [haiko_template_pad], [[
             "ImageMath", "3",
             haiko_template_pad,
             "PadImage",
             haiko_template,
             str(pad_size)
-        ], dry_run)
+        ]], dry_run, force=args.force)
     else:
         if not os.path.exists(haiko_template_pad):
             raise FileNotFoundError(f"Padded template not found: {haiko_template_pad}. Use --padding to create it.")
 
     if args.resolution:
         print(f"Resampling padded Haiko template to {resolution}mm iso resolution...")
-        run_command([
+        command_step(haiko_manifest, haiko_manifest_path, "resample_template", [haiko_template_pad], [haiko_template_pad], [[
             "mri_convert", "-i",
             haiko_template_pad,
             "-o",
             haiko_template_pad,
             "-vs", f"{resolution}", f"{resolution}",f"{resolution}"
-        ], dry_run)
+        ]], dry_run, force=args.force)
+
+    flip_fsl_mat = os.path.join(haiko_transforms_dir, f"{prefix}-padded_flip-x_fsl.mat")
+    flip_ants_mat = os.path.join(haiko_transforms_dir, f"{prefix}-padded_flip-x_ants.mat")
+    if args.padding:
+        def template_flip_matrix():
+            if dry_run:
+                print(f"[DRY RUN] flip-x matrices: {flip_fsl_mat}, {flip_ants_mat}")
+            else:
+                write_flip_matrix(haiko_template_pad, flip_fsl_mat, flip_ants_mat)
+        run_step(haiko_manifest, haiko_manifest_path, "flip_matrix", [haiko_template_pad],
+                 [flip_fsl_mat, flip_ants_mat], ["flip_x_matrices"], template_flip_matrix,
+                 dry_run, args.force)
 
     if args.generate_brainmask:
         print("Generating Haiko brainmask TPM by combining CSF, GM, WM and thresholding...")
-        run_command([
+        command_step(haiko_manifest, haiko_manifest_path, "brainmask_template", [haiko_csf, haiko_gm, haiko_wm], [haiko_brainmask], [[
             "fslmaths", haiko_csf,
             "-add", haiko_gm,
             "-add", haiko_wm,
             "-thr", "0.5",
             "-bin", haiko_brainmask
-        ], dry_run)
+        ]], dry_run, force=args.force)
     else:
         if not os.path.exists(haiko_brainmask):
             print(f"Warning: Brainmask not found: {haiko_brainmask}. Use --generate_brainmask to create it.")
@@ -110,230 +415,50 @@ def main():
         print("No subjects/sessions to process.")
         return
 
-    for sub, ses in subjects:
-        print(f"Processing {sub} {ses}")
-
-        #input_dir
-
-        anat_dir = os.path.join(input_dir, f"{sub}", f"{ses}", "anat")
-        suffix = f"_desc-{desc_str}" if desc_str else ""
-
-        t1w_in = os.path.join(anat_dir, f"{sub}_{ses}{suffix}_T1w.nii.gz")
-        t2w_in = os.path.join(anat_dir, f"{sub}_{ses}{suffix}_T2w.nii.gz")
-
-        if not os.path.exists(t1w_in) or not os.path.exists(t2w_in):
-            print(f"Warning: Missing denoised T1w or T2w for {sub} {ses}, skipping.")
-            continue
-
-        # SUBJECT BRAINMASK (must exist)
-        subject_brainmask = os.path.join(derivatives_dir, "segmentation",
-            sub, ses, "anat", f"{sub}_{ses}_space-orig_desc-brain_mask.nii.gz"
-        )
-
-        if not os.path.exists(subject_brainmask):
-            print(f"Warning: Brainmask not found for {sub} {ses}: {subject_brainmask}. Skipping.")
-            continue
-
-        transforms_dir = os.path.join(derivatives_dir, "transforms", f"{sub}", f"{ses}")
-        os.makedirs(transforms_dir, exist_ok=True)
-
-        output_dir = os.path.join(derivatives_dir, args.output_derivatives, f"{sub}", f"{ses}")
-        #output_dir = os.path.join(derivatives_dir, "warped", f"{sub}", f"{ses}")
-        os.makedirs(output_dir, exist_ok=True)
-
-        transfo_prefix = os.path.join(transforms_dir, f"{sub}_{ses}_from-native_to-Haiko89_rigid")
-
-        output_t1w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_T1w.nii.gz")
-        output_t2w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_T2w.nii.gz")
-
-        t1w_in_masked = os.path.join(anat_dir, f"{sub}_{ses}_desc-masked_T1w.nii.gz")
-
-        if args.generate_brainmask:
-            print("Generating Haiko brainmask TPM by combining CSF, GM, WM and thresholding...")
-            run_command([
-                "fslmaths", t1w_in,
-                "-mul", subject_brainmask,
-                t1w_in_masked
-            ], dry_run)
-
-
-        antsreg_cmd = [
-            "antsRegistration",
-            "--verbose", "1",
-            "--dimensionality", "3",
-            "--initial-moving-transform" ,f"[{haiko_template_pad},{t1w_in_masked},1]",
-            "--float", "0",
-            "--collapse-output-transforms", "1",
-            "--output", f"[{transfo_prefix}]",
-            "--interpolation", "Linear",
-            "--use-histogram-matching", "0",
-            "--winsorize-image-intensities", "[0.005,0.995]",
-            "--transform", "Rigid[0.1]",
-            "--metric", f"MI[{haiko_template_pad},{t1w_in_masked},1,32,Regular,0.25 ]",
-            "--convergence", "[1000x500x250x0,1e-6,10]",
-            "--shrink-factors", "8x4x2x1",
-            "--smoothing-sigmas", "3x2x1x0vox"
-        ]
-
-        env = os.environ.copy()
-        env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(threads)
-        run_command(antsreg_cmd, dry_run, env)
-
-        antsapply_cmd = [
-            "antsApplyTransforms",
-            "-d", "3",
-            "-i", t1w_in,
-            "-r", haiko_template_pad,
-            "-o", output_t1w,
-            "-t", f"{transfo_prefix}0GenericAffine.mat",
-            "--interpolation", "Linear"
-        ]
-
-        run_command(antsapply_cmd, dry_run, env)
-
-        antsapply_cmd = [
-            "antsApplyTransforms",
-            "-d", "3",
-            "-i", t2w_in,
-            "-r", haiko_template_pad,
-            "-o", output_t2w,
-            "-t", f"{transfo_prefix}0GenericAffine.mat",
-            "--interpolation", "Linear"
-        ]
-
-        run_command(antsapply_cmd, dry_run, env)
-
-        if args.padding:
-            print("Generating flipped x matrix from padded Haiko template...")
-            img = nib.load(haiko_template_pad)
-            header = img.header
-            res_x = header.get_zooms()[0]
-            width = img.shape[0]
-            translation_x = (width * res_x) - res_x
-            matrix = [
-                [-1.0, 0.0, 0.0, translation_x],
-                [0.0, 1.0, 0.0, 0.0],
-                [0.0, 0.0, 1.0, 0.0],
-                [0.0, 0.0, 0.0, 1.0]
-            ]
-            for row in matrix:
-                print(" ".join(f"{value: .10f}" for value in row))
-
-            transfo_output_mat = os.path.join(transforms_dir, f"{sub}_{ses}_from-Haiko89_flip-x_fsl.mat")
-            with open(transfo_output_mat, "w") as f:
-                for row in matrix:
-                    f.write(" ".join(f"{val:.10f}" for val in row) + "\n")
-
-            print(f"Matrix FSL saved : {transfo_output_mat}")
-
-            transfo_output_ants_mat = os.path.join(transforms_dir, f"{sub}_{ses}_from-Haiko89_flip-x_ants.mat")
-
-            convert_transfo_cmd = [
-                "c3d_affine_tool",
-                "-ref", f"{haiko_template_pad}",
-                "-src", f"{haiko_template_pad}",
-                f"{transfo_output_mat}",
-                "-fsl2ras", "-oitk", f"{transfo_output_ants_mat}"
-            ]
-
-            run_command(convert_transfo_cmd, dry_run, env)
-
-        # SUBJECT 3 TISSUES (must exist)
-        subject_wm = os.path.join(bids_root, "derivatives", "segmentation",
-            sub, ses, "anat", f"{sub}_{ses}_space-orig_label-WM_mask.nii.gz"
-        )
-        if not os.path.exists(subject_wm):
-            print(f"Warning: wm mask not found for {sub} {ses}: {subject_wm}. Skipping.")
-            continue
-        subject_gm = os.path.join(bids_root, "derivatives", "segmentation",
-            sub, ses, "anat", f"{sub}_{ses}_space-orig_label-GM_mask.nii.gz"
-        )
-        if not os.path.exists(subject_gm):
-            print(f"Warning: wm mask not found for {sub} {ses}: {subject_gm}. Skipping.")
-            continue
-        subject_csf = os.path.join(bids_root, "derivatives", "segmentation",
-            sub, ses, "anat", f"{sub}_{ses}_space-orig_label-CSF_mask.nii.gz"
-        )
-        if not os.path.exists(subject_csf):
-            print(f"Warning: csf mask not found for {sub} {ses}: {subject_csf}. Skipping.")
-            continue
-        subject_bm = os.path.join(bids_root, "derivatives", "segmentation",
-                                   sub, ses, "anat", f"{sub}_{ses}_space-orig_desc-brain_mask.nii.gz"
-                                   )
-        if not os.path.exists(subject_bm):
-            print(f"Warning: csf mask not found for {sub} {ses}: {subject_bm}. Skipping.")
-            continue
-
-        output_wm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-WM_mask.nii.gz")
-        output_gm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-GM_mask.nii.gz")
-        output_csf = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_label-CSF_mask.nii.gz")
-        output_bm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-warped_brain_mask.nii.gz")
-
-        ##"NearestNeighbor" or  "Linear" ?
-        ##"label-CSF_mask" or  "CSF_probseg" ?
-
-        antsapply_cmd = [
-            "antsApplyTransforms", "-d", "3",
-            "-i", subject_wm, "-r", haiko_template_pad, "-o", output_wm,
-            "-t", f"{transfo_prefix}0GenericAffine.mat", "--interpolation", "NearestNeighbor"
-        ]
-        run_command(antsapply_cmd, dry_run, env)
-        antsapply_cmd = [
-            "antsApplyTransforms", "-d", "3",
-            "-i", subject_gm, "-r", haiko_template_pad, "-o", output_gm,
-            "-t", f"{transfo_prefix}0GenericAffine.mat", "--interpolation", "NearestNeighbor"
-        ]
-        run_command(antsapply_cmd, dry_run, env)
-        antsapply_cmd = [
-            "antsApplyTransforms", "-d", "3",
-            "-i", subject_csf, "-r", haiko_template_pad, "-o", output_csf,
-            "-t", f"{transfo_prefix}0GenericAffine.mat", "--interpolation", "NearestNeighbor"
-        ]
-        run_command(antsapply_cmd, dry_run, env)
-
-        antsapply_cmd = [
-            "antsApplyTransforms", "-d", "3",
-            "-i", subject_bm, "-r", haiko_template_pad, "-o", output_bm,
-            "-t", f"{transfo_prefix}0GenericAffine.mat", "--interpolation", "NearestNeighbor"
-        ]
-        run_command(antsapply_cmd, dry_run, env)
-
-        # -----------------------------
-        # Optionally flip Left/Right
-        # -----------------------------
-        if args.flipping_LR:
-            print("Flipping outputs Left-Right...")
-
-            flipped_t1w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T1w.nii.gz")
-            flipped_t2w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T2w.nii.gz")
-
-            # T1w flip
-            run_command([ "fslswapdim", output_t1w, "-x", "y", "z", flipped_t1w ], dry_run)
-            run_command(["CopyImageHeaderInformation",output_t1w, flipped_t1w, flipped_t1w,"1","1","1"], dry_run)
-            # T2w flip
-            run_command([ "fslswapdim", output_t2w, "-x", "y", "z", flipped_t2w], dry_run)
-            run_command(["CopyImageHeaderInformation",output_t2w, flipped_t2w, flipped_t2w,"1","1","1"], dry_run)
-
-            flipped_t1w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T1w.nii.gz")
-            flipped_t2w = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_T2w.nii.gz")
-
-            # tissues
-            flipped_wm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-WM_mask.nii.gz")
-            flipped_gm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-GM_mask.nii.gz")
-            flipped_csf = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_label-CSF_mask.nii.gz")
-            flipped_bm = os.path.join(output_dir, f"{sub}_{ses}_space-Haiko89_desc-flipped_brain_mask.nii.gz")
-
-            # Tissues flip
-            run_command(["fslswapdim", output_wm, "-x", "y", "z", flipped_wm], dry_run)
-            run_command(["CopyImageHeaderInformation", output_wm, flipped_wm, flipped_wm, "1", "1", "1"], dry_run)
-            run_command(["fslswapdim", output_gm, "-x", "y", "z", flipped_gm], dry_run)
-            run_command(["CopyImageHeaderInformation", output_gm, flipped_gm, flipped_gm, "1", "1", "1"], dry_run)
-            run_command(["fslswapdim", output_csf, "-x", "y", "z", flipped_csf], dry_run)
-            run_command(["CopyImageHeaderInformation", output_csf, flipped_csf, flipped_csf, "1", "1", "1"], dry_run)
-            run_command(["fslswapdim", output_bm, "-x", "y", "z", flipped_bm], dry_run)
-            run_command(["CopyImageHeaderInformation", output_bm, flipped_bm, flipped_bm, "1", "1", "1"], dry_run)
-
-            print(f"Flipped images saved")
+    config = {
+        "bids_root": bids_root,
+        "derivatives_dir": derivatives_dir,
+        "input_dir": input_dir,
+        "output_derivatives": args.output_derivatives,
+        "desc_str": desc_str,
+        "haiko_template_pad": haiko_template_pad,
+        "generate_brainmask": args.generate_brainmask,
+        "padding": args.padding,
+        "flipping_LR": args.flipping_LR,
+        "virtual_flip": args.virtual_flip,
+        "resampler": args.resampler,
+        "flip_fsl_mat": flip_fsl_mat,
+        "flip_ants_mat": flip_ants_mat,
+        "threads": max(1, threads // jobs),
+        "dry_run": dry_run,
+        "force": args.force
+    }
+
+    failed = []
+    if jobs > 1 and len(subjects) > 1:
+        print(f"Processing {len(subjects)} subjects/sessions with {jobs} jobs ({config['threads']} threads each)")
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(process_subject, sub, ses, config): (sub, ses) for sub, ses in subjects}
+            for future in as_completed(futures):
+                sub, ses = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error: processing failed for {sub} {ses}: {e}")
+                    failed.append((sub, ses))
+    else:
+        for sub, ses in subjects:
+            try:
+                process_subject(sub, ses, config)
+            except Exception as e:
+                print(f"Error: processing failed for {sub} {ses}: {e}")
+                failed.append((sub, ses))
+
+    if failed:
+        print(f"\n{len(failed)} subject(s)/session(s) failed, re-run to resume from the last completed step:")
+        for sub, ses in failed:
+            print(f" - {sub} {ses}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1 @@
+"""Shared helpers for the BABACOOL preprocessing and postprocessing scripts."""
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+T1xT2 bias field correction in memory.
+
+Same algorithm as postprocessing/T1xT2BiasFieldCorrection.sh (sqrt(|T1w x T2w|) normalized by
+its mean, smoothed, modulated, thresholded at mean - std/2, eroded, extrapolated and smoothed
+again into a bias field dividing T1w and T2w), with the same -s, -b and -os semantics, but
+computed on float32 arrays without writing the intermediate images:
+  - fslmaths -s: separable Gaussian (FSL kernel, cut at 4 sigma, renormalized at the image
+    border), each 1D pass split across threads;
+  - fslmaths -dilall: replaced by a nearest non-zero value fill through the index output of
+    the Euclidean distance transform (one pass instead of repeated mean dilations).
+Only the brain mask (-b) mode is supported; T2w coregistration (-aT2) and BET (-bet) still
+require the shell script.
+
+Usage (from the repository root):
+    python -m utils.bias_field -t1 T1w.nii.gz -t2 T2w.nii.gz -s 2 -b mask.nii.gz -os _debiased
+"""
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+# =====================
+# fslmaths / fslstats operations
+# =====================
+
+def fsl_gaussian_kernel(sigma, voxel_size, cutoff=4.0):
+    """1D FSL Gaussian kernel (sigma in mm) sampled on the voxel grid."""
+    radius = int(np.ceil(sigma * cutoff / voxel_size))
+    x = np.arange(-radius, radius + 1) * voxel_size
+    return np.exp(-(x * x) / (2 * sigma * sigma))
+
+def _correlate_axis(data, kernel, axis, threads):
+    """correlate1d along axis, with the volume split in chunks along another axis."""
+    split_axis = max((a for a in range(data.ndim) if a != axis), key=lambda a: data.shape[a])
+    out = np.empty_like(data)
+    bounds = np.linspace(0, data.shape[split_axis], max(1, threads) + 1).astype(int)
+
+    def process(i):
+        index = [slice(None)] * data.ndim
+        index[split_axis] = slice(bounds[i], bounds[i + 1])
+        index = tuple(index)
+        ndimage.correlate1d(data[index], kernel, axis=axis, output=out[index], mode="constant", cval=0.0)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(process, range(len(bounds) - 1)))
+    return out
+
+def fsl_smooth(data, sigma, zooms, threads=1):
+    """fslmaths -s sigma: Gaussian smoothing renormalized by the kernel weight inside the image."""
+    out = data.astype(np.float32)
+    for axis in range(3):
+        kernel = fsl_gaussian_kernel(sigma, zooms[axis]).astype(np.float32)
+        out = _correlate_axis(out, kernel, axis, threads)
+        weights = ndimage.correlate1d(np.ones(data.shape[axis], dtype=np.float32), kernel,
+                                      mode="constant", cval=0.0)
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        out /= weights.reshape(shape)
+    return out
+
+def fsl_div(a, b):
+    """fslmaths -div: division by zero gives zero."""
+    out = np.zeros_like(a, dtype=np.float32)
+    np.divide(a, b, out=out, where=b != 0)
+    return out
+
+def fsl_stat(value):
+    """Value as printed by fslstats (6 significant digits) and read back by the script."""
+    return float(f"{value:.6g}")
+
+def nearest_fill(data, zooms):
+    """Replace zero voxels by the nearest non-zero value (in mm), in place of -dilall."""
+    holes = data == 0
+    if not holes.any() or holes.all():
+        return data
+    indices = ndimage.distance_transform_edt(holes, sampling=zooms, return_distances=False,
+                                             return_indices=True)
+    return data[tuple(indices)]
+
+# =====================
+# Bias field
+# =====================
+
+def output_prefix(t1_path, t2_path, out_suffix):
+    """Output names of T1xT2BiasFieldCorrection.sh: <dir><name without _T1w><suffix>_T1w."""
+    def base(path, modality):
+        name = os.path.basename(path)
+        for ext in (".nii.gz", ".nii"):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        if name.endswith(f"_{modality}"):
+            name = name[:-len(modality) - 1]
+        return name
+
+    directory = os.path.dirname(t1_path)
+    t1_name, t2_name = base(t1_path, "T1w"), base(t2_path, "T2w")
+    return {
+        "T1w": os.path.join(directory, f"{t1_name}{out_suffix}_T1w.nii.gz"),
+        "T2w": os.path.join(directory, f"{t2_name}{out_suffix}_T2w.nii.gz"),
+        "T1w_cropped": os.path.join(directory, f"{t1_name}{out_suffix}_cropped_T1w.nii.gz"),
+        "T2w_cropped": os.path.join(directory, f"{t2_name}{out_suffix}_cropped_T2w.nii.gz")
+    }
+
+def compute_bias_field(t1, t2, sigma, zooms, mask=None, threads=1):
+    """Bias field of the T1w/T2w pair (float32 arrays on the same grid)."""
+    t1xt2 = np.sqrt(np.abs(t1 * t2))
+    masked = t1xt2 if mask is None else np.where(mask > 0, t1xt2, np.float32(0))
+
+    nonzero = masked[masked != 0]
+    mean_intensity = fsl_stat(nonzero.mean(dtype=np.float64)) if nonzero.size else 0.0
+    print(f"Mean intensity value = {mean_intensity}")
+
+    print("Normalizing...")
+    norm = masked / np.float32(mean_intensity) if mean_intensity else masked
+    print("Smoothing...")
+    smooth = fsl_smooth((norm > 0).astype(np.float32), sigma, zooms, threads)
+    print("Normalizing...")
+    nm = fsl_div(fsl_smooth(norm, sigma, zooms, threads), smooth)
+    print("Modulate...")
+    mod = fsl_div(norm, nm)
+
+    nonzero = mod[mod != 0].astype(np.float64)
+    std = fsl_stat(nonzero.std(ddof=1)) if nonzero.size > 1 else 0.0
+    mean = fsl_stat(nonzero.mean()) if nonzero.size else 0.0
+    lower = mean - std * 0.5
+    print(f"Lower = {lower}")
+
+    print("Masking...")
+    # -thr lower -bin -ero (3x3x3 box, the image border does not erode)
+    mod_mask = ndimage.binary_erosion((mod >= np.float32(lower)) & (mod > 0),
+                                      structure=np.ones((3, 3, 3), dtype=bool), border_value=1)
+    print("Dilating...")
+    bias_raw = nearest_fill(np.where(mod_mask, norm, np.float32(0)), zooms)
+    print("Smoothing...")
+    return fsl_smooth(bias_raw, sigma, zooms, threads)
+
+def save_float(data, ref_img, path):
+    img = nib.Nifti1Image(data.astype(np.float32), ref_img.affine, ref_img.header)
+    img.set_data_dtype(np.float32)
+    nib.save(img, path)
+
+def t1xt2_bias_correction(t1_path, t2_path, sigma=4, brain_mask=None, out_suffix="_debiased",
+                          threads=1, dry_run=False):
+    """
+    Debias T1w and T2w like `T1xT2BiasFieldCorrection.sh -t1 -t2 -s sigma [-b mask] -os suffix`.
+    Returns the written paths (debiased T1w/T2w, and the cropped ones with a brain mask).
+    """
+    outputs = output_prefix(t1_path, t2_path, out_suffix)
+    written = [outputs["T1w"], outputs["T2w"]]
+    if brain_mask:
+        written += [outputs["T1w_cropped"], outputs["T2w_cropped"]]
+
+    if dry_run:
+        print(f"[DRY RUN] numpy T1xT2 bias correction (s={sigma}, mask={brain_mask}): {', '.join(written)}")
+        return written
+
+    t1_img, t2_img = nib.load(t1_path), nib.load(t2_path)
+    t1 = t1_img.get_fdata(dtype=np.float32)
+    t2 = t2_img.get_fdata(dtype=np.float32)
+    mask = nib.load(brain_mask).get_fdata(dtype=np.float32) if brain_mask else None
+    zooms = t1_img.header.get_zooms()[:3]
+
+    bias = compute_bias_field(t1, t2, float(sigma), zooms, mask, threads)
+
+    print("Applying bias field...")
+    t1_debiased = fsl_div(t1, bias)
+    t2_debiased = fsl_div(t2, bias)
+    save_float(t1_debiased, t1_img, outputs["T1w"])
+    save_float(t2_debiased, t2_img, outputs["T2w"])
+
+    if brain_mask:
+        print("Applying brain mask to debiased images...")
+        save_float(np.where(mask > 0, t1_debiased, np.float32(0)), t1_img, outputs["T1w_cropped"])
+        save_float(np.where(mask > 0, t2_debiased, np.float32(0)), t2_img, outputs["T2w_cropped"])
+
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="T1xT2 bias field correction (in-memory T1xT2BiasFieldCorrection.sh)")
+    parser.add_argument("-t1", required=True, help="Whole-head T1w image")
+    parser.add_argument("-t2", required=True, help="Whole-head T2w image (in the T1w space)")
+    parser.add_argument("-s", type=float, default=4, help="size of gauss kernel in mm when performing mean filtering (default=4)")
+    parser.add_argument("-b", help="Brain or brain mask file, also outputs the cropped debiased images")
+    parser.add_argument("-os", default="_debiased", help="Suffix for the bias field corrected images (default is \"_debiased\")")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads for the Gaussian filtering (default: 1)")
+    args = parser.parse_args()
+
+    for path in t1xt2_bias_correction(args.t1, args.t2, args.s, args.b, args.os, args.threads):
+        print(f"Saved: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Left-Right flip of NIfTI images without external tools.
+
+flip_lr() is the in-process equivalent of
+    fslswapdim in.nii.gz -x y z out.nii.gz
+    CopyImageHeaderInformation in.nii.gz out.nii.gz out.nii.gz 1 1 1
+i.e. the voxel data is reversed along the first axis and written once with the original
+header geometry (the anatomy is mirrored, the grid is unchanged).
+
+virtual_flip_lr() gives the same image in world space by only rewriting the affine
+(A @ F, F mirroring the first voxel axis); the voxel data is copied as is. It is only valid
+for consumers that resample through the header geometry (antsApplyTransforms,
+antsRegistration...), not for voxel-wise tools (AverageImages, fslmaths).
+"""
+
+import shutil
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+
+def flip_matrix(n):
+    """Voxel-space matrix mapping index i to n-1-i along the first axis."""
+    F = np.eye(4)
+    F[0, 0] = -1
+    F[0, 3] = n - 1
+    return F
+
+
+def flip_lr(in_path, out_path):
+    """Mirror the voxel data along the first axis, keeping the original header."""
+    img = nib.load(in_path)
+    slope, inter = img.header.get_slope_inter()
+    if slope in (None, 1.0) and inter in (None, 0.0):
+        # stored values are written back unchanged
+        data = np.asanyarray(img.dataobj.get_unscaled())
+    else:
+        data = np.asanyarray(img.dataobj)
+
+    out = img.__class__(data[::-1], img.affine, img.header)
+    out.set_data_dtype(img.get_data_dtype())
+    nib.save(out, out_path)
+    return out_path
+
+
+def virtual_flip_lr(in_path, out_path):
+    """
+    Write a copy whose affine is mirrored along the first voxel axis; the data bytes
+    (and extensions) are streamed unchanged after the new header.
+    """
+    img = nib.load(in_path)
+    affine = img.affine @ flip_matrix(img.shape[0])
+
+    with ImageOpener(in_path, "rb") as src, ImageOpener(out_path, "wb") as dst:
+        # header as stored on disk (keeps vox_offset, unlike img.header)
+        header = img.header.__class__.from_fileobj(src, check=False)
+        header.set_qform(affine, int(header["qform_code"]) or 1)
+        header.set_sform(affine, int(header["sform_code"]) or 1)
+        dst.write(header.binaryblock[:header.sizeof_hdr])
+        src.seek(header.sizeof_hdr)
+        shutil.copyfileobj(src, dst, 1 << 20)
+    return out_path
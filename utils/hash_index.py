@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Content hashes of files, cached in a JSON index.
+
+The caches of the repository (step hashes of utils/pipeline.py, composed transforms of
+utils/warp_cache.py, low-resolution inputs of utils/lr_pyramid.py) are keyed by the SHA-256 of
+multi-GB images. HashIndex keeps the hash of each file (by absolute path) with its size and
+modification time, so that a file is only re-read when one of them changed. The index is a
+JSON document {"files": {...}} to which its owner may add other sections (self.data).
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+
+class HashIndex:
+    """SHA-256 of file contents keyed by (size, mtime_ns), stored in a JSON file."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        self.data.setdefault("files", {})
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = [st.st_size, st.st_mtime_ns]
+        with self.lock:
+            cached = self.data["files"].get(path)
+        if cached and cached["key"] == key:
+            return cached["sha256"]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.data["files"][path] = {"key": key, "sha256": digest}
+        return digest
+
+    def save(self):
+        """
+        Write the index through a temporary file of its own (never left half written, and
+        safe when several threads or processes save the same index).
+        """
+        index_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(index_dir, exist_ok=True)
+        with self.lock:
+            fd, tmp_path = tempfile.mkstemp(dir=index_dir, prefix=f".{os.path.basename(self.path)}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self.data, f, indent=1)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
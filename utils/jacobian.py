@@ -0,0 +1,115 @@
+"""
+Jacobian determinant of ANTs displacement fields, by z-slabs.
+
+A displacement field u of antsRegistration (*_so_0Warp.nii.gz, fixed -> moving, LPS vectors on
+the fixed grid) defines phi(x) = x + u(x). Its Jacobian determinant det(I + du/dx) is the local
+volume ratio moving / fixed (> 1 where the moving image is locally larger), as given by
+    CreateJacobianDeterminantImage 3 Warp.nii.gz jacobian.nii.gz 0 0
+
+The derivatives are central finite differences along the voxel axes (one-sided on the image
+border), converted to LPS physical derivatives through the inverse of the voxel -> LPS
+matrix, and the 3x3 determinants are computed vectorised. The field is processed by slabs of
+z slices read with a one-slice halo, so only a slab of the field is in memory (together with
+the output volume); .nii.gz fields are first decompressed once to an uncompressed copy that is
+memory-mapped.
+"""
+
+import os
+import gzip
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+from utils.transforms import LPS
+
+
+def memmap_volume(path, tmpdir):
+    """
+    (array, image) of a NIfTI file, memory-mapped: .nii.gz files are decompressed to tmpdir
+    (once, streamed) and the uncompressed copy is mapped. The caller removes tmpdir.
+    """
+    path = str(path)
+    if path.endswith(".gz"):
+        os.makedirs(tmpdir, exist_ok=True)
+        plain = os.path.join(str(tmpdir), os.path.basename(path)[:-3])
+        if not os.path.exists(plain) or os.path.getmtime(plain) < os.path.getmtime(path):
+            with gzip.open(path, "rb") as src, open(plain, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+        path = plain
+    img = nib.load(path, mmap=True)
+    return np.asanyarray(img.dataobj), img
+
+
+def field_slab(field, z0, z1):
+    """(x, y, z1 - z0, 3) float64 slab of a (x, y, z, [1,] 3) displacement field."""
+    slab = field[:, :, z0:z1]
+    return np.asarray(slab, dtype=np.float64).reshape(slab.shape[:3] + (3,))
+
+
+def slab_determinant(field, voxel_to_lps, z0, z1, scale=1.0):
+    """det(I + scale * du/dx) of the slices z0:z1 of the field (x, y, z, [1,] 3)."""
+    nz = field.shape[2]
+    h0, h1 = max(z0 - 1, 0), min(z1 + 1, nz)
+    u = field_slab(field, h0, h1) * scale
+
+    # du/di along the voxel axes (central, one-sided on the borders), cropped to z0:z1
+    grads = []
+    for axis in range(3):
+        if u.shape[axis] < 2:
+            grads.append(np.zeros_like(u))
+        else:
+            grads.append(np.gradient(u, axis=axis))
+    grads = [g[:, :, z0 - h0:z0 - h0 + (z1 - z0)] for g in grads]
+
+    # du_c/dx_d = sum_k du_c/di_k * di_k/dx_d
+    to_voxel = np.linalg.inv(voxel_to_lps[:3, :3])
+    jac = np.empty(grads[0].shape[:3] + (3, 3))
+    for c in range(3):
+        for d in range(3):
+            jac[..., c, d] = sum(grads[k][..., c] * to_voxel[k, d] for k in range(3))
+        jac[..., c, c] += 1.0
+
+    a, b, cc = jac[..., 0, 0], jac[..., 0, 1], jac[..., 0, 2]
+    d, e, f = jac[..., 1, 0], jac[..., 1, 1], jac[..., 1, 2]
+    g, h, i = jac[..., 2, 0], jac[..., 2, 1], jac[..., 2, 2]
+    return a * (e * i - f * h) - b * (d * i - f * g) + cc * (d * h - e * g)
+
+
+def jacobian_determinant(field, affine, scale=1.0, log=True, threads=1, slab_size=8, eps=1e-6):
+    """
+    (log-)Jacobian determinant (float32, on the field grid) of the displacement field scaled by
+    scale (e.g. the b * Warp of a morph step). Folding voxels (det <= 0) are clipped to eps
+    before the log.
+    """
+    shape = field.shape[:3]
+    out = np.empty(shape, dtype=np.float32)
+    voxel_to_lps = LPS @ affine
+
+    def process(z0):
+        z1 = min(z0 + slab_size, shape[2])
+        det = slab_determinant(field, voxel_to_lps, z0, z1, scale)
+        out[:, :, z0:z1] = np.log(np.maximum(det, eps)) if log else det
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(process, range(0, shape[2], slab_size)))
+    return out
+
+
+def tissue_summary(log_jacobian, tpm, voxel_volume, slab_size=16):
+    """
+    TPM-weighted statistics of a log-Jacobian map (same grid): mean log-Jacobian, fixed
+    volume sum(p) * dv and moving volume sum(p * J) * dv (mm3 with header voxel sizes).
+    """
+    weight = log_sum = moved = 0.0
+    for z0 in range(0, log_jacobian.shape[2], slab_size):
+        p = np.asarray(tpm[:, :, z0:z0 + slab_size], dtype=np.float64).reshape(log_jacobian[:, :, z0:z0 + slab_size].shape)
+        logj = log_jacobian[:, :, z0:z0 + slab_size].astype(np.float64)
+        weight += p.sum()
+        log_sum += (p * logj).sum()
+        moved += (p * np.exp(logj)).sum()
+    return {
+        "mean_log_jacobian": log_sum / weight if weight > 0 else float("nan"),
+        "volume_fixed_mm3": weight * voxel_volume,
+        "volume_moving_mm3": moved * voxel_volume,
+    }
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Lazy, age-indexed access to the longitudinal template.
+
+interpolate_long_template.py writes --morph-numsteps frames per session pair, without ages.
+LongitudinalTemplate gives the template at any age between the first and the last session:
+
+    template = LongitudinalTemplate("BaBa21_openneuro", "BaBa21", ["ses-3", "ses-2", "ses-1", "ses-0"],
+                                    ["T2w"], reg_long_type="desc-MM")
+    img = template.at(0.75, "T2w")
+
+at(age) picks the pair of adjacent sessions bracketing the age, computes the blend weights
+(frame = a * ses_from + (1 - a) * ses_to, a rounded to blend_step like the interpolation) and
+synthesises the frame with utils.morph.MorphPair from the _so_0Warp / _so_0InverseWarp of the
+pair. Nothing is loaded before the first query; the warps of the last max_pairs pairs and
+the computed frames are kept in LRU caches, the frames within cache_mb, so repeated and
+nearby ages (same rounded blend) cost nothing.
+
+Session ages are read from sub-<template>/sub-<template>_sessions.tsv if it exists, otherwise
+averaged over the sub-*_sessions.tsv of the subjects of the dataset (as parse_dataset.py reads
+them), unless given explicitly.
+
+Usage (from the repository root):
+    python -m utils.long_template --bids_root BaBa21_openneuro --template_name BaBa21 \\
+      --sessions ses-3 ses-2 ses-1 ses-0 --reg_long_type desc-MM --contrasts T2w --age 0.75 --output T2w_0.75.nii.gz
+"""
+
+import os
+import argparse
+from collections import OrderedDict
+import numpy as np
+import nibabel as nib
+
+from utils.morph import MorphPair
+from preprocessing.parse_dataset import load_session_ages_for_subject
+
+def template_session_ages(bids_root, template_name, sessions):
+    """{session: age} of the template sessions (template sessions.tsv, or mean over the subjects)."""
+    template_dir = os.path.join(bids_root, f"sub-{template_name}")
+    ages = load_session_ages_for_subject(template_dir, f"sub-{template_name}")
+    if all(ses in ages for ses in sessions):
+        return {ses: float(ages[ses]) for ses in sessions}
+
+    per_session = {ses: [] for ses in sessions}
+    for subject in sorted(os.listdir(bids_root)):
+        subject_dir = os.path.join(bids_root, subject)
+        if not (subject.startswith("sub-") and os.path.isdir(subject_dir)):
+            continue
+        for ses, age in load_session_ages_for_subject(subject_dir, subject).items():
+            try:
+                if ses in per_session:
+                    per_session[ses].append(float(age))
+            except ValueError:
+                continue
+    return {ses: float(np.mean(values)) for ses, values in per_session.items() if values}
+
+class LongitudinalTemplate:
+    """Template frames synthesised on demand at any age, with LRU caches of warps and frames."""
+
+    def __init__(self, bids_root, template_name, sessions, contrasts, reg_long_type="CACP_MM",
+                 template_path="final", ages=None, cache_mb=1024, max_pairs=1, blend_step=0.01, threads=4):
+        self.bids_root = str(bids_root)
+        self.template_name = template_name
+        self.sessions = list(sessions)
+        self.contrasts = list(contrasts)
+        self.reg_long_type = reg_long_type
+        self.template_path = template_path
+        self.cache_bytes = int(cache_mb * 1024 * 1024)
+        self.max_pairs = max(1, max_pairs)
+        self.blend_step = blend_step
+        self.threads = threads
+
+        self.ages = dict(ages) if ages else template_session_ages(self.bids_root, template_name, self.sessions)
+        missing = [ses for ses in self.sessions if ses not in self.ages]
+        if missing:
+            raise ValueError(f"No age for session(s) {', '.join(missing)}")
+
+        self.pairs = OrderedDict()
+        self.frames = OrderedDict()
+        self.frames_bytes = 0
+
+    def paths(self, ses_from, ses_to):
+        """Warp, inverse warp and (moving, fixed) image of each contrast of a pair, as in interpolate_long_template.py."""
+        long_dir = os.path.join(self.bids_root, "derivatives", "transforms", f"sub-{self.template_name}", "long")
+        prefix = os.path.join(long_dir, f"{ses_from}_to_{ses_to}_{self.reg_long_type}_so_0")
+        template_dir = os.path.join(self.bids_root, "derivatives", "template", f"sub-{self.template_name}")
+        images = [(os.path.join(template_dir, ses_from, self.template_path, f"sub-{self.template_name}_{ses_from}_{c}.nii.gz"),
+                   os.path.join(template_dir, ses_to, self.template_path, f"sub-{self.template_name}_{ses_to}_{c}.nii.gz"))
+                  for c in self.contrasts]
+        return prefix + "Warp.nii.gz", prefix + "InverseWarp.nii.gz", images
+
+    def bracket(self, age):
+        """(ses_from, ses_to, blend a) of the adjacent pair whose ages bracket age."""
+        for ses_from, ses_to in zip(self.sessions[:-1], self.sessions[1:]):
+            age_from, age_to = self.ages[ses_from], self.ages[ses_to]
+            if min(age_from, age_to) <= age <= max(age_from, age_to):
+                blend = 1.0 if age_from == age_to else (age - age_to) / (age_from - age_to)
+                blend = round(round(blend / self.blend_step) * self.blend_step, 6)
+                return ses_from, ses_to, blend
+        ages = [self.ages[ses] for ses in self.sessions]
+        raise ValueError(f"Age {age} outside of the template range [{min(ages)}, {max(ages)}]")
+
+    def pair(self, ses_from, ses_to):
+        """MorphPair of the session pair, loaded on first use (LRU of max_pairs pairs)."""
+        key = (ses_from, ses_to)
+        if key in self.pairs:
+            self.pairs.move_to_end(key)
+            return self.pairs[key]
+        warp, invwarp, images = self.paths(ses_from, ses_to)
+        for path in [warp, invwarp] + [p for pair in images for p in pair]:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Missing {path}: run interpolate_long_template.py --compute-reg first")
+        print(f"[long_template] Loading {ses_from} → {ses_to}")
+        self.pairs[key] = MorphPair(warp, invwarp, images)
+        while len(self.pairs) > self.max_pairs:
+            self.pairs.popitem(last=False)
+        return self.pairs[key]
+
+    def frame(self, ses_from, ses_to, blend):
+        """Frames of all contrasts (float32 arrays, fixed grid) for a pair and blend, cached."""
+        key = (ses_from, ses_to, blend)
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return self.frames[key]
+
+        data = self.pair(ses_from, ses_to).frame(blend, round(1 - blend, 6), threads=self.threads)
+        size = sum(d.nbytes for d in data)
+        if size <= self.cache_bytes:
+            self.frames[key] = data
+            self.frames_bytes += size
+            while self.frames_bytes > self.cache_bytes:
+                _, evicted = self.frames.popitem(last=False)
+                self.frames_bytes -= sum(d.nbytes for d in evicted)
+        return data
+
+    def at(self, age, contrast=None):
+        """NIfTI image of a contrast (the only one by default) of the template at age."""
+        if contrast is None:
+            if len(self.contrasts) != 1:
+                raise ValueError(f"Choose a contrast among {', '.join(self.contrasts)}")
+            contrast = self.contrasts[0]
+        ses_from, ses_to, blend = self.bracket(age)
+        data = self.frame(ses_from, ses_to, blend)[self.contrasts.index(contrast)]
+        # header of the fixed image only, the pair may have been evicted
+        fixed_img = nib.load(self.paths(ses_from, ses_to)[2][self.contrasts.index(contrast)][1])
+        img = nib.Nifti1Image(data, fixed_img.affine, fixed_img.header)
+        img.set_data_dtype(np.float32)
+        return img
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthesise the longitudinal template at a given age")
+    parser.add_argument("--bids_root", required=True, help="Root BIDS directory")
+    parser.add_argument("--template_name", required=True, help="Template subject name")
+    parser.add_argument("--sessions", nargs="+", required=True, help="List of sessions (ordered, as interpolated)")
+    parser.add_argument("--contrasts", nargs="+", required=True, help="Contrasts of the template (as interpolated)")
+    parser.add_argument("--reg_long_type", default="CACP_MM", help="name of registration type (default: CACP_MM)")
+    parser.add_argument("--template_path", default="final", help="Subfolder for template")
+    parser.add_argument("--ages", nargs="*", default=[], help="Age of each session, as ses:age (default: sessions.tsv)")
+    parser.add_argument("--age", type=float, nargs="+", required=True, help="Age(s) of the output template(s)")
+    parser.add_argument("--output", nargs="+", required=True, help="Output image per age and contrast")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads (default: 4)")
+    args = parser.parse_args()
+
+    if len(args.output) != len(args.age) * len(args.contrasts):
+        parser.error("--output needs one file per age and contrast (ages outer, contrasts inner)")
+
+    ages = dict((ses, float(age)) for ses, age in (item.split(":", 1) for item in args.ages)) or None
+    template = LongitudinalTemplate(args.bids_root, args.template_name, args.sessions, args.contrasts,
+                                    args.reg_long_type, args.template_path, ages, threads=args.threads)
+    outputs = iter(args.output)
+    for age in args.age:
+        for contrast in args.contrasts:
+            out_path = next(outputs)
+            nib.save(template.at(age, contrast), out_path)
+            print(f"Saved: {out_path} ({contrast} at {age})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Low-resolution copies of the template inputs, for Stage 1 of MM_template_construction.py.
+
+Stage 1 builds a coarse template, but antsRegistration reads the full-resolution inputs and
+shrinks them again at every registration of every iteration. LRPyramid downsamples each input
+(and each -z prior) once, to an isotropic voxel size:
+  - anti-aliasing: Gaussian smoothing of sigma = sqrt(v^2 - s^2) / 2.3548 mm along an axis of
+    spacing s, so that the result has a resolution (FWHM) of about v;
+  - resampling with linear interpolation, as ITK samples images (utils/transforms.py), on a grid
+    of spacing about max(v, s) covering the same field of view (same orientation, same outer
+    corners: the spacing is adjusted to a whole number of voxels).
+A copy is stored as <cache_dir>/<name>_<hash>.nii.gz, the hash covering the content of the input
+and the voxel size: it is recomputed only when one of them changed. Content hashes are cached
+in <cache_dir>/index.json by (size, mtime) (utils/hash_index.py), with the source path of each
+copy, so that only the previous copies of the same source are removed (inputs of different
+folders often share a file name). The input CSV of the
+template script is rewritten cell by cell to point at the copies.
+
+Usage (from the repository root):
+    python -m utils.lr_pyramid --input-list list_of_subjects/subjects_ses-3_warp_HR_for_MM_template.csv \\
+      --voxel-size 1.2 --cache-dir tmp_LR/inputs --output-list tmp_LR/input_list_LR.csv --threads 8
+"""
+
+import os
+import csv
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+from utils.transforms import sample_slab
+from utils.hash_index import HashIndex
+
+# FWHM = FWHM_TO_SIGMA * sigma
+FWHM_TO_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+# bump when the downsampling changes, so that the cached copies are recomputed
+VERSION = "1"
+
+
+def is_image(value):
+    return str(value).strip().endswith((".nii", ".nii.gz"))
+
+
+def image_stem(path):
+    name = os.path.basename(str(path))
+    return name[:-7] if name.endswith(".nii.gz") else os.path.splitext(name)[0]
+
+
+def lr_grid(img, voxel_size):
+    """(shape, affine, LR -> input voxel matrix) of the downsampled grid, same field of view."""
+    zooms = np.array(img.header.get_zooms()[:3], dtype=np.float64)
+    shape = np.array(img.shape[:3])
+    spacing = np.maximum(voxel_size, zooms)
+    new_shape = np.maximum(1, np.round(shape * zooms / spacing)).astype(int)
+    # input voxel index of the new voxels: i = scale * (j + 0.5) - 0.5 (outer corners aligned)
+    scale = shape / new_shape
+    index = np.eye(4)
+    index[:3, :3] = np.diag(scale)
+    index[:3, 3] = 0.5 * scale - 0.5
+    return tuple(int(n) for n in new_shape), img.affine @ index, index
+
+
+def downsample(in_path, out_path, voxel_size, slab_size=16):
+    """Anti-aliased, downsampled float32 copy of a 3D image (4D images: first volume)."""
+    img = nib.load(str(in_path))
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3] + (-1,))[..., 0]
+    zooms = np.array(img.header.get_zooms()[:3], dtype=np.float64)
+    sigma_mm = np.sqrt(np.maximum(voxel_size ** 2 - zooms ** 2, 0.0)) / FWHM_TO_SIGMA
+    if np.any(sigma_mm > 0):
+        data = ndimage.gaussian_filter(data, sigma=sigma_mm / zooms, mode="nearest")
+
+    shape, affine, index = lr_grid(img, voxel_size)
+    out = np.zeros(shape, dtype=np.float32)
+    i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+    for z0 in range(0, shape[2], slab_size):
+        k = np.arange(z0, min(z0 + slab_size, shape[2]))
+        grid = np.stack([np.repeat(i[..., None], len(k), axis=2).ravel(),
+                         np.repeat(j[..., None], len(k), axis=2).ravel(),
+                         np.broadcast_to(k, (shape[0], shape[1], len(k))).ravel()]).astype(np.float64)
+        coords = index[:3, :3] @ grid + index[:3, 3:]
+        out[:, :, k[0]:k[-1] + 1] = sample_slab(data, coords, 1).reshape(shape[0], shape[1], len(k))
+
+    header = img.header.copy()
+    header.set_data_shape(shape)
+    lr = nib.Nifti1Image(out, affine, header)
+    lr.set_data_dtype(np.float32)
+    lr.set_qform(affine, int(img.header["qform_code"]) or 1)
+    lr.set_sform(affine, int(img.header["sform_code"]) or 1)
+    nib.save(lr, str(out_path))
+    return out_path
+
+
+class LRPyramid:
+    """Downsampled copies of images, keyed by the hash of their content and of the voxel size."""
+
+    def __init__(self, cache_dir, voxel_size):
+        self.cache_dir = str(cache_dir)
+        self.voxel_size = float(voxel_size)
+        # "copies": source image of each copy, to remove the stale copies of a source only
+        self.index = HashIndex(os.path.join(self.cache_dir, "index.json"))
+        self.index.data.setdefault("copies", {})
+
+    def remove_stale(self, source, name):
+        """Remove the previous copies of source (other content or voxel size) but name."""
+        with self.index.lock:
+            copies = self.index.data["copies"]
+            stale = [copy for copy, src in copies.items() if src == source and copy != name]
+            for copy in stale:
+                del copies[copy]
+            copies[name] = source
+        for copy in stale:
+            copy_path = os.path.join(self.cache_dir, copy)
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+
+    def get(self, path, dry_run=False):
+        """Path of the downsampled copy of an image, computed on first use."""
+        path = str(path).strip()
+        name = image_stem(path)
+        if not os.path.exists(path):
+            if not dry_run:
+                raise FileNotFoundError(f"Missing input image {path}")
+            out_path = os.path.join(self.cache_dir, f"{name}_<hash>.nii.gz")
+            print(f"[DRY RUN] downsample {path} -> {out_path}")
+            return out_path
+
+        sha = hashlib.sha256()
+        sha.update(self.index.file_hash(path).encode())
+        sha.update(f"{self.voxel_size:g}/{VERSION}".encode())
+        digest = sha.hexdigest()
+        out_path = os.path.join(self.cache_dir, f"{name}_{digest[:12]}.nii.gz")
+        if os.path.exists(out_path):
+            print(f"[lr_pyramid] Using {out_path}")
+            return out_path
+        if dry_run:
+            print(f"[DRY RUN] downsample {path} -> {out_path}")
+            return out_path
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.remove_stale(os.path.abspath(path), os.path.basename(out_path))
+
+        print(f"[lr_pyramid] Downsampling {path} to {self.voxel_size:g} mm -> {out_path}")
+        tmp_path = os.path.join(self.cache_dir, f"{name}.tmp_{digest[:12]}.nii.gz")
+        downsample(path, tmp_path, self.voxel_size)
+        os.replace(tmp_path, out_path)
+        return out_path
+
+    def get_all(self, paths, threads=1, dry_run=False):
+        """Downsampled copies of several images (in parallel, each image once), in the same order."""
+        unique = list(dict.fromkeys(str(p).strip() for p in paths))
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            copies = dict(zip(unique, executor.map(lambda p: self.get(p, dry_run), unique)))
+        if not dry_run and unique:
+            self.index.save()
+        return [copies[str(p).strip()] for p in paths]
+
+    def rewrite_list(self, in_csv, out_csv, threads=1, dry_run=False):
+        """Copy of an input CSV of the template script with every image replaced by its LR copy."""
+        with open(in_csv, newline="") as f:
+            rows = list(csv.reader(f))
+        images = [cell.strip() for row in rows for cell in row if is_image(cell)]
+        copies = dict(zip(images, self.get_all(images, threads, dry_run)))
+        rows = [[copies.get(cell.strip(), cell) for cell in row] for row in rows]
+        if dry_run:
+            print(f"[DRY RUN] write {out_csv} ({len(copies)} images)")
+            return out_csv
+        os.makedirs(os.path.dirname(os.path.abspath(out_csv)), exist_ok=True)
+        with open(out_csv, "w", newline="") as f:
+            csv.writer(f, lineterminator="\n").writerows(rows)
+        return out_csv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Downsampled copies of the inputs of antsMultivariateTemplateConstruction2.sh")
+    parser.add_argument("--input-list", required=True, help="CSV file of input images of the template script")
+    parser.add_argument("--voxel-size", type=float, required=True, help="Voxel size of the copies (mm)")
+    parser.add_argument("--cache-dir", required=True, help="Folder of the copies")
+    parser.add_argument("--output-list", required=True, help="Rewritten CSV file, pointing at the copies")
+    parser.add_argument("--priors", nargs="*", default=[], help="Initial templates (-z) to downsample too")
+    parser.add_argument("--threads", type=int, default=1, help="Number of images processed in parallel (default: 1)")
+    parser.add_argument("--dry-run", action="store_true", help="Don't actually downsample")
+    args = parser.parse_args()
+
+    pyramid = LRPyramid(args.cache_dir, args.voxel_size)
+    pyramid.rewrite_list(args.input_list, args.output_list, args.threads, args.dry_run)
+    for prior, copy in zip(args.priors, pyramid.get_all(args.priors, args.threads, args.dry_run)):
+        print(f"{prior} -> {copy}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+In-memory morphing between two session templates.
+
+One morph frame of interpolate_long_template.py blends, with a = n/numsteps and b = 1 - a,
+    a * moving(x + b * Warp)  +  b * fixed(x + a * InverseWarp)
+which the ANTs engine computes with MultiplyImages (scaled warps), antsApplyTransforms,
+ImageMath m and ImageMath + (five temporary images per contrast and frame).
+
+MorphPair loads the _so_0Warp / _so_0InverseWarp displacement fields and the contrasts of a
+session pair once; frame() scales the displacements in memory, computes the sampling
+coordinates once per slab and direction (shared by all contrasts on the same grid), samples
+with linear interpolation like antsApplyTransforms (0 outside the input image) and blends in
+place. Only the blended frames are returned.
+
+ANTs displacement fields are stored as 5D NIfTI (x, y, z, 1, 3) vectors in LPS physical
+coordinates; the displacement is 0 outside the field domain.
+
+share() / from_shared() hand a loaded pair to worker processes as uncompressed .npy copies
+that the workers memory-map (read-only, shared through the page cache), so the .nii.gz
+inputs are decompressed once.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+from utils.transforms import sample_slab
+
+LPS_SIGN = np.array([-1.0, -1.0, 1.0], dtype=np.float32)
+
+
+def compute_blending(n, numsteps):
+    """Blending coefficients a and b (rounded to 0.01) and blend name (percent) of morph step n."""
+    blending_a = round(n / numsteps, 2)
+    blending_b = round(1 - blending_a, 2)
+    blend_name = int(blending_a * 100)
+    return blending_a, blending_b, blend_name
+
+
+def load_displacement_field(path):
+    """ANTs displacement field as a (x, y, z, 3) float32 LPS array and its affine."""
+    img = nib.load(str(path))
+    field = np.asarray(img.dataobj, dtype=np.float32).reshape(img.shape[:3] + (3,))
+    return field, img.affine
+
+
+class MorphPair:
+    """Displacement fields and contrasts of one session pair (from -> to), loaded once."""
+
+    def __init__(self, warp_path, invwarp_path, contrast_paths):
+        """contrast_paths: list of (moving image of ses_from, fixed image of ses_to) per contrast."""
+        self.warp, self.warp_affine = load_displacement_field(warp_path)
+        self.invwarp, self.invwarp_affine = load_displacement_field(invwarp_path)
+
+        self.contrasts = []
+        for moving_path, fixed_path in contrast_paths:
+            moving_img, fixed_img = nib.load(str(moving_path)), nib.load(str(fixed_path))
+            if moving_img.shape[:3] != fixed_img.shape[:3]:
+                raise ValueError(f"{moving_path} and {fixed_path} must have the same dimensions to be blended")
+            self.contrasts.append((moving_img, moving_img.get_fdata(dtype=np.float32),
+                                   fixed_img, fixed_img.get_fdata(dtype=np.float32)))
+
+    def share(self, directory):
+        """Write the arrays as .npy files in directory; returns the (picklable) spec for from_shared()."""
+        os.makedirs(directory, exist_ok=True)
+
+        def save(name, array):
+            path = os.path.join(str(directory), f"{name}.npy")
+            np.save(path, array)
+            return path
+
+        return {
+            "directory": str(directory),
+            "warp": (save("warp", self.warp), self.warp_affine),
+            "invwarp": (save("invwarp", self.invwarp), self.invwarp_affine),
+            "contrasts": [(moving_img.get_filename(), save(f"moving_{i}", moving),
+                           fixed_img.get_filename(), save(f"fixed_{i}", fixed))
+                          for i, (moving_img, moving, fixed_img, fixed) in enumerate(self.contrasts)]
+        }
+
+    @classmethod
+    def from_shared(cls, spec):
+        """Pair whose arrays are memory-mapped from the files written by share()."""
+        pair = cls.__new__(cls)
+        pair.warp = np.load(spec["warp"][0], mmap_mode="r")
+        pair.warp_affine = spec["warp"][1]
+        pair.invwarp = np.load(spec["invwarp"][0], mmap_mode="r")
+        pair.invwarp_affine = spec["invwarp"][1]
+        pair.contrasts = [(nib.load(moving_path), np.load(moving_npy, mmap_mode="r"),
+                           nib.load(fixed_path), np.load(fixed_npy, mmap_mode="r"))
+                          for moving_path, moving_npy, fixed_path, fixed_npy in spec["contrasts"]]
+        return pair
+
+    def displaced_coordinates(self, field, field_affine, reference, source, scale, z0, z1):
+        """
+        Source voxel coordinates (3, N) of the reference voxels of slices z0:z1, displaced
+        by scale * field (the transform antsApplyTransforms -r reference -t field applies).
+        """
+        nx, ny = reference.shape[:2]
+        i, j, k = np.meshgrid(np.arange(nx), np.arange(ny), np.arange(z0, z1), indexing="ij")
+        grid = np.stack([i.ravel(), j.ravel(), k.ravel(), np.ones(i.size)]).astype(np.float64)
+        points = (reference.affine @ grid)[:3]
+
+        if field.shape[:3] == reference.shape[:3] and np.allclose(field_affine, reference.affine, atol=1e-5):
+            displacement = field[:, :, z0:z1].reshape(-1, 3).T
+        else:
+            field_coords = (np.linalg.inv(field_affine) @ np.vstack([points, grid[3]]))[:3]
+            displacement = np.stack([sample_slab(field[..., c], field_coords, 1) for c in range(3)])
+
+        points += scale * (displacement * LPS_SIGN[:, None])
+        to_voxel = np.linalg.inv(source.affine)
+        return to_voxel[:3, :3] @ points + to_voxel[:3, 3:]
+
+    def frame(self, blending_a, blending_b, threads=1, slab_size=8):
+        """Blended frame of every contrast (float32 arrays on the grid of the fixed images)."""
+        outputs = [np.zeros(fixed_img.shape[:3], dtype=np.float32) for _, _, fixed_img, _ in self.contrasts]
+        nz = self.contrasts[0][2].shape[2]
+
+        def process(z0):
+            z1 = min(z0 + slab_size, nz)
+            cache = {}
+            for (moving_img, moving, fixed_img, fixed), out in zip(self.contrasts, outputs):
+                # moving resampled on the fixed grid through b * Warp, fixed on the moving grid through a * InverseWarp
+                key_src = ("src", fixed_img.affine.tobytes(), moving_img.affine.tobytes())
+                if key_src not in cache:
+                    cache[key_src] = self.displaced_coordinates(self.warp, self.warp_affine, fixed_img,
+                                                                moving_img, blending_b, z0, z1)
+                key_tgt = ("tgt", moving_img.affine.tobytes(), fixed_img.affine.tobytes())
+                if key_tgt not in cache:
+                    cache[key_tgt] = self.displaced_coordinates(self.invwarp, self.invwarp_affine, moving_img,
+                                                                fixed_img, blending_a, z0, z1)
+
+                shape = (fixed.shape[0], fixed.shape[1], z1 - z0)
+                slab = out[:, :, z0:z1]
+                slab += np.float32(blending_a) * sample_slab(moving, cache[key_src], 1).reshape(shape)
+                slab += np.float32(blending_b) * sample_slab(fixed, cache[key_tgt], 1).reshape(shape)
+
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            list(executor.map(process, range(0, nz, slab_size)))
+        return outputs
+
+    def frame_images(self, blending_a, blending_b, threads=1, slab_size=8):
+        """frame() as float32 NIfTI images with the header of the fixed images."""
+        images = []
+        for (_, _, fixed_img, _), data in zip(self.contrasts, self.frame(blending_a, blending_b, threads, slab_size)):
+            img = nib.Nifti1Image(data, fixed_img.affine, fixed_img.header)
+            img.set_data_dtype(np.float32)
+            images.append(img)
+        return images
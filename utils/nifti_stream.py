@@ -0,0 +1,109 @@
+"""
+Streaming 4D NIfTI writer and reader.
+
+Volumes are appended one at a time, so only the current frame is in memory (fslmerge -t, or
+nibabel concat_images, hold the whole series). The header is written up front and its
+dim[4] patched when the writer is closed.
+
+For .nii.gz the file is made of two gzip members, which gzip readers (zlib, nibabel, FSL,
+ITK) decompress as one stream: the 352-byte header, stored uncompressed (compression level 0)
+so that it can be rewritten in place with the same length, followed by the compressed
+volumes.
+
+iter_volumes() reads a 4D file volume by volume in a single sequential pass over the
+(decompressed) stream; indexing the last axis of a .nii.gz with nibabel restarts the
+decompression from the beginning of the file at each volume.
+"""
+
+import gzip
+import numpy as np
+import nibabel as nib
+
+VOX_OFFSET = 352
+
+
+class Nifti4DWriter:
+    """
+    Write a 4D float NIfTI volume by volume, with the geometry of a 3D reference image:
+
+        with Nifti4DWriter(out_path, reference_img) as writer:
+            for frame in frames:
+                writer.append(frame)
+    """
+
+    def __init__(self, path, reference, dtype=np.float32, compresslevel=6):
+        self.path = str(path)
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(reference.shape[:3])
+        self.count = 0
+
+        header = nib.Nifti1Header()
+        header.set_data_dtype(self.dtype)
+        header.set_data_shape(self.shape + (1,))
+        header.set_zooms(tuple(reference.header.get_zooms()[:3]) + (1.0,))
+        header.set_xyzt_units(*reference.header.get_xyzt_units())
+        header.set_qform(reference.affine, int(reference.header["qform_code"]) or 1)
+        header.set_sform(reference.affine, int(reference.header["sform_code"]) or 1)
+        header["vox_offset"] = VOX_OFFSET
+        self.header = header
+
+        self.compressed = self.path.endswith(".gz")
+        self.file = open(self.path, "wb")
+        self.file.write(self._header_block())
+        self.stream = gzip.GzipFile(fileobj=self.file, mode="wb", compresslevel=compresslevel, mtime=0) \
+            if self.compressed else self.file
+
+    def _header_block(self):
+        block = self.header.binaryblock + b"\0" * (VOX_OFFSET - self.header.sizeof_hdr)
+        return gzip.compress(block, compresslevel=0, mtime=0) if self.compressed else block
+
+    def append(self, volume):
+        """Append one 3D volume (with the shape of the reference)."""
+        volume = np.asarray(volume)
+        if volume.shape != self.shape:
+            raise ValueError(f"Volume shape {volume.shape} does not match {self.shape} for {self.path}")
+        # NIfTI stores x fastest: Fortran order
+        self.stream.write(np.asfortranarray(volume, dtype=self.dtype).tobytes(order="F"))
+        self.count += 1
+
+    def close(self):
+        """Finish the data stream and patch dim[4] with the number of volumes written."""
+        if self.file.closed:
+            return
+        if self.compressed:
+            self.stream.close()
+        self.header.set_data_shape(self.shape + (self.count,))
+        self.file.seek(0)
+        self.file.write(self._header_block())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+
+def iter_volumes(path, dtype=np.float32):
+    """Yield the 3D volumes of a 4D NIfTI file in order (scaling applied), reading it once."""
+    img = nib.load(str(path))
+    header = img.header
+    shape = tuple(img.shape[:3])
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+    stored = header.get_data_dtype()
+    # the header of a loaded image has vox_offset and scaling reset, the proxy keeps them
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    nbytes = int(np.prod(shape)) * stored.itemsize
+
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(str(path), "rb") as f:
+        f.seek(int(img.dataobj.offset))
+        for _ in range(n_volumes):
+            buffer = f.read(nbytes)
+            if len(buffer) != nbytes:
+                raise ValueError(f"Truncated NIfTI file: {path}")
+            volume = np.frombuffer(buffer, dtype=stored).reshape(shape, order="F").astype(dtype)
+            if slope != 1.0 or inter != 0.0:
+                cast = np.dtype(dtype).type
+                volume = volume * cast(slope) + cast(inter)
+            yield volume
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Declarative, content-hash based runner for the BABACOOL step sequences.
+
+A pipeline is described in a JSON file with global "params" and a list of "steps".
+Each step declares its command, its inputs and its outputs as BIDS paths (relative to
+bids_root unless absolute). Steps are expanded over "foreach" variables (e.g. per session,
+per modality), connected through their inputs/outputs, and only re-run when the hash of
+their inputs content plus their expanded command changed, or when an output is missing.
+
+Usage (from the repository root):
+    python -m utils.pipeline pipelines/BaBa21_4D.json --jobs 4 --set TPM_threshold=0.3
+"""
+
+import os
+import re
+import sys
+import json
+import glob
+import fnmatch
+import hashlib
+import argparse
+import itertools
+
+from utils.runner import run_command, run_graph
+from utils.hash_index import HashIndex
+from utils.tpm_labels import threshold_label
+
+PLACEHOLDER = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+# =====================
+# Spec expansion
+# =====================
+
+# rules of the "derived" params of a spec: {"TPM_label": {"rule": "threshold_label", "from": "TPM_threshold"}}
+DERIVED_RULES = {"threshold_label": threshold_label}
+
+def substitute(value, variables):
+    """
+    Replace {name} placeholders in strings (recursively in lists and dicts).
+    A string made of a single placeholder is replaced by the variable itself (e.g. a list).
+    """
+    if isinstance(value, str):
+        match = PLACEHOLDER.fullmatch(value)
+        if match and match.group(1) in variables:
+            return substitute(variables[match.group(1)], variables)
+
+        def replace(m):
+            if m.group(1) not in variables:
+                raise KeyError(f"Undefined pipeline parameter '{m.group(1)}' in '{value}'")
+            return str(substitute(variables[m.group(1)], variables))
+        return PLACEHOLDER.sub(replace, value)
+    if isinstance(value, list):
+        return [substitute(v, variables) for v in value]
+    if isinstance(value, dict):
+        return {k: substitute(v, variables) for k, v in value.items()}
+    return value
+
+def foreach_combinations(foreach, params):
+    """
+    Cartesian product of the "foreach" variables of a step.
+    Items may be plain values or dicts of several variables (e.g. per modality settings).
+    """
+    if not foreach:
+        return [{}]
+    names = list(foreach)
+    values = []
+    for name in names:
+        items = substitute(foreach[name], params)
+        if not isinstance(items, list):
+            items = [items]
+        values.append(items)
+
+    combinations = []
+    for combo in itertools.product(*values):
+        variables = {}
+        for name, item in zip(names, combo):
+            if isinstance(item, dict):
+                variables.update(item)
+            else:
+                variables[name] = item
+        combinations.append(variables)
+    return combinations
+
+def expand_items(items, scope):
+    """
+    Substitute a list of command words or paths. A placeholder holding a list is spliced in
+    (e.g. "{sessions}" -> several words), and an item {"foreach": {...}, "each": [...]} is
+    replaced by its "each" items for every combination of its foreach variables.
+    """
+    expanded = []
+    for item in items:
+        if isinstance(item, dict):
+            for variables in foreach_combinations(item.get("foreach"), scope):
+                expanded.extend(expand_items(item["each"], {**scope, **variables}))
+        else:
+            value = substitute(item, scope)
+            expanded.extend(value if isinstance(value, list) else [value])
+    return expanded
+
+class Step:
+    """A single expanded pipeline step."""
+
+    def __init__(self, name, command, inputs, outputs, env, bids_root):
+        self.name = name
+        self.command = [str(c) for c in command]
+        self.inputs = [self.resolve(p, bids_root) for p in inputs]
+        self.outputs = [self.resolve(p, bids_root) for p in outputs]
+        self.env = {k: str(v) for k, v in env.items()}
+        self.deps = set()
+
+    @staticmethod
+    def resolve(path, bids_root):
+        return path if os.path.isabs(path) else os.path.join(bids_root, path)
+
+def load_pipeline(spec_path, overrides):
+    """Read a JSON pipeline spec and expand it into a dict of Steps connected by their files."""
+    with open(spec_path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+
+    params = dict(spec.get("params", {}))
+    for key, value in overrides.items():
+        params[key] = value
+    # derived params follow their source param, so that they cannot be overridden out of step
+    for key, rule in spec.get("derived", {}).items():
+        if key in overrides:
+            raise ValueError(f"'{key}' is derived from '{rule['from']}': set '{rule['from']}' instead")
+        if rule["rule"] not in DERIVED_RULES:
+            raise ValueError(f"Unknown rule '{rule['rule']}' of derived param '{key}'")
+        params[key] = DERIVED_RULES[rule["rule"]](params[rule["from"]])
+    if "bids_root" not in params:
+        raise ValueError("The pipeline params must define 'bids_root'")
+    bids_root = str(params["bids_root"])
+
+    steps = {}
+    for step_spec in spec["steps"]:
+        for variables in foreach_combinations(step_spec.get("foreach"), params):
+            scope = {**params, **variables}
+            step = Step(
+                substitute(step_spec["name"], scope),
+                expand_items(step_spec["command"], scope),
+                expand_items(step_spec.get("inputs", []), scope),
+                expand_items(step_spec.get("outputs", []), scope),
+                substitute(step_spec.get("env", {}), scope),
+                bids_root
+            )
+            if step.name in steps:
+                raise ValueError(f"Duplicate step name after expansion: {step.name}")
+            steps[step.name] = step
+
+    producers = {}
+    for step in steps.values():
+        for output in step.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is produced by both {producers[output]} and {step.name}")
+            producers[output] = step.name
+
+    for step in steps.values():
+        for pattern in step.inputs:
+            for output, producer in producers.items():
+                if output == pattern or fnmatch.fnmatch(output, pattern):
+                    if producer != step.name:
+                        step.deps.add(producer)
+
+    return steps, params
+
+def select_steps(steps, patterns):
+    """Keep the steps matching the patterns and everything upstream of them."""
+    if not patterns:
+        return set(steps)
+    selected = set()
+    todo = [name for name in steps if any(fnmatch.fnmatch(name, p) for p in patterns)]
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(steps[name].deps)
+    return selected
+
+def topological_order(steps, selected):
+    order, done, visiting = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Cycle detected in pipeline at step {name}")
+        visiting.add(name)
+        for dep in sorted(steps[name].deps & selected):
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in sorted(selected):
+        visit(name)
+    return order
+
+# =====================
+# Hashing and state
+# =====================
+
+class PipelineState(HashIndex):
+    """
+    Persistent step hashes plus a cache of file content hashes keyed by (size, mtime)
+    (utils/hash_index.py), so unchanged multi-GB inputs are not re-read at every run.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.data.setdefault("steps", {})
+
+    def step_hash(self, step):
+        """Hash of the expanded command, environment and content of every input."""
+        sha = hashlib.sha256()
+        sha.update(json.dumps([step.command, step.env, step.outputs], sort_keys=True).encode())
+        for pattern in step.inputs:
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            if not matches:
+                raise FileNotFoundError(f"No input matching {pattern} for step {step.name}")
+            for path in matches:
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"Missing input {path} for step {step.name}")
+                sha.update(path.encode())
+                sha.update(self.file_hash(path).encode())
+        return sha.hexdigest()
+
+    def recorded(self, name):
+        with self.lock:
+            return self.data["steps"].get(name)
+
+    def record(self, name, digest):
+        with self.lock:
+            self.data["steps"][name] = digest
+        self.save()
+
+# =====================
+# Execution
+# =====================
+
+def run_step(step, log_dir):
+    """Run one step command, logging its output to log_dir/<step>.log."""
+    env = os.environ.copy()
+    env.update(step.env)
+    for output in step.outputs:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    log_path = os.path.join(log_dir, f"{step.name}.log")
+    print(f"[pipeline] {step.name}: log in {log_path}")
+    open(log_path, "w").close()
+    run_command(step.command, env=env, log_path=log_path, step=step.name)
+
+def run_pipeline(steps, selected, state, log_dir, jobs=1, force=False, dry_run=False):
+    """
+    Execute the selected steps in dependency order, running independent branches in parallel.
+    Returns the list of failed step names.
+    """
+    order = topological_order(steps, selected)
+    status = {}
+
+    def needs_run(step):
+        digest = state.step_hash(step)
+        outputs_ok = all(os.path.exists(p) for p in step.outputs)
+        return force or not outputs_ok or state.recorded(step.name) != digest, digest
+
+    def execute(name):
+        step = steps[name]
+        if dry_run and any(status.get(dep) == "would-run" for dep in step.deps & selected):
+            print(f"[DRY RUN] {name}: would run (upstream changed): {' '.join(step.command)}")
+            return "would-run"
+        run, digest = needs_run(step)
+        if not run:
+            print(f"[pipeline] {name}: up to date")
+            return "skipped"
+        if dry_run:
+            print(f"[DRY RUN] {name}: would run: {' '.join(step.command)}")
+            return "would-run"
+        run_step(step, log_dir)
+        missing = [p for p in step.outputs if not os.path.exists(p)]
+        if missing:
+            raise FileNotFoundError(f"Step {name} did not produce: {', '.join(missing)}")
+        state.record(name, digest)
+        return "done"
+
+    os.makedirs(log_dir, exist_ok=True)
+    tasks = {name: (steps[name].deps & selected, lambda name=name: execute(name)) for name in order}
+    run_graph(tasks, jobs, status, label="pipeline")
+    return [name for name in order if status.get(name) == "failed"]
+
+def parse_overrides(items):
+    """Parse --set key=value items, decoding JSON values when possible (numbers, lists)."""
+    overrides = {}
+    for item in items or []:
+        if "=" not in item:
+            raise ValueError(f"--set expects key=value, got '{item}'")
+        key, value = item.split("=", 1)
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a BABACOOL pipeline spec, only re-running steps whose inputs or parameters changed.")
+    parser.add_argument("spec", help="JSON pipeline specification (e.g. pipelines/BaBa21_4D.json)")
+    parser.add_argument("--set", nargs="+", metavar="KEY=VALUE", help="Override pipeline params (e.g. TPM_threshold=0.3)")
+    parser.add_argument("--steps", nargs="+", help="Only run steps matching these patterns (and their upstream steps)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of independent steps run concurrently (default: 1)")
+    parser.add_argument("--state", help="State file (default: <bids_root>/derivatives/pipeline/<spec>_state.json)")
+    parser.add_argument("--force", action="store_true", help="Re-run selected steps even if up to date")
+    parser.add_argument("--list", action="store_true", help="List the expanded steps and their dependencies, then exit")
+    parser.add_argument("--dry-run", action="store_true", help="Print which steps would run without executing them")
+    args = parser.parse_args()
+
+    steps, params = load_pipeline(args.spec, parse_overrides(args.set))
+    selected = select_steps(steps, args.steps)
+
+    if args.list:
+        for name in topological_order(steps, selected):
+            deps = ", ".join(sorted(steps[name].deps)) or "-"
+            print(f"{name}  <-  {deps}")
+        return
+
+    spec_name = os.path.splitext(os.path.basename(args.spec))[0]
+    pipeline_dir = os.path.join(str(params["bids_root"]), "derivatives", "pipeline")
+    state = PipelineState(args.state or os.path.join(pipeline_dir, f"{spec_name}_state.json"))
+    log_dir = os.path.join(pipeline_dir, "logs", spec_name)
+
+    print(f"[pipeline] {len(selected)} steps selected from {args.spec}")
+    failed = run_pipeline(steps, selected, state, log_dir, args.jobs, args.force, args.dry_run)
+    if not args.dry_run:
+        state.save()
+
+    if failed:
+        print(f"\n[pipeline] {len(failed)} step(s) failed:")
+        for name in failed:
+            print(f" - {name} (log: {os.path.join(log_dir, name + '.log')})")
+        sys.exit(1)
+    print("\n[pipeline] done")
+
+if __name__ == "__main__":
+    main()
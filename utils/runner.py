@@ -0,0 +1,193 @@
+"""
+Shared command runner for the BABACOOL scripts.
+
+Every external command (FSL, ANTs, mri_convert...) goes through run_command(), which
+prints it, runs it, and when the BABACOOL_TRACE environment variable points to a file, appends
+one JSON line per command with wall time, user/sys CPU, peak RSS, block I/O and exit status,
+tagged with the current subject/session/step (see trace_tags).
+
+Example:
+    export BABACOOL_TRACE=traces/ses-2.jsonl
+    python postprocessing/correct_TPM.py --bids_root BaBa21_openneuro --sessions ses-2
+    python -m utils.trace_summary traces/ses-2.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import socket
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+TRACE_ENV = "BABACOOL_TRACE"
+
+# ru_inblock / ru_oublock are counted in 512-byte blocks on Linux
+BLOCK_SIZE = 512
+
+_local = threading.local()
+
+def current_tags():
+    """Return the tags active in this thread (merged from nested trace_tags blocks)."""
+    tags = {}
+    for layer in getattr(_local, "tags", []):
+        tags.update(layer)
+    return tags
+
+@contextmanager
+def trace_tags(**tags):
+    """
+    Tag every command run inside the block, e.g.
+        with trace_tags(subject=sub, session=ses, step="register"):
+            run_command(cmd)
+    Tags nest: inner blocks add to (or override) outer ones.
+    """
+    if not hasattr(_local, "tags"):
+        _local.tags = []
+    _local.tags.append({k: v for k, v in tags.items() if v is not None})
+    try:
+        yield
+    finally:
+        _local.tags.pop()
+
+def tool_name(cmd, shell=False):
+    """Name of the executable, used to aggregate traces (e.g. antsRegistration)."""
+    first = str(cmd[0]) if isinstance(cmd, (list, tuple)) else str(cmd)
+    if shell:
+        first = first.split()[0] if first.split() else first
+    return os.path.basename(first)
+
+def write_trace(record, trace_path=None):
+    """Append a record to the JSONL trace file (locked, so parallel jobs can share it)."""
+    trace_path = trace_path or os.environ.get(TRACE_ENV)
+    if not trace_path:
+        return
+    trace_dir = os.path.dirname(trace_path)
+    if trace_dir:
+        os.makedirs(trace_dir, exist_ok=True)
+    line = json.dumps(record) + "\n"
+    with open(trace_path, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def run_command(cmd, dry_run=False, env=None, workdir=None, shell=False, log_path=None, **tags):
+    """
+    Run an external command (raises CalledProcessError on failure, like subprocess.run(check=True)).
+
+    Resource usage is taken from wait4() on the child, so it includes every descendant it
+    waited for (e.g. the tools called by antsMultivariateTemplateConstruction2.sh).
+    Extra keyword arguments are added to the trace record as tags.
+    If log_path is given, stdout and stderr of the command are written to that file.
+    """
+    print("Running:", " ".join(map(str, cmd)))
+    if dry_run:
+        return
+
+    record = {
+        "start": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "tool": tool_name(cmd, shell),
+        "cmd": [str(c) for c in cmd] if isinstance(cmd, (list, tuple)) else str(cmd),
+        "script": os.path.basename(sys.argv[0]),
+        "host": socket.gethostname(),
+    }
+    record.update(current_tags())
+    record.update({k: v for k, v in tags.items() if v is not None})
+
+    log = open(log_path, "a") if log_path else None
+    t0 = time.perf_counter()
+    try:
+        proc = subprocess.Popen(cmd, env=env, shell=shell, cwd=workdir,
+                                stdout=log, stderr=subprocess.STDOUT if log else None)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    finally:
+        if log:
+            log.close()
+    wall = time.perf_counter() - t0
+
+    record.update({
+        "wall_s": round(wall, 3),
+        "user_s": round(rusage.ru_utime, 3),
+        "sys_s": round(rusage.ru_stime, 3),
+        "max_rss_kb": rusage.ru_maxrss,
+        "read_bytes": rusage.ru_inblock * BLOCK_SIZE,
+        "write_bytes": rusage.ru_oublock * BLOCK_SIZE,
+        "exit_status": proc.returncode,
+    })
+    write_trace(record)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def itk_env(threads, env=None):
+    """Copy of the environment (os.environ by default) limiting ITK/ANTs tools to threads threads."""
+    env = dict(os.environ if env is None else env)
+    env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(max(1, threads))
+    env["OMP_NUM_THREADS"] = str(max(1, threads))
+    return env
+
+def job_options(args, bids_root, name):
+    """
+    run_command options of a job of the longitudinal scripts (--jobs, --threads-per-job, --dry-run):
+    its ITK thread count and, with --jobs > 1, its own log file in transforms/sub-<name>/long/logs/.
+    """
+    options = {"env": itk_env(args.threads_per_job)}
+    if args.jobs > 1 and not args.dry_run:
+        log_dir = os.path.join(bids_root, "derivatives", "transforms", f"sub-{args.template_name}", "long", "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        log_path = os.path.join(log_dir, f"{name}.log")
+        open(log_path, "w").close()
+        print(f"[jobs] {name}: log in {os.path.relpath(log_path)}")
+        options["log_path"] = log_path
+    return options
+
+def run_graph(tasks, jobs=1, status=None, label="jobs"):
+    """
+    Run tasks {name: (dependencies, function)} on jobs threads, each one as soon as all its
+    dependencies are finished (dependencies that are not tasks are ignored). The status of a task
+    is the string returned by its function (e.g. "skipped", else "done"), "failed" if it raised,
+    or "blocked" if one of its dependencies failed or was blocked: it is not run then.
+    status ({name: status}) is filled as tasks finish, so functions can look at their dependencies.
+    Returns the list of failed and blocked task names.
+    """
+    pending = {name: set(deps) & set(tasks) for name, (deps, _) in tasks.items()}
+    status = {} if status is None else status
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                deps = pending[name]
+                if any(status.get(dep) in ("failed", "blocked") for dep in deps):
+                    print(f"[{label}] {name}: blocked by a failed dependency")
+                    status[name] = "blocked"
+                    del pending[name]
+                elif all(dep in status for dep in deps):
+                    running[executor.submit(tasks[name][1])] = name
+                    del pending[name]
+
+            if not running:
+                # only a dependency cycle can leave tasks pending with nothing running
+                for name in pending:
+                    print(f"[{label}] {name}: blocked by a dependency cycle")
+                    status[name] = "blocked"
+                pending.clear()
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                    status[name] = result if isinstance(result, str) else "done"
+                except Exception as e:
+                    print(f"[{label}] {name}: FAILED: {e}")
+                    status[name] = "failed"
+
+    return [name for name in tasks if status.get(name) in ("failed", "blocked")]
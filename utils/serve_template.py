@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Local HTTP server of 2D tiles of the 4D+t template, for web viewers.
+
+Tiles are slices of one contrast at one time point, selected by frame index or by age (the
+nearest frame), along one axis (x/sagittal, y/coronal, z/axial), returned as 8-bit grayscale
+PNG or raw little-endian float32:
+
+    GET /index                                       contrasts, shape and frame index (JSON)
+    GET /tile/<contrast>/<axis>/<slice>?frame=12     PNG tile (vmin/vmax: window, default 0.5-99.5 percentiles)
+    GET /tile/<contrast>/<axis>/<slice>?age=0.75&format=raw
+                                                     float32 tile, shape in the X-Tile-Shape header
+
+Tiles are shown with the first voxel axis of the slice horizontal and the second one vertical,
+bottom-up. The tile data is read from (in order of preference):
+  - a chunked store (utils/template_store.py): only the chunks of the slice are read;
+  - the _morph_4D files of interpolate_long_template.py: a frame is decompressed once, on its
+    first tile request, and kept in an LRU of volumes (--volume-cache-mb);
+  - the final templates of each session (one frame per session).
+Rendered tiles are kept in an LRU (--cache-mb) and carry a strong ETag (hash of the source
+files, the tile request and the window), so conditional requests (If-None-Match) are answered
+304 without touching the data. Requests are served by asyncio, tiles rendered in a thread
+pool, and concurrent requests of the same tile share one rendering.
+
+Usage (from the repository root):
+    python -m utils.serve_template --store BaBa21_4D.t4d --port 8021
+    python -m utils.serve_template --bids_root BaBa21_openneuro --template_name BaBa21 \\
+      --sessions ses-3 ses-2 ses-1 ses-0 --reg_long_type desc-MM --contrasts T1w T2w --ages ses-0:0.04 ...
+"""
+
+import os
+import json
+import zlib
+import struct
+import asyncio
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+import numpy as np
+import nibabel as nib
+
+from utils.template_store import TemplateStore, build_index, morph_steps, load_ages
+
+AXES = {"x": 0, "sagittal": 0, "0": 0, "y": 1, "coronal": 1, "1": 1, "z": 2, "axial": 2, "2": 2}
+
+# =====================
+# Tile sources
+# =====================
+
+class StoreSource:
+    """Tiles read from a chunked store (only the chunks crossing the slice)."""
+
+    def __init__(self, path):
+        self.store = TemplateStore(path)
+        self.contrasts = list(self.store.contrasts)
+        self.frames = self.store.frames
+        self.shape = self.store.shape
+        self.version = file_version([os.path.join(path, "store.json")])
+
+    def slice(self, contrast, frame, axis, index):
+        key = [slice(None)] * 3 + [frame]
+        key[axis] = index
+        return self.store[contrast][tuple(key)]
+
+class NiftiSource:
+    """Tiles read from 3D/4D NIfTI files, one frame being (file, volume); frames kept in an LRU of volumes."""
+
+    def __init__(self, contrast_frames, frames, volume_cache_mb=2048):
+        """contrast_frames: {contrast: [(path, volume index) of each frame]}."""
+        self.contrast_frames = contrast_frames
+        self.contrasts = list(contrast_frames)
+        self.frames = frames
+        first = nib.load(str(contrast_frames[self.contrasts[0]][0][0]))
+        self.shape = tuple(first.shape[:3]) + (len(frames),)
+        self.version = file_version(sorted({p for files in contrast_frames.values() for p, _ in files}))
+        self.volume_bytes = int(volume_cache_mb * 1024 * 1024)
+        self.volumes = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def volume(self, contrast, frame):
+        key = (contrast, frame)
+        with self.lock:
+            if key in self.volumes:
+                self.volumes.move_to_end(key)
+                return self.volumes[key]
+            # one thread decompresses a frame, the others wait for it
+            event = self.loading.get(key)
+            if event is None:
+                self.loading[key] = threading.Event()
+        if event is not None:
+            event.wait()
+            return self.volume(contrast, frame)
+
+        try:
+            path, position = self.contrast_frames[contrast][frame]
+            img = nib.load(str(path))
+            data = np.asarray(img.dataobj[..., position] if len(img.shape) > 3 else img.dataobj, dtype=np.float32)
+            with self.lock:
+                self.volumes[key] = data
+                total = sum(v.nbytes for v in self.volumes.values())
+                while total > self.volume_bytes and len(self.volumes) > 1:
+                    _, evicted = self.volumes.popitem(last=False)
+                    total -= evicted.nbytes
+            return data
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def slice(self, contrast, frame, axis, index):
+        return np.take(self.volume(contrast, frame), index, axis=axis)
+
+def file_version(paths):
+    """Identity of the source files (path, size, mtime) for the ETags."""
+    sha = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        sha.update(f"{path}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return sha.hexdigest()[:16]
+
+def morph4d_source(long_dir, sessions, reg_long_type, contrasts, steps, session_ages, volume_cache_mb):
+    """Frames of the _morph_4D files of every session pair (same index as the chunked store)."""
+    pairs = list(zip(sessions[:-1], sessions[1:]))
+    frames = build_index(pairs, steps, session_ages)
+    contrast_frames = {}
+    for contrast in contrasts:
+        files = [os.path.join(long_dir, f"{a}_to_{b}_{reg_long_type}_{contrast}_morph_4D.nii.gz") for a, b in pairs]
+        contrast_frames[contrast] = [(files[f["pair"]], f["position"]) for f in frames]
+    return NiftiSource(contrast_frames, frames, volume_cache_mb)
+
+def finals_source(template_dir, template_name, sessions, template_path, contrasts, session_ages, volume_cache_mb):
+    """One frame per session: the final template of each session."""
+    frames = [{"session": ses, "age": session_ages.get(ses)} for ses in sessions]
+    if all(f["age"] is not None for f in frames):
+        frames.sort(key=lambda f: f["age"])
+    for t, frame in enumerate(frames):
+        frame["frame"] = t
+    contrast_frames = {
+        contrast: [(os.path.join(template_dir, f["session"], template_path,
+                                 f"sub-{template_name}_{f['session']}_{contrast}.nii.gz"), 0) for f in frames]
+        for contrast in contrasts
+    }
+    return NiftiSource(contrast_frames, frames, volume_cache_mb)
+
+# =====================
+# Tiles
+# =====================
+
+def encode_png(image):
+    """8-bit grayscale PNG of a 2D uint8 array."""
+    height, width = image.shape
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image]).tobytes()
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 6)) + chunk(b"IEND", b""))
+
+def render_tile(data, fmt, vmin=None, vmax=None):
+    """(body, content type, extra headers) of a 2D slice, displayed bottom-up."""
+    view = np.ascontiguousarray(np.flipud(data.T))
+    if fmt == "raw":
+        return view.astype("<f4").tobytes(), "application/octet-stream", {"X-Tile-Shape": f"{view.shape[0]},{view.shape[1]}"}
+    if vmin is None or vmax is None:
+        lower, upper = np.percentile(view, [0.5, 99.5]) if view.size else (0.0, 1.0)
+        vmin = lower if vmin is None else vmin
+        vmax = upper if vmax is None else vmax
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    image = np.clip((view - vmin) * scale, 0, 255).astype(np.uint8)
+    return encode_png(image), "image/png", {}
+
+class TileServer:
+    """asyncio HTTP server of the tiles of a source, with an LRU of rendered tiles."""
+
+    def __init__(self, source, cache_mb=256, threads=4):
+        self.source = source
+        self.cache_bytes = int(cache_mb * 1024 * 1024)
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.ages = np.array([np.nan if f.get("age") is None else f["age"] for f in source.frames])
+
+    def index(self):
+        return {"contrasts": self.source.contrasts, "shape": list(self.source.shape), "frames": self.source.frames}
+
+    def parse_tile(self, path, query):
+        """Tile key (contrast, frame, axis, slice, format, vmin, vmax) of a /tile request."""
+        parts = [unquote(p) for p in path.split("/")[2:]]
+        if len(parts) != 3:
+            raise ValueError("Expected /tile/<contrast>/<axis>/<slice>")
+        contrast, axis_name, index = parts
+        if contrast not in self.source.contrasts:
+            raise KeyError(f"Unknown contrast {contrast}")
+        if axis_name not in AXES:
+            raise ValueError(f"Unknown axis {axis_name} (x, y or z)")
+        axis = AXES[axis_name]
+        index = int(index)
+        if not 0 <= index < self.source.shape[axis]:
+            raise ValueError(f"Slice {index} out of range [0, {self.source.shape[axis]})")
+
+        if "frame" in query:
+            frame = int(query["frame"][0])
+        elif "age" in query:
+            if np.all(np.isnan(self.ages)):
+                raise ValueError("No ages in the frame index, use frame=")
+            frame = int(np.nanargmin(np.abs(self.ages - float(query["age"][0]))))
+        else:
+            frame = 0
+        if not 0 <= frame < len(self.source.frames):
+            raise ValueError(f"Frame {frame} out of range [0, {len(self.source.frames)})")
+
+        fmt = query.get("format", ["png"])[0]
+        if fmt not in ("png", "raw"):
+            raise ValueError(f"Unknown format {fmt} (png or raw)")
+        vmin = float(query["vmin"][0]) if "vmin" in query else None
+        vmax = float(query["vmax"][0]) if "vmax" in query else None
+        return contrast, frame, axis, index, fmt, vmin, vmax
+
+    def etag(self, key):
+        return '"' + hashlib.sha1(f"{self.source.version}:{key}".encode()).hexdigest()[:20] + '"'
+
+    def render(self, key):
+        contrast, frame, axis, index, fmt, vmin, vmax = key
+        return render_tile(self.source.slice(contrast, frame, axis, index), fmt, vmin, vmax)
+
+    async def tile(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        if key not in self.pending:
+            loop = asyncio.get_running_loop()
+            self.pending[key] = loop.run_in_executor(self.executor, self.render, key)
+        try:
+            tile = await self.pending[key]
+        finally:
+            self.pending.pop(key, None)
+
+        size = len(tile[0])
+        if key not in self.cache and size <= self.cache_bytes:
+            self.cache[key] = tile
+            self.cache_size += size
+            while self.cache_size > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_size -= len(evicted[0])
+        return tile
+
+    async def respond(self, method, target, headers):
+        """(status, body, headers) of one request."""
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if method not in ("GET", "HEAD"):
+            return 405, b"Method not allowed\n", {"Content-Type": "text/plain"}
+        if url.path == "/index":
+            return 200, json.dumps(self.index()).encode(), {"Content-Type": "application/json", "Cache-Control": "no-cache"}
+        if not url.path.startswith("/tile/"):
+            return 404, b"Not found\n", {"Content-Type": "text/plain"}
+
+        try:
+            key = self.parse_tile(url.path, query)
+        except (KeyError, ValueError) as e:
+            return 400, f"{e}\n".encode(), {"Content-Type": "text/plain"}
+
+        etag = self.etag(key)
+        cache_headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+        if etag in [t.strip() for t in headers.get("if-none-match", "").split(",")]:
+            return 304, b"", cache_headers
+        try:
+            body, content_type, extra = await self.tile(key)
+        except FileNotFoundError as e:
+            return 404, f"{e}\n".encode(), {"Content-Type": "text/plain"}
+        return 200, body, {"Content-Type": content_type, **cache_headers, **extra}
+
+    async def handle(self, reader, writer):
+        """HTTP/1.1 connection (keep-alive) with GET/HEAD requests."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    status, body, response_headers = await self.respond(method, target, headers)
+                except Exception as e:
+                    print(f"[serve_template] {method} {target}: {e!r}")
+                    status, body, response_headers = 500, f"{e}\n".encode(), {"Content-Type": "text/plain"}
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                reason = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+                          405: "Method Not Allowed", 500: "Internal Server Error"}[status]
+                lines = [f"HTTP/1.1 {status} {reason}", f"Content-Length: {len(body)}",
+                         "Access-Control-Allow-Origin: *", "Access-Control-Expose-Headers: ETag, X-Tile-Shape",
+                         f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                lines += [f"{name}: {value}" for name, value in response_headers.items()]
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+                if method != "HEAD" and status != 304:
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"[serve_template] {len(self.source.contrasts)} contrast(s), {len(self.source.frames)} frames, "
+              f"shape {self.source.shape[:3]}: http://{host}:{port}/index")
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve PNG / float32 tiles of the 4D+t template over HTTP")
+    parser.add_argument("--store", help="Chunked store (utils/template_store.py) to serve")
+    parser.add_argument("--bids_root", help="Root BIDS directory (_morph_4D files or --finals)")
+    parser.add_argument("--template_name", help="Template subject name")
+    parser.add_argument("--sessions", nargs="+", help="List of sessions (ordered, as interpolated)")
+    parser.add_argument("--contrasts", nargs="+", help="Contrasts to serve")
+    parser.add_argument("--reg_long_type", default="CACP_MM", help="name of registration type (default: CACP_MM)")
+    parser.add_argument("--morph-numsteps", type=int, default=10, help="Number of morphing steps (default=10)")
+    parser.add_argument("--morph-step", type=int, default=1, help="Morphing increment (default=1)")
+    parser.add_argument("--finals", action="store_true", help="Serve the final template of each session instead of the morphs")
+    parser.add_argument("--template_path", default="final", help="Subfolder for template (with --finals)")
+    parser.add_argument("--ages", nargs="*", default=[], help="Age of each session, as ses:age")
+    parser.add_argument("--sessions_tsv", help="BIDS sessions.tsv with session_id and age columns")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8021, help="Port (default: 8021)")
+    parser.add_argument("--cache-mb", type=float, default=256, help="Memory for rendered tiles (default: 256)")
+    parser.add_argument("--volume-cache-mb", type=float, default=2048,
+                        help="Memory for decompressed frames of NIfTI sources (default: 2048)")
+    parser.add_argument("--threads", type=int, default=4, help="Number of threads rendering tiles (default: 4)")
+    args = parser.parse_args()
+
+    if args.store:
+        source = StoreSource(args.store)
+    else:
+        if not (args.bids_root and args.template_name and args.sessions and args.contrasts):
+            parser.error("--bids_root, --template_name, --sessions and --contrasts are required without --store")
+        session_ages = load_ages(args.ages, args.sessions_tsv)
+        if args.finals:
+            template_dir = os.path.join(args.bids_root, "derivatives", "template", f"sub-{args.template_name}")
+            source = finals_source(template_dir, args.template_name, args.sessions, args.template_path,
+                                   args.contrasts, session_ages, args.volume_cache_mb)
+        else:
+            long_dir = os.path.join(args.bids_root, "derivatives", "transforms", f"sub-{args.template_name}", "long")
+            source = morph4d_source(long_dir, args.sessions, args.reg_long_type, args.contrasts,
+                                    morph_steps(args.morph_numsteps, args.morph_step), session_ages,
+                                    args.volume_cache_mb)
+
+    try:
+        asyncio.run(TileServer(source, args.cache_mb, args.threads).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
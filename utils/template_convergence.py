@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Convergence of antsMultivariateTemplateConstruction2.sh, from its intermediateTemplates/.
+
+After each iteration k, the template script writes {T}_iteration{k}_{prefix}template{i}.nii.gz
+(one per modality) and {T}_iteration{k}_shapeUpdateWarp.nii.gz. This module compares the
+templates of iterations k - 1 and k within the brain (voxels of template 0 above a fraction of
+its 99.5th percentile, or --mask):
+  - nrms: RMS of the difference / standard deviation of the iteration k template;
+  - cc: Pearson correlation of the two templates;
+  - sharpness: mean gradient magnitude (mm-1) / mean intensity, of the iteration k template;
+  - warp_mean_mm / warp_max_mm: magnitude of the shape update warp.
+Volumes are memory-mapped and summed by z-slabs in float64. Each call adds (or replaces) the
+iteration in a JSON file, and exits with status 0 when the construction has converged: at least
+--min-iterations iterations, the nrms of every modality below --tol and, with --warp-tol, the
+mean shape update below it. Any other status (1, or an error) means "go on", so a failed check
+never stops the construction.
+
+Usage (normally called by antsMultivariateTemplateConstruction2.sh after each iteration, through
+$ANTS_TEMPLATE_CONVERGENCE, see MM_template_construction.py):
+    python -m utils.template_convergence --iteration 2 --prefix MY --modalities 2 --tol 0.01 \\
+        --json tmp_HR/convergence.json tmp_HR/intermediateTemplates
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from utils.jacobian import memmap_volume, field_slab
+
+
+def template_path(directory, transformation, iteration, prefix, modality):
+    return os.path.join(directory, f"{transformation}_iteration{iteration}_{prefix}template{modality}.nii.gz")
+
+
+def update_warp_path(directory, transformation, iteration):
+    return os.path.join(directory, f"{transformation}_iteration{iteration}_shapeUpdateWarp.nii.gz")
+
+
+def brain_threshold(data, fraction=0.1, step=4):
+    """Intensity threshold of the brain: fraction of the 99.5th percentile (on a subsampled grid)."""
+    sample = np.asarray(data[::step, ::step, ::step], dtype=np.float64)
+    sample = sample[sample > 0]
+    if sample.size == 0:
+        return 0.0
+    return fraction * float(np.percentile(sample, 99.5))
+
+
+def slab_mask(mask, threshold, z0, z1):
+    return np.asarray(mask[:, :, z0:z1]) > threshold
+
+
+def template_change(previous, current, mask, threshold, slab_size=16):
+    """(nrms, cc) of two templates on the same grid, within mask > threshold."""
+    n = sa = sb = saa = sbb = sab = sdd = 0.0
+    for z0 in range(0, current.shape[2], slab_size):
+        z1 = min(z0 + slab_size, current.shape[2])
+        inside = slab_mask(mask, threshold, z0, z1)
+        a = np.asarray(previous[:, :, z0:z1], dtype=np.float64)[inside]
+        b = np.asarray(current[:, :, z0:z1], dtype=np.float64)[inside]
+        n += a.size
+        sa += a.sum()
+        sb += b.sum()
+        saa += (a * a).sum()
+        sbb += (b * b).sum()
+        sab += (a * b).sum()
+        sdd += ((b - a) ** 2).sum()
+    if n == 0:
+        return None, None
+    var_a = saa / n - (sa / n) ** 2
+    var_b = sbb / n - (sb / n) ** 2
+    cov = sab / n - (sa / n) * (sb / n)
+    nrms = np.sqrt(sdd / n) / np.sqrt(var_b) if var_b > 0 else None
+    cc = cov / np.sqrt(var_a * var_b) if var_a > 0 and var_b > 0 else None
+    return nrms, cc
+
+
+def sharpness(data, zooms, mask, threshold, slab_size=16):
+    """Mean gradient magnitude (mm-1, central differences) / mean intensity, within mask > threshold."""
+    nz = data.shape[2]
+    n = total = grad_total = 0.0
+    for z0 in range(0, nz, slab_size):
+        z1 = min(z0 + slab_size, nz)
+        h0, h1 = max(z0 - 1, 0), min(z1 + 1, nz)
+        v = np.asarray(data[:, :, h0:h1], dtype=np.float64)
+        grads = [np.gradient(v, zooms[axis], axis=axis) if v.shape[axis] > 1 else np.zeros_like(v)
+                 for axis in range(3)]
+        magnitude = np.sqrt(sum(g ** 2 for g in grads))[:, :, z0 - h0:z0 - h0 + (z1 - z0)]
+        inside = slab_mask(mask, threshold, z0, z1)
+        n += np.count_nonzero(inside)
+        total += v[:, :, z0 - h0:z0 - h0 + (z1 - z0)][inside].sum()
+        grad_total += magnitude[inside].sum()
+    if n == 0 or total == 0:
+        return None
+    return grad_total / total
+
+
+def warp_magnitude(field, mask, threshold, slab_size=8):
+    """(mean, max) displacement (mm) of a (x, y, z, [1,] 3) field, within mask > threshold."""
+    n = total = peak = 0.0
+    for z0 in range(0, field.shape[2], slab_size):
+        z1 = min(z0 + slab_size, field.shape[2])
+        norm = np.linalg.norm(field_slab(field, z0, z1), axis=-1)[slab_mask(mask, threshold, z0, z1)]
+        if norm.size:
+            n += norm.size
+            total += norm.sum()
+            peak = max(peak, float(norm.max()))
+    if n == 0:
+        return None, None
+    return total / n, peak
+
+
+def rounded(value, digits=6):
+    return None if value is None else round(float(value), digits)
+
+
+def iteration_metrics(directory, iteration, prefix="MY", modalities=1, transformation="SyN",
+                      mask_path=None, mask_fraction=0.1, tmpdir=None):
+    """Metrics of one iteration: {"iteration", "modalities": [{...}], "warp_mean_mm", "warp_max_mm"}."""
+    tmpdir = tmpdir or tempfile.mkdtemp(prefix="template_convergence_")
+    try:
+        if mask_path:
+            mask, _ = memmap_volume(mask_path, tmpdir)
+            threshold = 0.5
+        else:
+            mask, _ = memmap_volume(template_path(directory, transformation, iteration, prefix, 0), tmpdir)
+            threshold = brain_threshold(mask, mask_fraction)
+
+        record = {"iteration": iteration, "modalities": []}
+        for modality in range(modalities):
+            current, img = memmap_volume(template_path(directory, transformation, iteration, prefix, modality), tmpdir)
+            entry = {"modality": modality,
+                     "sharpness": rounded(sharpness(current, img.header.get_zooms()[:3], mask, threshold))}
+            previous_path = template_path(directory, transformation, iteration - 1, prefix, modality)
+            if iteration > 0 and os.path.exists(previous_path):
+                previous, _ = memmap_volume(previous_path, tmpdir)
+                nrms, cc = template_change(previous, current, mask, threshold)
+                entry.update({"nrms": rounded(nrms), "cc": rounded(cc)})
+            record["modalities"].append(entry)
+
+        warp_path = update_warp_path(directory, transformation, iteration)
+        if os.path.exists(warp_path):
+            field, _ = memmap_volume(warp_path, tmpdir)
+            warp_mean, warp_max = warp_magnitude(field, mask, threshold)
+            record.update({"warp_mean_mm": rounded(warp_mean), "warp_max_mm": rounded(warp_max)})
+        return record
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def converged(record, tol, warp_tol=None, min_iterations=2):
+    """True when the iteration is at least the min_iterations-th and every change is below tolerance."""
+    if record["iteration"] + 1 < min_iterations:
+        return False
+    changes = [entry.get("nrms") for entry in record["modalities"]]
+    if not changes or any(change is None or change >= tol for change in changes):
+        return False
+    if warp_tol is not None and (record.get("warp_mean_mm") is None or record["warp_mean_mm"] >= warp_tol):
+        return False
+    return True
+
+
+def update_curve(json_path, record, settings):
+    """Add (or replace) an iteration in the JSON curve file and return its content."""
+    curve = {"iterations": []}
+    if os.path.exists(json_path):
+        with open(json_path, encoding="utf-8") as f:
+            curve = json.load(f)
+    curve.update(settings)
+    curve["iterations"] = [r for r in curve.get("iterations", []) if r["iteration"] < record["iteration"]] + [record]
+    curve["last_iteration"] = record["iteration"]
+    curve["converged"] = record["converged"]
+    curve["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(curve, f, indent=1)
+    os.replace(tmp_path, json_path)
+    return curve
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convergence check of antsMultivariateTemplateConstruction2.sh iterations")
+    parser.add_argument("directory", help="intermediateTemplates directory of the template construction")
+    parser.add_argument("--iteration", type=int, required=True, help="Iteration just completed (0-based)")
+    parser.add_argument("--prefix", default="MY", help="OutputPrefix of the template construction, without directory (default: MY)")
+    parser.add_argument("--modalities", type=int, default=1, help="Number of modalities (default: 1)")
+    parser.add_argument("--transformation", default="SyN", help="Transformation type of the file names (default: SyN)")
+    parser.add_argument("--tol", type=float, required=True, help="Tolerance on the normalised RMS change of every modality")
+    parser.add_argument("--warp-tol", type=float, default=None, help="Tolerance on the mean shape update (mm), optional")
+    parser.add_argument("--min-iterations", type=int, default=2, help="Iterations always run (default: 2)")
+    parser.add_argument("--mask", default=None, help="Brain mask on the template grid (default: threshold of template 0)")
+    parser.add_argument("--mask-fraction", type=float, default=0.1,
+                        help="Without --mask, brain = template 0 above this fraction of its 99.5th percentile (default: 0.1)")
+    parser.add_argument("--json", required=True, help="JSON file of the per-iteration curve (updated)")
+    args = parser.parse_args()
+
+    record = iteration_metrics(args.directory, args.iteration, args.prefix, args.modalities,
+                               args.transformation, args.mask, args.mask_fraction)
+    record["converged"] = converged(record, args.tol, args.warp_tol, args.min_iterations)
+    update_curve(args.json, record, {"tol": args.tol, "warp_tol": args.warp_tol, "min_iterations": args.min_iterations})
+
+    changes = ", ".join(f"template{e['modality']} nrms={e.get('nrms')} cc={e.get('cc')} sharpness={e['sharpness']}"
+                        for e in record["modalities"])
+    print(f"[convergence] iteration {args.iteration}: {changes}, warp mean={record.get('warp_mean_mm')} mm"
+          f"{' -> converged' if record['converged'] else ''}")
+    sys.exit(0 if record["converged"] else 1)
+
+
+if __name__ == "__main__":
+    main()
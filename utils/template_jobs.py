@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Local scheduler for the job scripts of antsMultivariateTemplateConstruction2.sh (-c 6).
+
+With -c 2 every job script gets one ANTSpexec.sh slot, whatever the size of its images, and
+one failed or hung registration stalls the iteration. With -c 6 the template script writes
+the same job*.sh scripts and hands them to this scheduler, which:
+  - estimates the memory of each job from the dimensions (NIfTI headers) of the images it
+    references, and starts a job only when it fits in the memory budget (the largest jobs
+    first; a job that does not fit lets smaller ones start). The estimate is calibrated by
+    the peak RSS of the jobs already finished;
+  - gives each job ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS threads (--threads-per-job, more when
+    fewer jobs than free cores remain, so the tail of an iteration still uses every core);
+  - kills a job running longer than --timeout (with its whole process group) and retries
+    failed jobs up to --retries times, exiting with status 1 if some job still fails;
+  - prints every job state change and a periodic summary, and keeps a JSON status file
+    (--status) up to date. Each attempt is traced like run_command (BABACOOL_TRACE).
+
+Usage (normally called by antsMultivariateTemplateConstruction2.sh -c 6, through
+$ANTS_TEMPLATE_SCHEDULER, see MM_template_construction.py):
+    python -m utils.template_jobs -j 24 --threads-per-job 2 --timeout 14400 --retries 1 tmp_HR/job*.sh
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import argparse
+import threading
+import subprocess
+import numpy as np
+import nibabel as nib
+
+from utils.runner import itk_env, write_trace
+
+IMAGE = re.compile(r"[^\s,\[\]=;>]+\.nii(?:\.gz)?")
+
+# antsRegistration memory model: a fixed overhead plus, per voxel of the largest image,
+# its input images and about VOLUMES_PER_JOB float volumes (pyramids, forward / inverse /
+# update displacement fields, metric gradients)
+BASE_MEMORY = 256 * 1024 ** 2
+VOLUMES_PER_JOB = 40
+
+def available_memory():
+    """Available memory in bytes (MemAvailable of /proc/meminfo, else the physical memory)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def script_images(script):
+    """Existing NIfTI files referenced by a job script."""
+    with open(script) as f:
+        text = f.read()
+    return sorted({path for path in IMAGE.findall(text) if os.path.exists(path)})
+
+def estimate_memory(script):
+    """Estimated peak memory (bytes) of a job script, from the dimensions of its images."""
+    images = script_images(script)
+    voxels = []
+    for path in images:
+        try:
+            voxels.append(int(np.prod(nib.load(path).header.get_data_shape()[:3])))
+        except (OSError, nib.filebasedimages.ImageFileError):
+            # being written or not an image: counted with the others, not in the voxels
+            pass
+    if not voxels:
+        return BASE_MEMORY
+    return BASE_MEMORY + max(voxels) * 4 * (len(images) + VOLUMES_PER_JOB)
+
+def gb(n):
+    return f"{n / 1024 ** 3:.1f} GB"
+
+class Job:
+    """One job script and the state of its current attempt."""
+
+    def __init__(self, script):
+        self.script = script
+        self.name = os.path.basename(script)
+        self.estimate = estimate_memory(script)
+        self.status = "pending"
+        self.attempt = 0
+        self.threads = 0
+        self.start = None
+        self.wall = None
+        self.max_rss = None
+        self.returncode = None
+        self.timed_out = False
+        self.proc = None
+        self.log_path = os.path.splitext(script)[0] + "_scheduler.txt"
+
+    def state(self, memory):
+        return {"script": self.script, "status": self.status, "attempt": self.attempt, "threads": self.threads,
+                "estimated_bytes": memory, "elapsed_s": round(time.time() - self.start, 1) if self.start else None,
+                "wall_s": self.wall, "max_rss_bytes": self.max_rss, "returncode": self.returncode}
+
+class Scheduler:
+    """Memory-aware pool of job scripts run with sh on the local host."""
+
+    def __init__(self, scripts, cores, threads_per_job=1, memory=None, timeout=None, retries=1,
+                 status_path=None, status_interval=60, shell="sh"):
+        self.jobs = [Job(script) for script in scripts]
+        self.cores = max(1, cores)
+        self.threads_per_job = max(1, threads_per_job)
+        self.memory = memory or int(available_memory() * 0.9)
+        self.timeout = timeout
+        self.retries = retries
+        self.status_path = status_path
+        self.status_interval = status_interval
+        self.shell = shell
+        self.scale = 1.0
+        self.finished = queue.Queue()
+
+    def needed(self, job):
+        """Memory admitted for a job: its estimate, scaled by the worst observed RSS / estimate."""
+        return int(job.estimate * self.scale)
+
+    def log(self, message):
+        print(f"[template_jobs] {message}", flush=True)
+
+    def write_status(self):
+        if not self.status_path:
+            return
+        tmp_path = f"{self.status_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"updated": time.strftime("%Y-%m-%dT%H:%M:%S"), "cores": self.cores,
+                       "memory_bytes": self.memory, "memory_scale": round(self.scale, 3),
+                       "jobs": [job.state(self.needed(job)) for job in self.jobs]}, f, indent=1)
+        os.replace(tmp_path, self.status_path)
+
+    def summary(self, running):
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        threads = sum(job.threads for job in running)
+        memory = sum(self.needed(job) for job in running)
+        self.log(f"{counts.get('done', 0)}/{len(self.jobs)} done, {len(running)} running, "
+                 f"{counts.get('pending', 0)} pending, {counts.get('failed', 0)} failed, "
+                 f"{threads}/{self.cores} threads, {gb(memory)}/{gb(self.memory)}")
+
+    def execute(self, job):
+        """Run one attempt of a job (in its own thread and process group)."""
+        t0 = time.perf_counter()
+        job.returncode = None
+        job.proc = None
+        try:
+            with open(job.log_path, "a") as log:
+                log.write(f"=== attempt {job.attempt}, {job.threads} thread(s) ===\n")
+                log.flush()
+                job.proc = subprocess.Popen([self.shell, job.script], stdout=log, stderr=subprocess.STDOUT,
+                                            env=itk_env(job.threads), start_new_session=True)
+                _, status, rusage = os.wait4(job.proc.pid, 0)
+            job.returncode = os.waitstatus_to_exitcode(status)
+            job.wall = round(time.perf_counter() - t0, 3)
+            job.max_rss = rusage.ru_maxrss * 1024
+            write_trace({"start": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(job.start)),
+                         "tool": "template_job", "cmd": [self.shell, job.script], "script": "template_jobs",
+                         "host": socket.gethostname(), "attempt": job.attempt, "threads": job.threads,
+                         "wall_s": job.wall, "user_s": round(rusage.ru_utime, 3), "sys_s": round(rusage.ru_stime, 3),
+                         "max_rss_kb": rusage.ru_maxrss, "exit_status": job.returncode})
+        except Exception as e:
+            # not started (or not waited for): a failed attempt, retried or failed by complete()
+            self.log(f"{job.name}: could not run ({e})")
+            if job.returncode is None:
+                job.returncode = -1
+                job.wall = round(time.perf_counter() - t0, 3)
+        finally:
+            self.finished.put(job)
+
+    def launch(self, job, pending_count, free_cores):
+        job.attempt += 1
+        job.threads = max(1, min(free_cores, max(self.threads_per_job, free_cores // max(1, pending_count))))
+        job.status = "running"
+        job.start = time.time()
+        job.timed_out = False
+        self.log(f"{job.name}: running (attempt {job.attempt}, {job.threads} thread(s), ~{gb(self.needed(job))})")
+        threading.Thread(target=self.execute, args=(job,), daemon=True).start()
+
+    def kill(self, job):
+        """Terminate the process group of a job, then kill it if it is still there."""
+        job.timed_out = True
+        # this attempt's process: job.proc is replaced if the job is retried meanwhile
+        proc = job.proc
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            deadline = time.time() + 10
+            # (signal 0 only probes the group: execute() is the one waiting for the process)
+            while time.time() < deadline:
+                os.killpg(proc.pid, 0)
+                time.sleep(0.2)
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def complete(self, job):
+        """Record a finished attempt: done, retried or failed."""
+        if job.returncode == 0 and not job.timed_out:
+            job.status = "done"
+            if job.max_rss:
+                self.scale = max(self.scale, job.max_rss / job.estimate)
+            self.log(f"{job.name}: done in {job.wall:.0f} s (peak {gb(job.max_rss)}, estimated {gb(self.needed(job))})")
+            return
+        reason = f"timed out after {self.timeout} s" if job.timed_out else f"exit status {job.returncode}"
+        if job.attempt <= self.retries:
+            job.status = "pending"
+            self.log(f"{job.name}: {reason}, retrying ({job.attempt}/{self.retries}), see {job.log_path}")
+        else:
+            job.status = "failed"
+            self.log(f"{job.name}: FAILED ({reason}), see {job.log_path}")
+
+    def run(self):
+        """Run all the jobs; returns the failed ones."""
+        self.log(f"{len(self.jobs)} job(s) on {self.cores} core(s), {gb(self.memory)} memory budget")
+        # largest jobs first, the small ones fill the remaining memory and cores
+        order = sorted(self.jobs, key=lambda job: -job.estimate)
+        running = set()
+        last_summary = time.time()
+        self.write_status()
+
+        while running or any(job.status == "pending" for job in order):
+            pending = [job for job in order if job.status == "pending"]
+            for job in pending:
+                free_cores = self.cores - sum(j.threads for j in running)
+                free_memory = self.memory - sum(self.needed(j) for j in running)
+                if free_cores < 1:
+                    break
+                # always run at least one job, even if larger than the budget
+                if running and self.needed(job) > free_memory:
+                    continue
+                self.launch(job, len([j for j in order if j.status == "pending"]), free_cores)
+                running.add(job)
+            self.write_status()
+
+            try:
+                job = self.finished.get(timeout=1)
+                running.discard(job)
+                self.complete(job)
+                self.write_status()
+            except queue.Empty:
+                pass
+
+            if self.timeout:
+                for job in list(running):
+                    if job.proc is not None and not job.timed_out and time.time() - job.start > self.timeout:
+                        self.log(f"{job.name}: timeout ({self.timeout} s), killing")
+                        threading.Thread(target=self.kill, args=(job,), daemon=True).start()
+
+            if time.time() - last_summary >= self.status_interval:
+                self.summary(running)
+                last_summary = time.time()
+
+        self.summary(running)
+        self.write_status()
+        return [job for job in self.jobs if job.status == "failed"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the job scripts of antsMultivariateTemplateConstruction2.sh on the local host")
+    parser.add_argument("scripts", nargs="+", help="Job scripts (job*.sh)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of cores to use (-j of the template script, default: all)")
+    parser.add_argument("--threads-per-job", type=int, default=1,
+                        help="Minimum ITK threads of a job (default: 1, more when fewer jobs than free cores remain)")
+    parser.add_argument("--memory", type=float, default=None,
+                        help="Memory budget in GB (default: 90%% of the available memory)")
+    parser.add_argument("--timeout", type=float, default=None, help="Time limit of one attempt of a job, in seconds")
+    parser.add_argument("--retries", type=int, default=1, help="Attempts after a failure or timeout (default: 1)")
+    parser.add_argument("--status", default=None, help="JSON status file, updated while the jobs run")
+    parser.add_argument("--status-interval", type=float, default=60, help="Seconds between progress summaries (default: 60)")
+    args = parser.parse_args()
+
+    scheduler = Scheduler(args.scripts, args.jobs, args.threads_per_job,
+                          int(args.memory * 1024 ** 3) if args.memory else None,
+                          args.timeout, args.retries, args.status, args.status_interval)
+    failed = scheduler.run()
+    if failed:
+        print(f"[template_jobs] {len(failed)} job(s) failed: {', '.join(job.name for job in failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
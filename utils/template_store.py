@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Chunked, time-indexed store of the 4D+t template.
+
+interpolate_long_template.py writes one {ses_from}_to_{ses_to}_{reg}_{contrast}_morph_4D.nii.gz
+per session pair: reading one slice, or one voxel, across all time points decompresses every
+volume of every file. export_store() converts these files once into a directory of
+(x, y, z, t) chunks, one file per chunk:
+
+    <store>/store.json              shape, chunks, dtype, geometry and the frame index
+    <store>/<contrast>/i.j.k.t      raw C-order chunk
+    <store>/<contrast>/i.j.k.t.z    zlib compressed chunk (kept only when smaller than raw)
+
+Chunks that are entirely 0 (background of padded templates) are not written. The frames of
+all session pairs are ordered by age when the age of every session is known (file order
+otherwise), each frame of the index recording its session pair, its step, its blend weight
+a (frame = a * ses_from + (1 - a) * ses_to, as in interpolate_long_template.py) and its age.
+
+TemplateStore gives a NumPy-like read access that only loads the chunks a query touches:
+
+    store = TemplateStore("BaBa21.t4d")
+    axial = store["T1w"][:, :, 60, :]      # (x, y, t) slice over time
+    trajectory = store["T1w"][80, 95, 60]   # (t,) single voxel
+    store.ages                              # age of each frame
+
+Usage (from the repository root):
+    python -m utils.template_store --long_dir BaBa21_openneuro/derivatives/transforms/sub-BaBa21/long \\
+      --sessions ses-3 ses-2 ses-1 ses-0 --reg_long_type desc-MM --contrasts T1w T2w \\
+      --ages ses-0:0.04 ses-1:0.5 ses-2:2 ses-3:5 --output BaBa21.t4d --threads 8
+"""
+
+import os
+import json
+import zlib
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+import pandas as pd
+
+from utils.nifti_stream import iter_volumes
+from utils.morph import compute_blending
+
+STORE_VERSION = 1
+
+# =====================
+# Frame index
+# =====================
+
+def morph_steps(numsteps, step):
+    """(n, blend a) of the frames of a morph 4D file (blend rounded as interpolate_long_template.py)."""
+    return [(n, compute_blending(n, numsteps)[0]) for n in range(0, numsteps + 1, step)]
+
+def load_ages(ages=None, sessions_tsv=None):
+    """{session: age} from ses:age items and/or a BIDS sessions.tsv (session_id, age columns)."""
+    session_ages = {}
+    if sessions_tsv:
+        df = pd.read_csv(sessions_tsv, sep="\t")
+        if "session_id" in df.columns and "age" in df.columns:
+            session_ages.update({ses: float(age) for ses, age in zip(df["session_id"], df["age"]) if pd.notna(age)})
+    for item in ages or []:
+        ses, age = item.split(":", 1)
+        session_ages[ses] = float(age)
+    return session_ages
+
+def build_index(pairs, steps, session_ages):
+    """
+    Frame index of the morph series of each pair: list of dicts (ordered by age if every
+    session age is known), with the file and position of each frame.
+    """
+    frames = []
+    for pair_index, (ses_from, ses_to) in enumerate(pairs):
+        for position, (n, blend) in enumerate(steps):
+            age = None
+            if ses_from in session_ages and ses_to in session_ages:
+                age = round(blend * session_ages[ses_from] + (1 - blend) * session_ages[ses_to], 6)
+            frames.append({"ses_from": ses_from, "ses_to": ses_to, "step": n, "blend": blend, "age": age,
+                           "pair": pair_index, "position": position})
+    if frames and all(frame["age"] is not None for frame in frames):
+        frames.sort(key=lambda frame: frame["age"])
+    for t, frame in enumerate(frames):
+        frame["frame"] = t
+    return frames
+
+# =====================
+# Chunks
+# =====================
+
+def chunk_name(index):
+    return ".".join(str(i) for i in index)
+
+def chunk_bounds(shape, chunks, index):
+    """Slices of the array covered by the chunk index."""
+    return tuple(slice(i * c, min((i + 1) * c, n)) for i, c, n in zip(index, chunks, shape))
+
+def write_chunk(directory, index, data, compression, level):
+    """Write one chunk (C order), compressed only if that makes it smaller; skip all-zero chunks."""
+    if not data.any():
+        return 0
+    raw = np.ascontiguousarray(data).tobytes()
+    path = os.path.join(directory, chunk_name(index))
+    if compression == "zlib":
+        packed = zlib.compress(raw, level)
+        if len(packed) < len(raw):
+            with open(path + ".z", "wb") as f:
+                f.write(packed)
+            return len(packed)
+    with open(path, "wb") as f:
+        f.write(raw)
+    return len(raw)
+
+def read_chunk(directory, index, shape, dtype):
+    """Chunk of the given (edge-clipped) shape; zeros if it was not written."""
+    path = os.path.join(directory, chunk_name(index))
+    if os.path.exists(path + ".z"):
+        with open(path + ".z", "rb") as f:
+            raw = zlib.decompress(f.read())
+    elif os.path.exists(path):
+        with open(path, "rb") as f:
+            raw = f.read()
+    else:
+        return np.zeros(shape, dtype=dtype)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+# =====================
+# Export
+# =====================
+
+def export_store(output, contrast_files, frames, chunks=(32, 32, 32, 16), compression="zlib", level=4,
+                 threads=1, overwrite=False):
+    """
+    Write the store from {contrast: [4D file of each pair]} and the frame index of build_index().
+    The 4D files are read once, sequentially; only the frames of the time chunks being
+    filled are kept in memory.
+    """
+    if os.path.exists(output):
+        if not overwrite:
+            raise FileExistsError(f"{output} already exists (use --overwrite)")
+        shutil.rmtree(output)
+    os.makedirs(output)
+
+    n_frames = len(frames)
+    reference = nib.load(str(next(iter(contrast_files.values()))[0]))
+    spatial = tuple(reference.shape[:3])
+    shape = spatial + (n_frames,)
+    chunks = tuple(int(c) for c in chunks)
+    chunk_counts = [int(np.ceil(n / c)) for n, c in zip(shape, chunks)]
+    frame_of = {(frame["pair"], frame["position"]): frame["frame"] for frame in frames}
+
+    stored_bytes = 0
+    for contrast, files in contrast_files.items():
+        directory = os.path.join(output, contrast)
+        os.makedirs(directory)
+        print(f"[template_store] {contrast}: {n_frames} frames from {len(files)} files")
+
+        # time chunk -> (buffer, frames received)
+        pending = {}
+
+        def flush(tc):
+            buffer, _ = pending.pop(tc)
+            indices = [(i, j, k) for i in range(chunk_counts[0]) for j in range(chunk_counts[1])
+                       for k in range(chunk_counts[2])]
+
+            def process(ijk):
+                bounds = chunk_bounds(spatial, chunks[:3], ijk)
+                return write_chunk(directory, ijk + (tc,), buffer[bounds], compression, level)
+
+            with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                return sum(executor.map(process, indices))
+
+        for pair_index, path in enumerate(files):
+            img = nib.load(str(path))
+            if tuple(img.shape[:3]) != spatial or not np.allclose(img.affine, reference.affine, atol=1e-4):
+                raise ValueError(f"{path} is not on the grid of {reference.get_filename()}")
+            for position, volume in enumerate(iter_volumes(path)):
+                if (pair_index, position) not in frame_of:
+                    raise ValueError(f"{path} has more frames than the morph steps ({position + 1})")
+                t = frame_of[(pair_index, position)]
+                tc = t // chunks[3]
+                if tc not in pending:
+                    length = min(chunks[3], n_frames - tc * chunks[3])
+                    pending[tc] = (np.zeros(spatial + (length,), dtype=np.float32), 0)
+                buffer, received = pending[tc]
+                buffer[..., t - tc * chunks[3]] = volume
+                pending[tc] = (buffer, received + 1)
+                if received + 1 == buffer.shape[3]:
+                    stored_bytes += flush(tc)
+        if pending:
+            raise ValueError(f"Missing frames for {contrast}: check --morph-numsteps / --morph-step")
+
+    metadata = {
+        "version": STORE_VERSION,
+        "shape": list(shape),
+        "chunks": list(chunks),
+        "dtype": "float32",
+        "compression": compression,
+        "affine": reference.affine.tolist(),
+        "zooms": [float(z) for z in reference.header.get_zooms()[:3]],
+        "contrasts": list(contrast_files),
+        "sources": {contrast: [str(f) for f in files] for contrast, files in contrast_files.items()},
+        "frames": frames,
+    }
+    with open(os.path.join(output, "store.json"), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=1)
+    print(f"[template_store] Wrote {output} ({stored_bytes / 1e6:.1f} MB of chunks)")
+    return output
+
+# =====================
+# Read API
+# =====================
+
+class ChunkedArray:
+    """One contrast of a store, indexed like a (x, y, z, t) NumPy array (integers and slices)."""
+
+    def __init__(self, directory, shape, chunks, dtype):
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _normalize(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) != self.ndim:
+            raise IndexError(f"Too many indices for a {self.ndim}D store")
+
+        ranges, squeeze = [], []
+        for axis, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                ranges.append(range(*k.indices(n)))
+            elif isinstance(k, (int, np.integer)):
+                index = int(k) + n if k < 0 else int(k)
+                if not 0 <= index < n:
+                    raise IndexError(f"Index {k} out of bounds for axis {axis} of size {n}")
+                ranges.append(range(index, index + 1))
+                squeeze.append(axis)
+            else:
+                raise TypeError("Only integers and slices are supported")
+        return ranges, tuple(squeeze)
+
+    def __getitem__(self, key):
+        ranges, squeeze = self._normalize(key)
+        out = np.zeros(tuple(len(r) for r in ranges), dtype=self.dtype)
+        if out.size == 0:
+            return out.squeeze(axis=squeeze)
+
+        # chunks touched along each axis, with the positions of the selected indices inside them
+        per_axis = []
+        for r, c in zip(ranges, self.chunks):
+            indices = np.asarray(r)
+            chunk_ids = indices // c
+            per_axis.append([(int(ci), indices[chunk_ids == ci] - ci * c, np.nonzero(chunk_ids == ci)[0])
+                             for ci in np.unique(chunk_ids)])
+
+        for ci, li, oi in per_axis[0]:
+            for cj, lj, oj in per_axis[1]:
+                for ck, lk, ok in per_axis[2]:
+                    for ct, lt, ot in per_axis[3]:
+                        index = (ci, cj, ck, ct)
+                        bounds = chunk_bounds(self.shape, self.chunks, index)
+                        chunk = read_chunk(self.directory, index, tuple(b.stop - b.start for b in bounds), self.dtype)
+                        out[np.ix_(oi, oj, ok, ot)] = chunk[np.ix_(li, lj, lk, lt)]
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+class TemplateStore:
+    """Read access to a store written by export_store()."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, "store.json"), "r", encoding="utf-8") as f:
+            self.metadata = json.load(f)
+        if self.metadata.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported store version {self.metadata.get('version')} in {self.path}")
+        self.shape = tuple(self.metadata["shape"])
+        self.chunks = tuple(self.metadata["chunks"])
+        self.affine = np.array(self.metadata["affine"])
+        self.contrasts = self.metadata["contrasts"]
+        self.frames = self.metadata["frames"]
+
+    @property
+    def ages(self):
+        return np.array([np.nan if f["age"] is None else f["age"] for f in self.frames])
+
+    def __getitem__(self, contrast):
+        if contrast not in self.contrasts:
+            raise KeyError(f"No contrast {contrast} in {self.path} ({', '.join(self.contrasts)})")
+        return ChunkedArray(os.path.join(self.path, contrast), self.shape, self.chunks, self.metadata["dtype"])
+
+    def nearest_frame(self, age):
+        """Index of the frame closest to age."""
+        return int(np.nanargmin(np.abs(self.ages - age)))
+
+    def frame_image(self, contrast, frame):
+        """One time point as a NIfTI image."""
+        return nib.Nifti1Image(self[contrast][:, :, :, frame], self.affine)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the morph 4D files of interpolate_long_template.py "
+                                                 "to a chunked, time-indexed store")
+    parser.add_argument("--long_dir", required=True, help="transforms/sub-<name>/long folder with the _morph_4D files")
+    parser.add_argument("--sessions", nargs="+", required=True, help="List of sessions (ordered, as interpolated)")
+    parser.add_argument("--reg_long_type", default="CACP_MM", help="name of registration type (default: CACP_MM)")
+    parser.add_argument("--contrasts", nargs="+", required=True, help="Interpolated contrasts")
+    parser.add_argument("--morph-numsteps", type=int, default=10, help="Number of morphing steps (default=10)")
+    parser.add_argument("--morph-step", type=int, default=1, help="Morphing increment (default=1)")
+    parser.add_argument("--ages", nargs="*", default=[], help="Age of each session, as ses:age (e.g. ses-0:0.04)")
+    parser.add_argument("--sessions_tsv", help="BIDS sessions.tsv with session_id and age columns")
+    parser.add_argument("--output", required=True, help="Store directory")
+    parser.add_argument("--chunks", nargs=4, type=int, default=[32, 32, 32, 16],
+                        help="Chunk size along x y z t (default: 32 32 32 16)")
+    parser.add_argument("--compression", choices=["zlib", "none"], default="zlib",
+                        help="Per-chunk compression (default: zlib)")
+    parser.add_argument("--level", type=int, default=4, help="zlib compression level (default: 4)")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads writing chunks (default: 1)")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing store")
+    args = parser.parse_args()
+
+    pairs = list(zip(args.sessions[:-1], args.sessions[1:]))
+    contrast_files = {
+        contrast: [os.path.join(args.long_dir, f"{ses_from}_to_{ses_to}_{args.reg_long_type}_{contrast}_morph_4D.nii.gz")
+                   for ses_from, ses_to in pairs]
+        for contrast in args.contrasts
+    }
+    missing = [f for files in contrast_files.values() for f in files if not os.path.exists(f)]
+    if missing:
+        print("Missing 4D files:")
+        for f in missing:
+            print(" -", f)
+        exit(1)
+
+    frames = build_index(pairs, morph_steps(args.morph_numsteps, args.morph_step),
+                         load_ages(args.ages, args.sessions_tsv))
+    export_store(args.output, contrast_files, frames, args.chunks, args.compression, args.level,
+                 args.threads, args.overwrite)
+
+if __name__ == "__main__":
+    main()
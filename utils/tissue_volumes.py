@@ -0,0 +1,67 @@
+"""
+Tissue volumes of the interpolated TPM frames, streamed to a tidy CSV.
+
+interpolate_long_template.py --morph-volumes WM:<WM TPM contrast> ... calls frame_volumes() on each
+TPM frame while it is in memory (before it is streamed to the 4D file or dropped), so the
+growth trajectories need neither the _morph_ frames nor a second pass over them. Per frame and
+tissue, the CSV has the probabilistic volume sum(p) * dv and the thresholded volume
+#(p >= threshold) * dv, in mm3 with the voxel sizes of the frame header (the ses_to grid).
+"""
+
+import csv
+import numpy as np
+
+FIELDS = ["pair", "ses_from", "ses_to", "step", "blend", "age", "tissue", "volume_prob_mm3", "volume_thr_mm3"]
+
+def parse_tissues(items, contrasts):
+    """[(tissue, contrast)] of tissue:contrast items, the contrasts being interpolated ones."""
+    tissues = []
+    for item in items:
+        tissue, sep, contrast = item.partition(":")
+        if not sep or contrast not in contrasts:
+            raise ValueError(f"--morph-volumes {item}: expected tissue:contrast with a contrast of --contrasts_to_interpolate")
+        tissues.append((tissue, contrast))
+    return tissues
+
+def voxel_volume(img):
+    """Voxel volume (mm3) from the header voxel sizes."""
+    return float(np.prod(img.header.get_zooms()[:3]))
+
+def frame_volumes(data, dv, threshold=0.5, slab_size=32):
+    """(probabilistic, thresholded) volume of a TPM frame, summed by z-slabs in float64."""
+    prob = count = 0.0
+    for z0 in range(0, data.shape[2], slab_size):
+        p = np.asarray(data[:, :, z0:z0 + slab_size], dtype=np.float64)
+        prob += p.sum()
+        count += np.count_nonzero(p >= threshold)
+    return prob * dv, count * dv
+
+class VolumeTable:
+    """CSV of the tissue volumes of the frames, one row per frame and tissue, flushed as written."""
+
+    def __init__(self, path, ages=None):
+        self.path = path
+        self.ages = ages or {}
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+        self.writer.writeheader()
+        self.rows = 0
+
+    def frame_age(self, ses_from, ses_to, blend):
+        """Age of the frame a * ses_from + (1 - a) * ses_to, empty if a session age is unknown."""
+        if ses_from not in self.ages or ses_to not in self.ages:
+            return ""
+        return round(blend * self.ages[ses_from] + (1 - blend) * self.ages[ses_to], 6)
+
+    def add(self, ses_from, ses_to, step, blend, volumes):
+        """Rows of one frame, volumes being {tissue: (probabilistic, thresholded)}."""
+        age = self.frame_age(ses_from, ses_to, blend)
+        for tissue, (prob, thr) in volumes.items():
+            self.writer.writerow({"pair": f"{ses_from}_to_{ses_to}", "ses_from": ses_from, "ses_to": ses_to,
+                                  "step": step, "blend": blend, "age": age, "tissue": tissue,
+                                  "volume_prob_mm3": round(prob, 4), "volume_thr_mm3": round(thr, 4)})
+            self.rows += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
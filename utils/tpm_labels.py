@@ -0,0 +1,9 @@
+"""
+BIDS labels of the thresholded TPM written by postprocessing/correct_TPM.py, shared with the
+pipeline specs (utils/pipeline.py derives TPM_label from TPM_threshold with the same rule).
+"""
+
+
+def threshold_label(threshold):
+    """BIDS desc label of a TPM threshold (0.2 -> thr0p2)."""
+    return f"thr{str(float(threshold)).replace('.', 'p')}"
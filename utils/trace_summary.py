@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Summarize a JSONL trace written by utils.runner (BABACOOL_TRACE).
+
+Ranks the external tools (or scripts, steps, subjects, sessions...) by total wall time,
+with CPU time, peak memory and I/O.
+
+Usage (from the repository root):
+    python -m utils.trace_summary traces/ses-2.jsonl --by tool step --top 15
+"""
+
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Warning: skipping malformed line {line_number} in {path}", file=sys.stderr)
+    return records
+
+def summarize(records, key):
+    """Aggregate records per value of `key` (missing tags are grouped as '-')."""
+    groups = defaultdict(lambda: {"count": 0, "failed": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                  "max_rss_kb": 0, "read_bytes": 0, "write_bytes": 0})
+    for r in records:
+        g = groups[str(r.get(key, "-"))]
+        g["count"] += 1
+        g["failed"] += int(r.get("exit_status", 0) != 0)
+        g["wall_s"] += r.get("wall_s", 0.0)
+        g["cpu_s"] += r.get("user_s", 0.0) + r.get("sys_s", 0.0)
+        g["max_rss_kb"] = max(g["max_rss_kb"], r.get("max_rss_kb", 0))
+        g["read_bytes"] += r.get("read_bytes", 0)
+        g["write_bytes"] += r.get("write_bytes", 0)
+    return sorted(groups.items(), key=lambda item: item[1]["wall_s"], reverse=True)
+
+def format_bytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024:
+            return f"{n:.0f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    h, rem = divmod(int(seconds), 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}h{m:02d}m{s:02d}s" if h else f"{m}m{s:02d}s"
+
+def print_table(key, rows, total_wall, top):
+    print(f"\n=== by {key} ===")
+    print(f"{key:<40} {'runs':>5} {'fail':>4} {'wall':>11} {'%wall':>6} {'cpu':>11} {'cpu/wall':>8} {'peakRSS':>8} {'read':>8} {'write':>8}")
+    for name, g in rows[:top]:
+        share = 100 * g["wall_s"] / total_wall if total_wall else 0
+        ratio = g["cpu_s"] / g["wall_s"] if g["wall_s"] else 0
+        print(f"{name[:40]:<40} {g['count']:>5} {g['failed']:>4} {format_duration(g['wall_s']):>11} {share:>5.1f}% "
+              f"{format_duration(g['cpu_s']):>11} {ratio:>8.2f} {format_bytes(g['max_rss_kb'] * 1024):>8} "
+              f"{format_bytes(g['read_bytes']):>8} {format_bytes(g['write_bytes']):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank the slowest tools and stages from BABACOOL JSONL traces")
+    parser.add_argument("traces", nargs="+", help="JSONL trace file(s) written with BABACOOL_TRACE")
+    parser.add_argument("--by", nargs="+", default=["tool", "script", "step"],
+                        help="Tags to group by (default: tool script step; also subject, session, host...)")
+    parser.add_argument("--top", type=int, default=20, help="Number of rows per table (default: 20)")
+    parser.add_argument("--slowest", type=int, default=10, help="Number of slowest single commands listed (default: 10)")
+    args = parser.parse_args()
+
+    records = load_records(args.traces)
+    if not records:
+        print("No trace records found.")
+        return
+
+    total_wall = sum(r.get("wall_s", 0.0) for r in records)
+    print(f"{len(records)} commands, total wall time {format_duration(total_wall)}")
+
+    for key in args.by:
+        print_table(key, summarize(records, key), total_wall, args.top)
+
+    if args.slowest:
+        print(f"\n=== {args.slowest} slowest commands ===")
+        for r in sorted(records, key=lambda r: r.get("wall_s", 0.0), reverse=True)[:args.slowest]:
+            tags = " ".join(f"{k}={r[k]}" for k in ("subject", "session", "step") if k in r)
+            print(f"{format_duration(r.get('wall_s', 0.0)):>11}  {r.get('tool', '?'):<30} {tags}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""
+ITK affine transforms and in-process resampling.
+
+An ITK affine (e.g. antsRegistration *0GenericAffine.mat) maps a point of the fixed
+(reference) image to the moving image, in LPS physical coordinates:
+    y = M (x - c) + c + t
+NIfTI affines are in RAS, so the reference voxel -> moving voxel mapping is
+    inv(A_moving) @ D @ T_itk @ D @ A_reference,   D = diag(-1, -1, 1, 1)
+
+resample_volumes() applies one such transform to several volumes at once (the sampling
+coordinates are computed once per slab and shared), mimicking antsApplyTransforms:
+points outside the input image are set to 0 and the output is written as float32 with
+the reference header.
+
+FSL (flirt) matrices map scaled voxel coordinates of the source image to those of the
+reference image; fsl_to_ras() / ras_to_itk() give the same conversion as
+    c3d_affine_tool -ref ref.nii.gz -src src.nii.gz fsl.mat -fsl2ras -oitk itk.mat
+without launching a process.
+"""
+
+import os
+import struct
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+INTERPOLATION_ORDER = {"Linear": 1, "NearestNeighbor": 0}
+
+# =====================
+# ITK transform files
+# =====================
+
+def read_matlab_v4(path):
+    """Read the variables of a MATLAB v4 .mat file (as written by ITK) into a dict of arrays."""
+    variables = {}
+    with open(path, "rb") as f:
+        content = f.read()
+
+    pos = 0
+    while pos + 20 <= len(content):
+        mopt, mrows, ncols, imagf, namlen = struct.unpack("<5i", content[pos:pos + 20])
+        endian = "<"
+        if mopt < 0 or mopt > 9999:
+            # big-endian file
+            mopt, mrows, ncols, imagf, namlen = struct.unpack(">5i", content[pos:pos + 20])
+            endian = ">"
+        pos += 20
+        name = content[pos:pos + namlen].rstrip(b"\0").decode("ascii")
+        pos += namlen
+
+        precision = (mopt // 10) % 10
+        dtype = {0: "f8", 1: "f4", 2: "i4", 3: "i2", 4: "u2", 5: "u1"}[precision]
+        count = mrows * ncols
+        data = np.frombuffer(content, dtype=endian + dtype, count=count, offset=pos)
+        pos += count * np.dtype(dtype).itemsize
+        if imagf:
+            pos += count * np.dtype(dtype).itemsize
+        variables[name] = data.astype(np.float64).reshape((mrows, ncols), order="F")
+    return variables
+
+def read_itk_affine(path):
+    """
+    Read a 3D ITK affine transform (binary .mat or text .txt/.tfm).
+    Returns (matrix 3x3, translation 3, center 3) in LPS coordinates.
+    """
+    if path.endswith(".mat"):
+        variables = read_matlab_v4(path)
+        params = next(v for k, v in variables.items() if k.startswith(("AffineTransform", "MatrixOffsetTransformBase"))).ravel()
+        center = variables.get("fixed", np.zeros((3, 1))).ravel()
+    else:
+        params, center = None, np.zeros(3)
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith("Parameters:"):
+                    params = np.array(line.split(":", 1)[1].split(), dtype=float)
+                elif line.startswith("FixedParameters:"):
+                    center = np.array(line.split(":", 1)[1].split(), dtype=float)
+        if params is None:
+            raise ValueError(f"No transform parameters found in {path}")
+
+    matrix = params[:9].reshape(3, 3)
+    translation = params[9:12]
+    return matrix, translation, center
+
+def write_itk_affine(path, transform):
+    """
+    Write a 4x4 LPS (fixed -> moving) matrix as an ITK AffineTransform_double_3_3, in the
+    binary MATLAB v4 format for .mat files (as antsRegistration does), text otherwise.
+    """
+    params = np.concatenate([transform[:3, :3].ravel(), transform[:3, 3]])
+    center = np.zeros(3)
+    if path.endswith(".mat"):
+        with open(path, "wb") as f:
+            for name, values in [("AffineTransform_double_3_3", params), ("fixed", center)]:
+                name = name.encode("ascii") + b"\0"
+                # mopt 0: little-endian, double precision, full matrix (values x 1)
+                f.write(struct.pack("<5i", 0, len(values), 1, 0, len(name)))
+                f.write(name)
+                f.write(np.asarray(values, dtype="<f8").tobytes())
+    else:
+        with open(path, "w") as f:
+            f.write("#Insight Transform File V1.0\n#Transform 0\n")
+            f.write("Transform: AffineTransform_double_3_3\n")
+            f.write("Parameters: " + " ".join(f"{v:.17g}" for v in params) + "\n")
+            f.write("FixedParameters: " + " ".join(f"{v:.17g}" for v in center) + "\n")
+    return path
+
+def itk_affine_to_matrix(matrix, translation, center):
+    """4x4 homogeneous matrix (LPS, fixed -> moving) of an ITK affine."""
+    T = np.eye(4)
+    T[:3, :3] = matrix
+    T[:3, 3] = translation + center - matrix @ center
+    return T
+
+def itk_to_ras(itk_transform):
+    """RAS world matrix (moving -> fixed, i.e. the image motion) of an ITK transform."""
+    return np.linalg.inv(LPS @ itk_transform @ LPS)
+
+def ras_to_itk(ras_matrix):
+    """ITK transform (LPS, fixed -> moving) of a RAS world matrix moving -> fixed (c3d -oitk)."""
+    return LPS @ np.linalg.inv(ras_matrix) @ LPS
+
+# =====================
+# FSL matrices
+# =====================
+
+def read_fsl_matrix(path):
+    """Read a 4x4 FSL (flirt -omat) text matrix."""
+    return np.loadtxt(path, dtype=np.float64).reshape(4, 4)
+
+def write_fsl_matrix(path, matrix):
+    """Write a 4x4 matrix in the FSL text format."""
+    with open(path, "w") as f:
+        for row in matrix:
+            f.write(" ".join(f"{val:.10f}" for val in row) + "\n")
+    return path
+
+def fsl_scaled_voxel_matrix(img):
+    """
+    Voxel -> FSL scaled voxel coordinates (mm along the voxel axes). FSL mirrors the first
+    axis of images stored in neurological order (positive determinant).
+    """
+    zooms = img.header.get_zooms()[:3]
+    S = np.diag([zooms[0], zooms[1], zooms[2], 1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        S[0, 0] = -zooms[0]
+        S[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return S
+
+def fsl_to_ras(fsl_matrix, src_img, ref_img):
+    """RAS world matrix (source -> reference) of an FSL matrix (c3d -fsl2ras)."""
+    return (ref_img.affine @ np.linalg.inv(fsl_scaled_voxel_matrix(ref_img)) @ fsl_matrix
+            @ fsl_scaled_voxel_matrix(src_img) @ np.linalg.inv(src_img.affine))
+
+def ras_to_fsl(ras_matrix, src_img, ref_img):
+    """FSL matrix of a RAS world matrix (source -> reference) (c3d -ras2fsl)."""
+    return (fsl_scaled_voxel_matrix(ref_img) @ np.linalg.inv(ref_img.affine) @ ras_matrix
+            @ src_img.affine @ np.linalg.inv(fsl_scaled_voxel_matrix(src_img)))
+
+def fsl_to_itk(fsl_path, itk_path, src_path, ref_path):
+    """Convert a flirt matrix to an ITK transform usable by antsApplyTransforms."""
+    ras = fsl_to_ras(read_fsl_matrix(fsl_path), nib.load(src_path), nib.load(ref_path))
+    return write_itk_affine(itk_path, ras_to_itk(ras))
+
+def flip_x_fsl_matrix(template_path):
+    """FSL matrix mirroring an image along its first axis (in scaled voxel coordinates)."""
+    img = nib.load(template_path)
+    res_x = img.header.get_zooms()[0]
+    width = img.shape[0]
+    matrix = np.eye(4)
+    matrix[0, 0] = -1.0
+    matrix[0, 3] = (width * res_x) - res_x
+    return matrix
+
+@functools.lru_cache(maxsize=None)
+def _flip_x_matrices(template_path, mtime_ns):
+    fsl_matrix = flip_x_fsl_matrix(template_path)
+    img = nib.load(template_path)
+    return fsl_matrix, ras_to_itk(fsl_to_ras(fsl_matrix, img, img))
+
+def flip_x_matrices(template_path):
+    """
+    (FSL matrix, ITK transform) of the Left-Right flip of a template onto itself. Cached
+    per template file (path and mtime), so it is computed once per run.
+    """
+    fsl_matrix, itk_transform = _flip_x_matrices(template_path, os.stat(template_path).st_mtime_ns)
+    return fsl_matrix.copy(), itk_transform.copy()
+
+def voxel_mapping(reference_affine, moving_affine, itk_transform):
+    """Reference voxel -> moving voxel 4x4 matrix for an ITK (LPS) fixed -> moving transform."""
+    return np.linalg.inv(moving_affine) @ LPS @ itk_transform @ LPS @ reference_affine
+
+# =====================
+# Resampling
+# =====================
+
+def sample_slab(volume, coords, order):
+    """
+    Sample volume at continuous voxel coordinates (3, N) like ITK: edge values are used
+    between the last voxel centre and the image border, and 0 outside of the image.
+    """
+    values = ndimage.map_coordinates(volume, coords, order=order, mode="nearest", prefilter=False)
+    shape = np.array(volume.shape, dtype=np.float64)[:, None]
+    outside = np.any((coords < -0.5) | (coords > shape - 0.5), axis=0)
+    values[outside] = 0
+    return values
+
+def resample_volumes(volumes, reference_path, transform_path, threads=1, slab_size=8):
+    """
+    Resample several volumes onto the reference grid with the same ITK affine.
+
+    volumes: list of (input_path, output_path, interpolation) with interpolation in
+    "Linear" / "NearestNeighbor". Inputs sharing the same grid share the sampling
+    coordinates. Slabs of slab_size reference slices are processed across threads,
+    so only the coordinates of the running slabs are kept in memory.
+    """
+    reference = nib.load(reference_path)
+    ref_shape = reference.shape[:3]
+    itk_transform = itk_affine_to_matrix(*read_itk_affine(transform_path))
+
+    inputs = []
+    for in_path, out_path, interpolation in volumes:
+        img = nib.load(in_path)
+        data = img.get_fdata(dtype=np.float32)
+        mapping = voxel_mapping(reference.affine, img.affine, itk_transform)
+        inputs.append((data, mapping, INTERPOLATION_ORDER[interpolation], out_path))
+
+    outputs = [np.zeros(ref_shape, dtype=np.float32) for _ in inputs]
+
+    i, j = np.meshgrid(np.arange(ref_shape[0]), np.arange(ref_shape[1]), indexing="ij")
+
+    def process(z0):
+        z1 = min(z0 + slab_size, ref_shape[2])
+        k = np.arange(z0, z1)
+        grid = np.stack([
+            np.repeat(i[..., None], len(k), axis=2).ravel(),
+            np.repeat(j[..., None], len(k), axis=2).ravel(),
+            np.broadcast_to(k, (ref_shape[0], ref_shape[1], len(k))).ravel(),
+            np.ones(ref_shape[0] * ref_shape[1] * len(k))
+        ])
+        cache = {}
+        for (data, mapping, order, _), out in zip(inputs, outputs):
+            key = mapping.tobytes()
+            if key not in cache:
+                cache[key] = (mapping @ grid)[:3]
+            out[:, :, z0:z1] = sample_slab(data, cache[key], order).reshape(ref_shape[0], ref_shape[1], len(k))
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(process, range(0, ref_shape[2], slab_size)))
+
+    for (_, _, _, out_path), out in zip(inputs, outputs):
+        img = nib.Nifti1Image(out, reference.affine, reference.header)
+        img.set_data_dtype(np.float32)
+        nib.save(img, out_path)
+
+    return [out_path for _, out_path, _ in volumes]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Cache of precomposed longitudinal transforms.
+
+long/ only holds the transforms of adjacent sessions (ses-0_to_ses-1, ses-1_to_ses-2, ...):
+mapping ses-0 onto ses-3 either resamples the image once per hop, or passes a chain of -t
+to antsApplyTransforms, which evaluates every transform at every voxel. WarpCache composes
+such a chain once, on the grid of the reference image, into a single transform:
+  - a chain of affines is composed exactly into one ITK affine (.mat);
+  - a chain with displacement fields becomes one ANTs displacement field (.nii.gz), the
+    fields being sampled with linear interpolation (0 displacement outside their domain).
+
+Transforms are given in the antsApplyTransforms order (the last one is applied first to the
+reference points), "[path,1]" inverting an affine. The composed transform is stored as
+<cache_dir>/<name>_<hash>.{mat,nii.gz} with a .json sidecar listing its constituents, the
+hash covering the content of the constituents, their order, their inversion flags and the
+reference grid: a transform is recomposed only when one of them changed. Content hashes are
+cached in <cache_dir>/index.json by (size, mtime) (utils/hash_index.py).
+
+Usage (from the repository root), to precompose every session pair:
+    python -m utils.warp_cache --long_dir BaBa21_openneuro/derivatives/transforms/sub-BaBa21/long \\
+      --sessions ses-3 ses-2 ses-1 ses-0 --reg_long_type CACP_MM \\
+      --references ses-3:ses-3_T1w.nii.gz ... --threads 8
+"""
+
+import os
+import glob
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+
+from utils.transforms import LPS, read_itk_affine, itk_affine_to_matrix, write_itk_affine, sample_slab
+from utils.morph import load_displacement_field
+from utils.hash_index import HashIndex
+
+# =====================
+# Transform chains
+# =====================
+
+def parse_transform(spec):
+    """(path, invert) of an antsApplyTransforms -t argument: path or [path,1]."""
+    spec = str(spec)
+    if spec.startswith("[") and spec.endswith("]"):
+        path, _, flag = spec[1:-1].rpartition(",")
+        return path, flag.strip() in ("1", "true")
+    return spec, False
+
+def is_displacement_field(path):
+    return str(path).endswith((".nii", ".nii.gz"))
+
+def load_transform(spec):
+    """("affine", 4x4 LPS fixed -> moving) or ("field", (x, y, z, 3) LPS field, affine)."""
+    path, invert = parse_transform(spec)
+    if is_displacement_field(path):
+        if invert:
+            raise ValueError(f"Displacement fields cannot be inverted, use the InverseWarp: {spec}")
+        return ("field",) + load_displacement_field(path)
+    matrix = itk_affine_to_matrix(*read_itk_affine(path))
+    return ("affine", np.linalg.inv(matrix) if invert else matrix)
+
+def transform_points(points, transforms):
+    """Map (3, N) LPS points of the reference through the chain (last transform first)."""
+    for transform in reversed(transforms):
+        if transform[0] == "affine":
+            points = transform[1][:3, :3] @ points + transform[1][:3, 3:]
+        else:
+            _, field, field_affine = transform
+            to_voxel = np.linalg.inv(field_affine) @ LPS
+            coords = to_voxel[:3, :3] @ points + to_voxel[:3, 3:]
+            points = points + np.stack([sample_slab(field[..., c], coords, 1) for c in range(3)])
+    return points
+
+def compose_affines(transforms):
+    """Single 4x4 LPS matrix of a chain of affines."""
+    composed = np.eye(4)
+    for _, matrix in transforms:
+        composed = composed @ matrix
+    return composed
+
+def compose_field(transforms, reference, threads=1, slab_size=8):
+    """(x, y, z, 3) float32 LPS displacement field of the chain on the reference grid."""
+    shape = reference.shape[:3]
+    field = np.zeros(shape + (3,), dtype=np.float32)
+    to_lps = LPS @ reference.affine
+
+    def process(z0):
+        z1 = min(z0 + slab_size, shape[2])
+        i, j, k = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), np.arange(z0, z1), indexing="ij")
+        grid = np.stack([i.ravel(), j.ravel(), k.ravel()]).astype(np.float64)
+        points = to_lps[:3, :3] @ grid + to_lps[:3, 3:]
+        displacement = transform_points(points, transforms) - points
+        field[:, :, z0:z1] = displacement.T.reshape(shape[0], shape[1], z1 - z0, 3)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        list(executor.map(process, range(0, shape[2], slab_size)))
+    return field
+
+def write_displacement_field(path, field, reference):
+    """Save a displacement field in the ANTs layout: 5D (x, y, z, 1, 3) vector image."""
+    header = reference.header.copy()
+    img = nib.Nifti1Image(field[:, :, :, None, :], reference.affine, header)
+    img.set_data_dtype(np.float32)
+    img.header.set_intent("vector")
+    img.header.set_xyzt_units(*reference.header.get_xyzt_units())
+    nib.save(img, str(path))
+    return path
+
+def compose_transforms(specs, reference_path, out_path, threads=1, slab_size=8):
+    """Compose a chain of -t arguments into out_path (.mat for affines only, .nii.gz otherwise)."""
+    transforms = [load_transform(spec) for spec in specs]
+    if str(out_path).endswith(".mat"):
+        if any(t[0] != "affine" for t in transforms):
+            raise ValueError("A chain with displacement fields must be composed into a .nii.gz field")
+        return write_itk_affine(str(out_path), compose_affines(transforms))
+    reference = nib.load(str(reference_path))
+    return write_displacement_field(out_path, compose_field(transforms, reference, threads, slab_size), reference)
+
+# =====================
+# Cache
+# =====================
+
+class WarpCache:
+    """Composed transforms of a long/ directory, keyed by the hash of their constituents."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = str(cache_dir)
+        self.index = HashIndex(os.path.join(self.cache_dir, "index.json"))
+
+    def chain_hash(self, specs, reference_path):
+        """Hash of the constituents (content, order, inversion) and of the reference grid."""
+        sha = hashlib.sha256()
+        for spec in specs:
+            path, invert = parse_transform(spec)
+            sha.update(self.index.file_hash(path).encode())
+            sha.update(b"1" if invert else b"0")
+        reference = nib.load(str(reference_path))
+        sha.update(str(reference.shape[:3]).encode())
+        sha.update(np.asarray(reference.affine, dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def get(self, name, specs, reference_path, threads=1, dry_run=False):
+        """
+        -t argument of the chain specs composed on the reference grid, computed on first use.
+        A single transform is returned as is.
+        """
+        specs = [str(spec) for spec in specs]
+        if len(specs) == 1:
+            return specs[0]
+        ext = ".nii.gz" if any(is_displacement_field(parse_transform(s)[0]) for s in specs) else ".mat"
+
+        missing = [parse_transform(s)[0] for s in specs if not os.path.exists(parse_transform(s)[0])]
+        if missing or not os.path.exists(str(reference_path)):
+            if not dry_run:
+                raise FileNotFoundError(f"Cannot compose {name}, missing: {', '.join(missing) or reference_path}")
+            out_path = os.path.join(self.cache_dir, f"{name}_<hash>{ext}")
+            print(f"[DRY RUN] compose {len(specs)} transforms -> {out_path}")
+            return out_path
+
+        digest = self.chain_hash(specs, reference_path)
+        out_path = os.path.join(self.cache_dir, f"{name}_{digest[:12]}{ext}")
+        if os.path.exists(out_path):
+            print(f"[warp_cache] Using {out_path}")
+            return out_path
+        if dry_run:
+            print(f"[DRY RUN] compose {len(specs)} transforms -> {out_path}")
+            return out_path
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # previous compositions of the same chain are stale
+        for stale in glob.glob(os.path.join(glob.escape(self.cache_dir), f"{glob.escape(name)}_*")):
+            if os.path.basename(stale)[len(name) + 1:].split(".")[0].isalnum():
+                os.remove(stale)
+
+        print(f"[warp_cache] Composing {len(specs)} transforms -> {out_path}")
+        tmp_path = os.path.join(self.cache_dir, f"{name}.tmp_{digest[:12]}{ext}")
+        compose_transforms(specs, reference_path, tmp_path, threads)
+        os.replace(tmp_path, out_path)
+        with open(out_path[:-len(ext)] + ".json", "w", encoding="utf-8") as f:
+            json.dump({"transforms": specs, "reference": str(reference_path), "sha256": digest}, f, indent=1)
+        self.index.save()
+        return out_path
+
+# =====================
+# Longitudinal session pairs
+# =====================
+
+def long_chain(long_dir, sessions, reg_long_type, ses_from, ses_to):
+    """
+    -t chain mapping images of ses_from onto ses_to through the adjacent SyN transforms of
+    interpolate_long_template.py ({a}_to_{b}_{type}_so_0Warp / _so_0InverseWarp, sessions in order).
+    """
+    i, j = sessions.index(ses_from), sessions.index(ses_to)
+    if i == j:
+        raise ValueError(f"Same session {ses_from}")
+
+    def prefix(a, b):
+        return os.path.join(str(long_dir), f"{sessions[a]}_to_{sessions[b]}_{reg_long_type}_so_0")
+
+    if i < j:
+        # the reference point goes back from ses_to to ses_from through the Warps
+        return [prefix(k, k + 1) + "Warp.nii.gz" for k in range(i, j)]
+    return [prefix(k, k + 1) + "InverseWarp.nii.gz" for k in reversed(range(j, i))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompose the longitudinal warps of every session pair")
+    parser.add_argument("--long_dir", required=True, help="transforms/sub-<name>/long folder")
+    parser.add_argument("--sessions", nargs="+", required=True, help="List of sessions (ordered, as registered)")
+    parser.add_argument("--reg_long_type", default="CACP_MM", help="name of registration type (default: CACP_MM)")
+    parser.add_argument("--references", nargs="+", required=True,
+                        help="Reference grid of each session, as ses:path (e.g. ses-3:sub-BaBa21_ses-3_T1w.nii.gz)")
+    parser.add_argument("--cache_dir", help="Cache folder (default: <long_dir>/cache)")
+    parser.add_argument("--threads", type=int, default=1, help="Number of threads (default: 1)")
+    parser.add_argument("--dry-run", action="store_true", help="Don't actually compose")
+    args = parser.parse_args()
+
+    references = dict(item.split(":", 1) for item in args.references)
+    cache = WarpCache(args.cache_dir or os.path.join(args.long_dir, "cache"))
+    for ses_from in args.sessions:
+        for ses_to in args.sessions:
+            if ses_from == ses_to or abs(args.sessions.index(ses_from) - args.sessions.index(ses_to)) < 2:
+                continue
+            chain = long_chain(args.long_dir, args.sessions, args.reg_long_type, ses_from, ses_to)
+            cache.get(f"{ses_from}_to_{ses_to}_{args.reg_long_type}_so_0Warp", chain, references[ses_to],
+                      args.threads, args.dry_run)
+
+if __name__ == "__main__":
+    main()